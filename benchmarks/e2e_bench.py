@@ -0,0 +1,204 @@
+"""End-to-end load test: the full bot, as main.py builds it, against the fake Bot API with simulated users.
+
+    python -m benchmarks.e2e_bench --users 50000 --latency 0.02 --blocked 0.01 --retry-after-rate 0.001
+
+Starts benchmarks.fake_bot_api in a separate process (so its users don't share the bot's event
+loop), builds a fresh database with a synthetic population whose morning peak lands on the next
+minute, then runs the Application from main.build_application() in polling mode with its base_url
+pointed at the fake server: persistence, job queue, reminder engine and every handler included.
+Simulated users tap ✅ Taken or ⏰ Snooze on their reminders, which come back to the bot through
+getUpdates. Reports reminders/sec as seen by the fake server, and the latency from each tap to the
+bot's answerCallbackQuery and to its editMessageText (the ack), and saves the results as JSON
+under benchmarks/results/ like scheduler_bench.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+_workdir = tempfile.mkdtemp(prefix="mediminder-e2e-")
+os.environ["DB_NAME"] = os.path.join(_workdir, "e2e.db")
+os.environ["DB_BACKEND"] = "sqlite"  # The synthetic population is written straight into the SQLite file.
+os.environ.setdefault("TELEGRAM_TOKEN", "0:e2e")
+os.environ.setdefault("MATERIALIZE_HORIZON_DAYS", "1")  # The run only needs today's reminders.
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import database as db  # noqa: E402  (after DB_NAME is pointed at the scratch database)
+import main as bot_main  # noqa: E402
+from dispatcher import dispatcher  # noqa: E402
+from telegram.ext import Application  # noqa: E402
+
+from benchmarks import fake_bot_api, population  # noqa: E402
+from benchmarks.scheduler_bench import MORNING_PEAK, RESULTS_DIR, git_commit, peak_rss_mb  # noqa: E402
+
+logger = logging.getLogger("benchmarks.e2e")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_api(args, port):
+    command = [sys.executable, "-m", "benchmarks.fake_bot_api", "--port", str(port),
+               "--latency", str(args.latency), "--retry-after-rate", str(args.retry_after_rate),
+               "--retry-after", str(args.retry_after), "--blocked", str(args.blocked),
+               "--not-found", str(args.not_found), "--ack", str(args.ack), "--snooze", str(args.snooze),
+               "--reaction-mean", str(args.reaction_mean), "--seed", str(args.seed)]
+    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            if httpx.post(f"{url}/bot{os.environ['TELEGRAM_TOKEN']}/getMe").status_code == 200:
+                return process, url
+        except httpx.TransportError:
+            pass
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("The fake Bot API did not start.")
+
+
+async def fake_stats(client, url):
+    return (await client.get(f"{url}/_stats")).json()
+
+
+async def wait_for(client, url, done, timeout, what):
+    """Polls the fake server's stats until `done(stats)`; returns (stats, seconds waited)."""
+    start = time.perf_counter()
+    while True:
+        stats = await fake_stats(client, url)
+        if done(stats):
+            break
+        if time.perf_counter() - start > timeout:
+            logger.warning(f"Timed out waiting for {what}: {json.dumps(stats['counters'])}")
+            break
+        await asyncio.sleep(0.25)
+    return stats, time.perf_counter() - start
+
+
+async def run(args, url):
+    start = time.perf_counter()
+    db.init_db()
+    summary = population.generate(db.get_db_connection(), args.users * args.meds_per_user, args.meds_per_user,
+                                  args.history_days, args.seed)
+    now = datetime.now(timezone.utc)
+    peak_at = now.replace(second=0, microsecond=0) + timedelta(minutes=1 if now.second < 30 else 2)
+    population.shift_slots(db.get_db_connection(), (peak_at.hour * 60 + peak_at.minute - MORNING_PEAK) % (24 * 60))
+    populate_s = time.perf_counter() - start
+
+    dispatcher.workers = args.workers
+    dispatcher.global_rate = args.rate
+    application = bot_main.build_application(
+        Application.builder().base_url(f"{url}/bot").connection_pool_size(args.workers + 16)
+    )
+    start = time.perf_counter()
+    await application.initialize()
+    await bot_main.post_init(application)  # run_polling() would call it; the harness drives the app itself.
+    await application.start()
+    await application.updater.start_polling(poll_interval=0, timeout=10)
+    startup_s = time.perf_counter() - start
+
+    due = db.get_db_connection().execute(
+        "SELECT COUNT(*) FROM reminders_log WHERE scheduled_time = ?", (db.to_db_timestamp(peak_at),)
+    ).fetchone()[0]
+    wait = (peak_at - datetime.now(timezone.utc)).total_seconds()
+    if wait > 0:
+        logger.info(f"{due} reminders due at {peak_at.strftime('%H:%M')} UTC; waiting {wait:.0f}s.")
+        await asyncio.sleep(wait)
+
+    async with httpx.AsyncClient() as client:
+        def delivered(stats):
+            counters = stats["counters"]
+            return counters.get("reminders", 0) + counters.get("rejected_403", 0) + counters.get("rejected_400", 0) >= due
+
+        stats, send_s = await wait_for(client, url, delivered, args.timeout, "reminders")
+
+        def acked(stats):
+            counters = stats["counters"]
+            taps = counters.get("taps_ack", 0) + counters.get("taps_snooze", 0)
+            answered = (stats["answer_latency_s"] or {}).get("count", 0)
+            return answered >= taps and not stats["pending_updates"]
+
+        # Taps keep arriving for a few reaction times after the last reminder.
+        await asyncio.sleep(args.reaction_mean * 5)
+        stats, _ = await wait_for(client, url, acked, args.timeout, "acks")
+
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    await bot_main.post_shutdown(application)
+
+    counters = stats["counters"]
+    return {
+        "populate_s": round(populate_s, 2), **summary,
+        "startup_s": round(startup_s, 2),
+        "due": due,
+        "sent": counters.get("reminders", 0),
+        "blocked": counters.get("rejected_403", 0),
+        "not_found": counters.get("rejected_400", 0),
+        "send_s": round(send_s, 2),
+        "reminders_per_s": round(counters.get("reminders", 0) / send_s, 1) if send_s else None,
+        "reminders_per_s_peak": stats["reminders_per_second"]["peak"],
+        "answer_latency_s": stats["answer_latency_s"],
+        "ack_latency_s": stats["ack_latency_s"],
+        "user_events": counters,
+        "api_calls": stats["calls"],
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--meds-per-user", type=int, default=2)
+    parser.add_argument("--history-days", type=int, default=1, help="Days of handled reminders_log rows to generate")
+    parser.add_argument("--workers", type=int, default=dispatcher.workers, help="Dispatcher send workers")
+    parser.add_argument("--rate", type=float, default=dispatcher.global_rate,
+                        help="Global send rate limit (default: DISPATCH_GLOBAL_RATE, Telegram's real limit)")
+    parser.add_argument("--timeout", type=float, default=1800, help="Max seconds to wait for sends or acks")
+    fake_bot_api.add_arguments(parser)
+    parser.add_argument("--out", help="Where to write results (default: benchmarks/results/<commit>-e2e-<users>.json)")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(message)s", level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    process, url = start_fake_api(args, free_port())
+    try:
+        result = asyncio.run(run(args, url))
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(_workdir, ignore_errors=True)
+    logger.info(json.dumps(result))
+    commit = git_commit()
+    results = {
+        "commit": commit,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "sqlite": db.sqlite3.sqlite_version,
+        "params": vars(args),
+        "result": result,
+    }
+    out = args.out or os.path.join(RESULTS_DIR, f"{commit}-e2e-{args.users}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""A local stand-in for the Telegram Bot API, with simulated users, for end-to-end load tests.
+
+    python -m benchmarks.fake_bot_api --port 8081 --latency 0.02 --blocked 0.01 --retry-after-rate 0.001
+
+Implements what the bot uses (getMe, getUpdates, sendMessage, answerCallbackQuery,
+editMessageText, editMessageReplyMarkup, deleteWebhook) for any token, at
+http://127.0.0.1:<port>/bot<token>/<method>. Each request takes `--latency` seconds. A share of
+requests is answered 429 with retry_after, and fixed shares of chats have blocked the bot or don't
+exist. When a message carries the reminder's ✅/⏰ buttons, its simulated user taps Taken or
+Snooze (or ignores it) with the configured shares after an exponentially distributed reaction
+time; the tap is delivered through getUpdates. GET /_stats returns counters, sends per second
+and the latency from each tap to the bot's answerCallbackQuery and editMessageText.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+import zlib
+from collections import Counter, deque
+
+import tornado.web
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "MediMinder", "username": "mediminder_fake_bot"}
+
+
+class TelegramError(Exception):
+    def __init__(self, code, description, retry_after=None):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+        self.retry_after = retry_after
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda q: round(values[min(len(values) - 1, int(q * len(values)))], 4)  # noqa: E731
+    return {"count": len(values), "p50": pick(0.50), "p90": pick(0.90), "p99": pick(0.99), "max": round(values[-1], 4)}
+
+
+class FakeBotAPI:
+    """State of the fake API: queued updates, sent messages and the simulated users."""
+
+    def __init__(self, latency=0.0, retry_after_rate=0.0, retry_after=1, blocked=0.0, not_found=0.0,
+                 ack_share=0.8, snooze_share=0.1, reaction_mean=2.0, seed=42):
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.blocked = blocked
+        self.not_found = not_found
+        self.ack_share = ack_share
+        self.snooze_share = snooze_share
+        self.reaction_mean = reaction_mean
+        self.rng = random.Random(seed)
+        self.updates = deque()
+        self.next_update_id = 1
+        self.update_ready = asyncio.Event()
+        self.next_message_id = 1
+        self.calls = Counter()                 # Bot API method -> requests
+        self.counters = Counter()              # reminders, taps, ignored and rejected sends
+        self.reminders_per_second = Counter()  # whole epoch second -> reminders sent
+        self.taps = {}                         # callback_query id -> monotonic time of the tap
+        self.answer_latency = []
+        self.edit_latency = []
+        self._tapped_messages = {}             # message_id -> callback_query id, to match the edit
+
+    # --- Simulated users ---
+    def _chat_fate(self, chat_id):
+        # Stable per chat, so a blocked user stays blocked.
+        roll = (zlib.crc32(str(chat_id).encode()) % 10000) / 10000
+        if roll < self.blocked:
+            return TelegramError(403, "Forbidden: bot was blocked by the user")
+        if roll < self.blocked + self.not_found:
+            return TelegramError(400, "Bad Request: chat not found")
+        return None
+
+    def _user(self, chat_id):
+        return {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"}
+
+    def _queue_update(self, update):
+        update["update_id"] = self.next_update_id
+        self.next_update_id += 1
+        self.updates.append(update)
+        self.update_ready.set()
+
+    def _maybe_tap(self, message):
+        buttons = [button["callback_data"] for row in message.get("reply_markup", {}).get("inline_keyboard", [])
+                   for button in row if "callback_data" in button]
+        ack = next((data for data in buttons if data.startswith("ack:")), None)
+        if ack is None:
+            return
+        self.counters["reminders"] += 1
+        self.reminders_per_second[int(time.time())] += 1
+        snooze = next((data for data in buttons if data.startswith("snooze:")), None)
+        roll = self.rng.random()
+        if roll < self.ack_share:
+            data = ack
+        elif roll < self.ack_share + self.snooze_share and snooze:
+            data = snooze
+        else:
+            self.counters["ignored"] += 1
+            return
+        delay = self.rng.expovariate(1 / self.reaction_mean) if self.reaction_mean > 0 else 0
+        asyncio.get_running_loop().call_later(delay, self._tap, message, data)
+
+    def _tap(self, message, data):
+        query_id = str(self.next_update_id)
+        self.taps[query_id] = time.monotonic()
+        self._tapped_messages[message["message_id"]] = query_id
+        self.counters["taps_" + data.split(":")[0]] += 1
+        self._queue_update({"callback_query": {
+            "id": query_id, "from": self._user(message["chat"]["id"]), "message": message,
+            "chat_instance": str(message["chat"]["id"]), "data": data,
+        }})
+
+    # --- Bot API methods ---
+    async def call(self, method, params):
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return await self.get_updates(params)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method in ("sendMessage", "editMessageText", "editMessageReplyMarkup") and self.retry_after_rate \
+                and self.rng.random() < self.retry_after_rate:
+            raise TelegramError(429, f"Too Many Requests: retry after {self.retry_after}", self.retry_after)
+        handler = getattr(self, "m_" + method, None)
+        if handler is None:
+            raise TelegramError(404, "Not Found: method not found")
+        return handler(params)
+
+    async def get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates:
+            self.update_ready.clear()
+            try:
+                await asyncio.wait_for(self.update_ready.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        return [self.updates[i] for i in range(min(limit, len(self.updates)))]
+
+    def m_getMe(self, params):
+        return BOT_USER
+
+    def m_deleteWebhook(self, params):
+        return True
+
+    def m_getWebhookInfo(self, params):
+        return {"url": "", "has_custom_certificate": False, "pending_update_count": len(self.updates)}
+
+    def m_sendMessage(self, params):
+        chat_id = int(params["chat_id"])
+        fate = self._chat_fate(chat_id)
+        if fate:
+            self.counters["rejected_" + str(fate.code)] += 1
+            raise fate
+        message = {"message_id": self.next_message_id, "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private", "first_name": f"User{chat_id}"},
+                   "from": BOT_USER, "text": params.get("text", "")}
+        self.next_message_id += 1
+        if params.get("reply_markup"):
+            message["reply_markup"] = json.loads(params["reply_markup"])
+        self._maybe_tap(message)
+        return message
+
+    def m_answerCallbackQuery(self, params):
+        tapped_at = self.taps.get(params.get("callback_query_id"))
+        if tapped_at is not None:
+            self.answer_latency.append(time.monotonic() - tapped_at)
+        return True
+
+    def _edited(self, params):
+        message_id = int(params["message_id"])
+        query_id = self._tapped_messages.pop(message_id, None)
+        if query_id is not None:
+            self.edit_latency.append(time.monotonic() - self.taps.pop(query_id))
+        message = {"message_id": message_id, "date": int(time.time()),
+                   "chat": {"id": int(params["chat_id"]), "type": "private"}, "from": BOT_USER,
+                   "text": params.get("text", "")}
+        if params.get("reply_markup"):
+            message["reply_markup"] = json.loads(params["reply_markup"])
+        return message
+
+    def m_editMessageText(self, params):
+        return self._edited(params)
+
+    def m_editMessageReplyMarkup(self, params):
+        return self._edited(params)
+
+    def stats(self):
+        seconds = sorted(self.reminders_per_second.items())
+        busy = [count for _, count in seconds]
+        return {
+            "calls": dict(self.calls),
+            "counters": dict(self.counters),
+            "reminders_per_second": {"peak": max(busy) if busy else 0,
+                                     "mean": round(sum(busy) / len(busy), 1) if busy else 0,
+                                     "first": seconds[0][0] if seconds else None,
+                                     "last": seconds[-1][0] if seconds else None},
+            "answer_latency_s": _percentiles(self.answer_latency),
+            "ack_latency_s": _percentiles(self.edit_latency),
+            "pending_updates": len(self.updates),
+        }
+
+
+class _MethodHandler(tornado.web.RequestHandler):
+    def initialize(self, api):
+        self.api = api
+
+    async def _handle(self, token, method):
+        params = {key: values[-1].decode() for key, values in self.request.arguments.items()}
+        if self.request.headers.get("Content-Type", "").startswith("application/json") and self.request.body:
+            params.update({key: value if isinstance(value, str) else json.dumps(value)
+                           for key, value in json.loads(self.request.body).items()})
+        try:
+            result = await self.api.call(method, params)
+        except TelegramError as e:
+            body = {"ok": False, "error_code": e.code, "description": e.description}
+            if e.retry_after:
+                body["parameters"] = {"retry_after": e.retry_after}
+            self.set_status(e.code)
+            self.finish(body)
+            return
+        self.finish({"ok": True, "result": result})
+
+    post = get = _handle
+
+
+class _StatsHandler(tornado.web.RequestHandler):
+    def initialize(self, api):
+        self.api = api
+
+    def get(self):
+        self.finish(self.api.stats())
+
+
+def make_app(api):
+    return tornado.web.Application([
+        (r"/bot([^/]+)/(\w+)", _MethodHandler, {"api": api}),
+        (r"/_stats", _StatsHandler, {"api": api}),
+    ])
+
+
+async def serve(args):
+    api = FakeBotAPI(args.latency, args.retry_after_rate, args.retry_after, args.blocked, args.not_found,
+                     args.ack, args.snooze, args.reaction_mean, args.seed)
+    make_app(api).listen(args.port, args.host)
+    logger.info(f"Fake Bot API on http://{args.host}:{args.port} (base_url http://{args.host}:{args.port}/bot)")
+    await asyncio.Event().wait()
+
+
+def add_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds per API request")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="Share of sends answered 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after of injected 429s, in seconds")
+    parser.add_argument("--blocked", type=float, default=0.0, help="Share of chats that blocked the bot")
+    parser.add_argument("--not-found", type=float, default=0.0, help="Share of chats that don't exist")
+    parser.add_argument("--ack", type=float, default=0.8, help="Share of reminders the user confirms")
+    parser.add_argument("--snooze", type=float, default=0.1, help="Share of reminders the user snoozes")
+    parser.add_argument("--reaction-mean", type=float, default=2.0, help="Mean seconds before a user taps")
+    parser.add_argument("--seed", type=int, default=42)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Telegram Bot API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+    logging.getLogger("tornado.access").setLevel(logging.ERROR)  # One line per request otherwise.
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Synthetic users/medications/reminders_log datasets for the scheduler benchmarks.
+
+Slot times cluster the way real schedules do: most doses at the morning and evening peaks, a
+spread of doses around them, and a thin tail over the rest of the day.
+"""
+import random
+from datetime import datetime, timedelta, timezone
+
+import database as db
+
+# (share of medication slots, peak minute of day, spread in minutes either side)
+CLUSTERS = [
+    (0.40, 8 * 60, 0),
+    (0.30, 20 * 60, 0),
+    (0.10, 8 * 60, 45),
+    (0.10, 20 * 60, 45),
+    (0.10, None, None),  # anywhere in the day
+]
+# (share of history rows, status) for reminders that already went through the scheduler
+HISTORY_STATUSES = [(0.80, 'acknowledged'), (0.12, 'missed'), (0.05, 'call_triggered'), (0.03, 'send_failed')]
+BATCH = 50_000
+FIRST_TELEGRAM_ID = 1_000_000_000
+
+
+def _pick(rng, weighted):
+    roll = rng.random()
+    for share, value in weighted:
+        roll -= share
+        if roll < 0:
+            return value
+    return weighted[-1][1]
+
+
+def _slot_minute(rng):
+    peak, spread = _pick(rng, [(share, (peak, spread)) for share, peak, spread in CLUSTERS])
+    if peak is None:
+        minute = rng.randrange(24 * 60)
+    else:
+        minute = peak + (rng.randint(-spread, spread) if spread else 0)
+    return minute % (24 * 60)
+
+
+def _times_of_day(rng):
+    """One to three distinct HH:MM slots drawn from CLUSTERS."""
+    count = _pick(rng, [(0.45, 1), (0.45, 2), (0.10, 3)])
+    minutes = set()
+    while len(minutes) < count:
+        minutes.add(_slot_minute(rng))
+    return ",".join(f"{m // 60:02d}:{m % 60:02d}" for m in sorted(minutes))
+
+
+def generate(conn, meds, meds_per_user=2, history_days=1, seed=42):
+    """Fills an initialised, empty database with `meds` active medications.
+
+    `history_days` of already-handled reminders_log rows are written for each slot.
+    Returns a summary dict.
+    """
+    rng = random.Random(seed)
+    users = max(1, meds // meds_per_user)
+    conn.executemany(
+        "INSERT INTO users (telegram_id, phone_number) VALUES (?, ?)",
+        ((FIRST_TELEGRAM_ID + i, f"+1555{i:07d}" if i % 2 else None) for i in range(users))
+    )
+
+    med_rows = []
+    for med_id in range(1, meds + 1):
+        user_id = FIRST_TELEGRAM_ID + rng.randrange(users)
+        med_rows.append((med_id, user_id, f"Med{med_id}", f"{rng.choice((5, 10, 20, 50, 100))}mg",
+                         _times_of_day(rng)))
+    for start in range(0, len(med_rows), BATCH):
+        conn.executemany(
+            "INSERT INTO medications (id, user_telegram_id, med_name, dosage, times_of_day, is_active) "
+            "VALUES (?, ?, ?, ?, ?, 1)",
+            med_rows[start:start + BATCH]
+        )
+
+    history = 0
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    batch = []
+    for day in range(1, history_days + 1):
+        midnight = today - timedelta(days=day)
+        for med_id, user_id, _, _, times_of_day in med_rows:
+            for minute in _minutes(times_of_day):
+                scheduled = midnight + timedelta(minutes=minute)
+                status = _pick(rng, HISTORY_STATUSES)
+                batch.append((med_id, user_id, db.to_db_timestamp(scheduled), status,
+                              db.to_db_timestamp(scheduled + timedelta(minutes=rng.randint(1, 20)))
+                              if status == 'acknowledged' else None))
+                if len(batch) >= BATCH:
+                    history += _insert_history(conn, batch)
+                    batch = []
+    if batch:
+        history += _insert_history(conn, batch)
+    conn.commit()
+    slots = sum(len(row[4].split(',')) for row in med_rows)
+    return {'users': users, 'medications': meds, 'slots': slots, 'history_rows': history}
+
+
+def _insert_history(conn, batch):
+    conn.executemany(
+        "INSERT INTO reminders_log (medication_id, user_telegram_id, scheduled_time, status, acknowledged_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        batch
+    )
+    return len(batch)
+
+
+def shift_slots(conn, shift_minutes):
+    """Rotates every medication's times_of_day by `shift_minutes`, e.g. to put the 08:00 peak on a given minute."""
+    rows = conn.execute("SELECT id, times_of_day FROM medications").fetchall()
+    updates = []
+    for med_id, times_of_day in rows:
+        minutes = sorted((m + shift_minutes) % (24 * 60) for m in _minutes(times_of_day))
+        updates.append((",".join(f"{m // 60:02d}:{m % 60:02d}" for m in minutes), med_id))
+    conn.executemany("UPDATE medications SET times_of_day = ? WHERE id = ?", updates)
+    conn.commit()
+
+
+def _minutes(times_of_day):
+    for time_str in times_of_day.split(','):
+        h, m = map(int, time_str.split(':'))
+        yield h * 60 + m
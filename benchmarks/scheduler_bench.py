@@ -0,0 +1,218 @@
+"""Scheduler benchmark: runs the reminder and escalation jobs against a synthetic population.
+
+    python -m benchmarks.scheduler_bench --meds 100000 --latency 0.05
+    python -m benchmarks.scheduler_bench --meds 100000 --compare benchmarks/results/<commit>-100000.json
+
+Each run builds a fresh database in a temporary directory, materialises upcoming reminders,
+starts the reminder engine with a StubBot, fires the 08:00 peak slot once and escalates every
+reminder it sent. Per phase it reports wall time, time spent inside DB calls, sends/sec and peak
+RSS, and saves the results as JSON under benchmarks/results/ for comparison with other commits.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+_workdir = tempfile.mkdtemp(prefix="mediminder-bench-")
+os.environ["DB_NAME"] = os.path.join(_workdir, "bench.db")
+os.environ["DB_BACKEND"] = "sqlite"  # The synthetic population is written straight into the SQLite file.
+os.environ.setdefault("TELEGRAM_TOKEN", "0:benchmark")
+
+import database as db  # noqa: E402  (after DB_NAME is pointed at the scratch database)
+import db_async as adb  # noqa: E402
+import metrics  # noqa: E402
+import scheduler as reminder_scheduler  # noqa: E402
+from apscheduler.schedulers.asyncio import AsyncIOScheduler  # noqa: E402
+from dispatcher import dispatcher  # noqa: E402
+from write_behind import status_writer  # noqa: E402
+
+from benchmarks import population  # noqa: E402
+from benchmarks.stub_bot import StubBot  # noqa: E402
+
+logger = logging.getLogger("benchmarks.scheduler")
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+MORNING_PEAK = 8 * 60
+
+
+class DBTimer:
+    """Reads the time spent inside DB calls on the pool threads from metrics.db_call_seconds."""
+
+    def __init__(self):
+        self._calls, self._seconds = metrics.db_call_seconds.totals()
+
+    def reset(self):
+        calls, seconds = metrics.db_call_seconds.totals()
+        result = (seconds - self._seconds, calls - self._calls)
+        self._calls, self._seconds = calls, seconds
+        return result
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024, 1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def outbox_count():
+    return db.get_db_connection().execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+
+async def drain(bot, target, timeout):
+    """Waits until the stub bot has sent `target` messages; returns the seconds it took."""
+    start = time.perf_counter()
+    while bot.sent < target:
+        if time.perf_counter() - start > timeout:
+            logger.warning(f"Drain timed out with {bot.sent}/{target} messages sent.")
+            break
+        await asyncio.sleep(0.01)
+    return time.perf_counter() - start
+
+
+def phase(name, wall, db_timer, **extra):
+    db_seconds, db_calls = db_timer.reset()
+    result = {"phase": name, "wall_s": round(wall, 4), "db_s": round(db_seconds, 4), "db_calls": db_calls,
+              "peak_rss_mb": peak_rss_mb(), **extra}
+    logger.info(json.dumps(result))
+    return result
+
+
+async def run(args):
+    db_timer = DBTimer()
+    phases = []
+
+    start = time.perf_counter()
+    db.init_db()
+    summary = population.generate(db.get_db_connection(), args.meds, args.meds_per_user, args.history_days, args.seed)
+    # Put the morning peak on the next whole minute that leaves time to load the engine.
+    now = datetime.now(timezone.utc)
+    peak_at = now.replace(second=0, microsecond=0) + timedelta(minutes=1 if now.second < 30 else 2)
+    population.shift_slots(db.get_db_connection(), (peak_at.hour * 60 + peak_at.minute - MORNING_PEAK) % (24 * 60))
+    phases.append(phase("populate", time.perf_counter() - start, db_timer, **summary))
+
+    start = time.perf_counter()
+    materialized = await adb.run(db.extend_reminder_horizon, args.horizon_days)
+    phases.append(phase("materialize", time.perf_counter() - start, db_timer, rows=materialized))
+
+    bot = StubBot(latency=args.latency, jitter=args.jitter)
+    dispatcher.workers = args.workers
+    dispatcher.global_rate = args.rate
+    scheduler = AsyncIOScheduler(timezone=timezone.utc)  # never started: the benchmark fires the jobs itself
+
+    start = time.perf_counter()
+    await reminder_scheduler.start_reminder_engine(scheduler, bot)
+    phases.append(phase("engine_start", time.perf_counter() - start, db_timer))
+
+    wait = (peak_at - datetime.now(timezone.utc)).total_seconds()
+    if wait > 0:
+        logger.info(f"Waiting {wait:.0f}s for the peak slot at {peak_at.strftime('%H:%M')} UTC.")
+        await asyncio.sleep(wait)
+    queued_before = outbox_count()
+    start = time.perf_counter()
+    await reminder_scheduler.check_and_send_reminders(bot)
+    tick = time.perf_counter() - start
+    queued = outbox_count() - queued_before
+    drained = await drain(bot, queued, args.drain_timeout)
+    phases.append(phase("reminder_tick", tick, db_timer, due=queued, sent=bot.sent,
+                        drain_s=round(drained, 4), sends_per_s=round(bot.sent / drained, 1) if drained else None))
+
+    # Every reminder just sent goes unanswered; bring its deadline forward so escalation runs now.
+    await status_writer.flush_now()
+    conn = db.get_db_connection()
+    conn.execute("UPDATE reminders_log SET escalate_at = ? WHERE status = 'sent'",
+                 (db.to_db_timestamp(datetime.now(timezone.utc)),))
+    conn.commit()
+    db_timer.reset()
+    sent_before = bot.sent
+    queued_before = outbox_count()
+    start = time.perf_counter()
+    await reminder_scheduler.check_missed_reminders_and_escalate(bot)
+    tick = time.perf_counter() - start
+    queued = outbox_count() - queued_before
+    drained = await drain(bot, sent_before + queued, args.drain_timeout)
+    phases.append(phase("escalation_tick", tick, db_timer, due=queued, sent=bot.sent - sent_before,
+                        drain_s=round(drained, 4),
+                        sends_per_s=round((bot.sent - sent_before) / drained, 1) if drained else None))
+
+    await reminder_scheduler.stop_reminder_engine()
+    await adb.shutdown()
+    return phases
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {p["phase"]: p for p in json.load(f)["phases"]}
+    print(f"\n{'phase':<16}{'metric':<14}{'baseline':>12}{'current':>12}{'change':>10}")
+    for current in results["phases"]:
+        base = baseline.get(current["phase"])
+        if not base:
+            continue
+        for metric in ("wall_s", "db_s", "drain_s", "sends_per_s", "peak_rss_mb"):
+            old, new = base.get(metric), current.get(metric)
+            if old is None or new is None:
+                continue
+            change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+            print(f"{current['phase']:<16}{metric:<14}{old:>12}{new:>12}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--meds", type=int, default=10_000, help="Active medications to generate (e.g. 10000, 100000, 1000000)")
+    parser.add_argument("--meds-per-user", type=int, default=2)
+    parser.add_argument("--history-days", type=int, default=1, help="Days of handled reminders_log rows to generate")
+    parser.add_argument("--horizon-days", type=int, default=db.MATERIALIZE_HORIZON_DAYS,
+                        help="Days of upcoming reminders to materialise")
+    parser.add_argument("--latency", type=float, default=0.05, help="Stub send latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random ± added to each send's latency")
+    parser.add_argument("--workers", type=int, default=dispatcher.workers, help="Dispatcher send workers")
+    parser.add_argument("--rate", type=float, default=1_000_000, help="Global send rate limit (default: unlimited)")
+    parser.add_argument("--drain-timeout", type=float, default=600, help="Max seconds to wait for sends to finish")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", help="Where to write results (default: benchmarks/results/<commit>-<meds>.json)")
+    parser.add_argument("--compare", help="Results file of an earlier run to compare against")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(message)s", level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    try:
+        phases = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(_workdir, ignore_errors=True)
+    commit = git_commit()
+    results = {
+        "commit": commit,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "sqlite": db.sqlite3.sqlite_version,
+        "params": vars(args),
+        "phases": phases,
+    }
+    out = args.out or os.path.join(RESULTS_DIR, f"{commit}-{args.meds}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {out}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
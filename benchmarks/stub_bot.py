@@ -0,0 +1,24 @@
+"""A stand-in for telegram.Bot whose send_message never leaves the process."""
+import asyncio
+import random
+from datetime import datetime, timezone
+
+from telegram import Chat, Message
+
+
+class StubBot:
+    """Counts sends instead of calling Telegram, taking `latency` seconds (± `jitter`) per send."""
+
+    def __init__(self, latency=0.05, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        delay = self.latency + (random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.sent += 1
+        return Message(
+            message_id=self.sent, date=datetime.now(timezone.utc), chat=Chat(id=chat_id, type=Chat.PRIVATE), text=text
+        )
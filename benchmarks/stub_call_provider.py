@@ -0,0 +1,120 @@
+"""A local stand-in for the Twilio Calls API, for trying call escalation without placing real calls.
+
+    python -m benchmarks.stub_call_provider --port 8089 --latency 0.2 --fail-rate 0.1
+
+then run the bot with CALL_PROVIDER_URL=http://127.0.0.1:8089, any TWILIO_* values and
+CALL_PROVIDER_IDEMPOTENT=1. Each placed call is logged; POST answers 201 with a call sid,
+or 503 for the --fail-rate share of requests. A repeated Idempotency-Key gets the original call
+back instead of a new one. GET on the same path lists the calls placed so far.
+"""
+import argparse
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+logger = logging.getLogger(__name__)
+
+CALLS_PATH = re.compile(r"^/2010-04-01/Accounts/([^/]+)/Calls\.json$")
+
+
+class StubCallProvider(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, fail_rate=0.0):
+        super().__init__(address, _Handler)
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.calls = []            # every call placed, in order
+        self._by_key = {}          # Idempotency-Key -> call
+        self._lock = threading.Lock()
+
+    def place(self, account_sid, form, idempotency_key):
+        """Returns (call, created)."""
+        with self._lock:
+            if idempotency_key and idempotency_key in self._by_key:
+                return self._by_key[idempotency_key], False
+            call = {
+                'sid': "CA" + uuid.uuid4().hex, 'account_sid': account_sid, 'to': form.get('To'),
+                'from': form.get('From'), 'status': 'queued', 'twiml': form.get('Twiml'),
+                'date_created': time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime()),
+            }
+            self.calls.append(call)
+            if idempotency_key:
+                self._by_key[idempotency_key] = call
+            return call, True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: StubCallProvider
+
+    def _reply(self, status, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if not CALLS_PATH.match(self.path):
+            self._reply(404, {'code': 20404, 'message': "The requested resource was not found"})
+            return
+        with self.server._lock:
+            self._reply(200, {'calls': list(self.server.calls)})
+
+    def do_POST(self):
+        match = CALLS_PATH.match(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+        if not match:
+            self._reply(404, {'code': 20404, 'message': "The requested resource was not found"})
+            return
+        if not self.headers.get("Authorization"):
+            self._reply(401, {'code': 20003, 'message': "Authenticate"})
+            return
+        if not form.get('To') or not form.get('From') or not (form.get('Twiml') or form.get('Url')):
+            self._reply(400, {'code': 21201, 'message': "To, From and Twiml or Url are required"})
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if random.random() < self.server.fail_rate:
+            self._reply(503, {'code': 20503, 'message': "Service unavailable"}, [("Retry-After", "1")])
+            return
+        call, created = self.server.place(match.group(1), form, self.headers.get("Idempotency-Key"))
+        if created:
+            logger.info(f"Call {call['sid']} to {call['to']}: {call['twiml']}")
+        self._reply(201 if created else 200, call)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Twilio Calls API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds each call request takes")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of requests answered with 503")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+    server = StubCallProvider((args.host, args.port), args.latency, args.fail_rate)
+    logger.info(f"Stub call provider on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
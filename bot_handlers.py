@@ -1,4 +1,7 @@
+import io
 import logging
+import os
+import tempfile
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     ContextTypes,
@@ -8,76 +11,90 @@ from telegram.ext import (
     filters,
     CallbackQueryHandler,
 )
-import database as db
-from datetime import datetime, time, timezone
-from config import SNOOZE_MINUTES, MAX_SNOOZES
+import db_async as adb
+import bulk_io
+from broadcast import broadcaster, format_progress
+import scheduler as reminder_scheduler
+from write_behind import status_writer
+from materializer import is_valid_timezone, DEFAULT_TIMEZONE
+from validators import parse_times_of_day, is_valid_phone
+from rx_ocr import rx_scanner, ScannerBusy, OCR_AVAILABLE
+from profiling import profiler, MODES
+import cache
+from datetime import datetime, time, timezone, timedelta
+from config import SNOOZE_MINUTES, MAX_SNOOZES, ADMIN_CHAT_ID, OCR_MAX_IMAGE_BYTES, IMPORT_SPOOL_BYTES, DB_BACKEND
 
 logger = logging.getLogger(__name__)
 
+STATS_DEFAULT_DAYS = 30
+STATS_MAX_DAYS = 365
+
 # States for ConversationHandler
-(MED_NAME, DOSAGE, TIMES_A_DAY, SPECIFIC_TIMES, CONFIRMATION, PHONE_NUMBER) = range(6)
+(MED_NAME, DOSAGE, TIMES_A_DAY, SPECIFIC_TIMES, CONFIRMATION, PHONE_NUMBER, TIMEZONE) = range(7)
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     if user:  # Ensure user object exists
         logger.info(f"User {user.id} ({user.username or 'NoUsername'}) started interaction.")
-        db.add_user(user.id)  # This should store user.id as telegram_id in your 'users' table
+        await adb.add_user(user.id)  # This should store user.id as telegram_id in your 'users' table
         reply_keyboard = [['💊 Add Medication', '📋 My Medications'], ['📞 Set/Update Call Number']]
         await update.message.reply_text(
             f"Hi {user.first_name}! I'm MediMinder Bot. How can I help you today?",
             reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True),
         )
+        tz_name = await adb.get_user_timezone(user.id)
+        if tz_name in (None, DEFAULT_TIMEZONE):
+            await update.message.reply_text(
+                f"Reminder times are read in your time zone, currently {tz_name or DEFAULT_TIMEZONE}. "
+                "Use /timezone to set yours."
+            )
     else:
         logger.error("start_command: update.effective_user is None. Cannot register user.")
 
 # --- Add Medication Conversation ---
 async def add_med_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the conversation and asks for the medication name."""
+    context.user_data.clear()
     await update.message.reply_text(
         "Let's add a new medication reminder. What's the name of the medication?",
     )
     return MED_NAME
 
+async def _ask_next_field(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Asks for the first medication detail not filled in yet (typed, or read from a scanned prescription)."""
+    if not context.user_data.get("med_name"):
+        await update.message.reply_text("What's the name of the medication?")
+        return MED_NAME
+    if not context.user_data.get("dosage"):
+        await update.message.reply_text(
+            f"Got it! What's the dosage for {context.user_data['med_name']}? (e.g., '10mg', '1 tablet', etc.)"
+        )
+        return DOSAGE
+    if not context.user_data.get("times_of_day"):
+        await update.message.reply_text(
+            "At what specific times do you need to take this medication?\n\n"
+            "Please enter all times in 24-hour format (HH:MM), separated by commas.\n"
+            "For example: '08:00, 20:00' for 8 AM and 8 PM."
+        )
+        return SPECIFIC_TIMES
+    return await _confirm_medication(update, context)
+
 async def med_name_received(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the medication name and ask for the dosage."""
-    med_name = update.message.text
-    context.user_data["med_name"] = med_name
-    
-    await update.message.reply_text(
-        f"Got it! What's the dosage for {med_name}? (e.g., '10mg', '1 tablet', etc.)"
-    )
-    return DOSAGE
+    context.user_data["med_name"] = update.message.text
+    return await _ask_next_field(update, context)
 
 async def dosage_received(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the dosage and ask for specific times."""
-    dosage = update.message.text
-    context.user_data["dosage"] = dosage
-    
-    await update.message.reply_text(
-        "At what specific times do you need to take this medication?\n\n"
-        "Please enter all times in 24-hour format (HH:MM), separated by commas.\n"
-        "For example: '08:00, 20:00' for 8 AM and 8 PM."
-    )
-    return SPECIFIC_TIMES
+    context.user_data["dosage"] = update.message.text
+    return await _ask_next_field(update, context)
 
 async def specific_times_received(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the specific times and ask for confirmation."""
     times_text = update.message.text
     
     # Basic validation of time format
-    times_list = [t.strip() for t in times_text.split(',')]
-    valid_times = []
-    invalid_times = []
-    
-    for t in times_list:
-        try:
-            h, m = map(int, t.split(':'))
-            if 0 <= h < 24 and 0 <= m < 60:
-                valid_times.append(f"{h:02d}:{m:02d}")
-            else:
-                invalid_times.append(t)
-        except (ValueError, IndexError):
-            invalid_times.append(t)
+    valid_times, invalid_times = parse_times_of_day(times_text)
     
     if invalid_times:
         await update.message.reply_text(
@@ -86,15 +103,15 @@ async def specific_times_received(update: Update, context: ContextTypes.DEFAULT_
         )
         return SPECIFIC_TIMES
     
-    times_str = ', '.join(valid_times)
-    context.user_data["times_of_day"] = times_str
-    
-    # Summary for confirmation
+    context.user_data["times_of_day"] = ', '.join(valid_times)
+    return await _confirm_medication(update, context)
+
+async def _confirm_medication(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text(
         f"Please confirm these medication details:\n\n"
         f"Medication: {context.user_data['med_name']}\n"
         f"Dosage: {context.user_data['dosage']}\n"
-        f"Times: {times_str}\n\n"
+        f"Times: {context.user_data['times_of_day']}\n\n"
         "Is this correct?",
         reply_markup=ReplyKeyboardMarkup(
             [['✅ Yes, Save!', '✏️ No, Start Over']],
@@ -115,7 +132,7 @@ async def confirmation_received(update: Update, context: ContextTypes.DEFAULT_TY
         times_of_day = context.user_data.get("times_of_day", "")
         
         # Save to database
-        med_id = db.add_medication_db(user_id, med_name, dosage, times_of_day)
+        med_id = await adb.add_medication_db(user_id, med_name, dosage, times_of_day)
         
         if med_id:
             logger.info(f"Medication {med_name} saved for user {user_id} with ID {med_id}")
@@ -139,6 +156,7 @@ async def confirmation_received(update: Update, context: ContextTypes.DEFAULT_TY
                 )
             )
     else:
+        context.user_data.clear()
         await update.message.reply_text(
             "Let's start over. What's the name of the medication?",
         )
@@ -172,7 +190,7 @@ async def text_fallback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 async def set_phone_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the conversation for setting a phone number."""
     user_id = update.effective_user.id
-    current_phone = db.get_user_phone(user_id)
+    current_phone = await adb.get_user_phone(user_id)
     
     if current_phone:
         await update.message.reply_text(
@@ -193,14 +211,14 @@ async def set_phone_received(update: Update, context: ContextTypes.DEFAULT_TYPE)
     phone_number = update.message.text.strip()
     
     # Basic validation - could be enhanced
-    if not (phone_number.startswith('+') and len(phone_number) > 8 and phone_number[1:].isdigit()):
+    if not is_valid_phone(phone_number):
         await update.message.reply_text(
             "Invalid phone number format. Please use: Country code + number (e.g., +1234567890)"
         )
         return PHONE_NUMBER
     
     user_id = update.effective_user.id
-    db.add_user(user_id, phone_number)  # This should update the phone number if user exists
+    await adb.add_user(user_id, phone_number)  # Updates the phone number if the user exists
     
     await update.message.reply_text(
         f"Thanks! Your phone number {phone_number} has been saved.\n"
@@ -214,10 +232,45 @@ async def set_phone_received(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     return ConversationHandler.END
 
+# --- Set Time Zone ---
+async def set_timezone_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Starts the conversation for setting the user's time zone."""
+    current_tz = await adb.get_user_timezone(update.effective_user.id) or DEFAULT_TIMEZONE
+    await update.message.reply_text(
+        f"Your reminders currently use the {current_tz} time zone.\n"
+        "Please enter your time zone as a region/city name (e.g., Europe/Berlin, America/New_York, Asia/Kolkata), "
+        "or /cancel to keep the current one."
+    )
+    return TIMEZONE
+
+async def set_timezone_received(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Validate and save the time zone; upcoming reminders move to the new local times."""
+    tz_name = update.message.text.strip()
+    if not is_valid_timezone(tz_name):
+        await update.message.reply_text(
+            f"I don't know the time zone '{tz_name}'. Please use a region/city name such as Europe/Berlin."
+        )
+        return TIMEZONE
+
+    user_id = update.effective_user.id
+    if not await adb.set_user_timezone(user_id, tz_name):
+        await update.message.reply_text("Sorry, there was an error saving your time zone. Please try again.")
+        return ConversationHandler.END
+
+    await update.message.reply_text(
+        f"Thanks! Your reminders will now follow {tz_name} time.",
+        reply_markup=ReplyKeyboardMarkup(
+            [['💊 Add Medication', '📋 My Medications'], ['📞 Set/Update Call Number']],
+            one_time_keyboard=True,
+            resize_keyboard=True
+        )
+    )
+    return ConversationHandler.END
+
 # --- My Medications ---
 async def my_medications_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    meds = db.get_active_medications_for_user(user_id)
+    meds = await adb.get_active_medications_for_user(user_id)
     if not meds:
         await update.message.reply_text("You don't have any active medications scheduled yet. Use 'Add Medication' to add some!")
         return
@@ -229,14 +282,246 @@ async def my_medications_command(update: Update, context: ContextTypes.DEFAULT_T
     
     await update.message.reply_text(message, parse_mode='Markdown')
 
+# --- Adherence Statistics ---
+def _stats_days(context) -> int:
+    """Report length from the command argument (/stats 90), within 1..STATS_MAX_DAYS."""
+    try:
+        days = int(context.args[0]) if context.args else STATS_DEFAULT_DAYS
+    except ValueError:
+        days = STATS_DEFAULT_DAYS
+    return max(1, min(days, STATS_MAX_DAYS))
+
+def _percent(part, whole) -> str:
+    return f"{part * 100 // whole}%" if whole else "n/a"
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Shows the user's adherence per medication over the last N days (default 30)."""
+    user_id = update.effective_user.id
+    days = _stats_days(context)
+    since = datetime.now(timezone.utc).date() - timedelta(days=days - 1)
+    rows = await adb.get_user_adherence(user_id, since)
+    if not rows:
+        await update.message.reply_text(f"No reminders have been due in the last {days} days yet.")
+        return
+
+    message = f"📊 Your adherence over the last {days} days:\n\n"
+    for row in rows:
+        name = row['med_name'] + ("" if row['is_active'] else " (inactive)")
+        message += (f"💊 {name}: {row['acknowledged']}/{row['scheduled']} taken "
+                    f"({_percent(row['acknowledged'], row['scheduled'])})")
+        details = []
+        if row['missed']:
+            details.append(f"{row['missed']} missed")
+        if row['snoozed']:
+            details.append(f"{row['snoozed']} snoozes")
+        if row['escalated']:
+            details.append(f"{row['escalated']} call alerts")
+        message += (f"\n   {', '.join(details)}\n" if details else "\n")
+    total = sum(row['scheduled'] for row in rows)
+    taken = sum(row['acknowledged'] for row in rows)
+    message += f"\nOverall: {taken}/{total} doses taken ({_percent(taken, total)})."
+    await update.message.reply_text(message)
+
+def _is_admin(update: Update, command: str) -> bool:
+    user_id = update.effective_user.id
+    if ADMIN_CHAT_ID and str(user_id) == str(ADMIN_CHAT_ID):
+        return True
+    logger.warning(f"User {user_id} tried {command} without being the admin.")
+    return False
+
+async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Service-wide adherence and load figures, only for ADMIN_CHAT_ID."""
+    if not _is_admin(update, "/adminstats"):
+        return
+
+    days = _stats_days(context)
+    since = datetime.now(timezone.utc).date() - timedelta(days=days - 1)
+    by_day = await adb.get_adherence_by_day(since)
+    users, meds = await adb.get_population_counts()
+    totals = {key: sum(row[key] for row in by_day)
+              for key in ('scheduled', 'acknowledged', 'snoozed', 'missed', 'escalated')}
+
+    message = (f"📊 Service stats, last {days} days\n\n"
+               f"Active users: {users}, active medications: {meds}\n"
+               f"Doses due: {totals['scheduled']}, taken: {totals['acknowledged']} "
+               f"({_percent(totals['acknowledged'], totals['scheduled'])})\n"
+               f"Missed: {totals['missed']}, snoozes: {totals['snoozed']}, call alerts: {totals['escalated']}\n\n"
+               "Last 7 days (due / taken):\n")
+    for row in by_day[-7:]:
+        message += f"{row['day']}: {row['scheduled']} / {row['acknowledged']} ({_percent(row['acknowledged'], row['scheduled'])})\n"
+    for name, stats in cache.stats().items():
+        message += f"\nCache {name}: {stats['size']} entries, hit ratio {stats['hit_ratio']}"
+    await update.message.reply_text(message)
+
+# --- Bulk Import/Export (admin) ---
+async def import_document_received(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """A .csv or .jsonl document captioned /import: imports its users and medications."""
+    if not _is_admin(update, "/import"):
+        return
+    if DB_BACKEND != 'sqlite':
+        await update.message.reply_text("Bulk import and export only work with the SQLite backend.")
+        return
+    document = update.message.document
+    try:
+        fmt = bulk_io.detect_format(document.file_name or "")
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return
+
+    await update.message.reply_text(f"Importing {document.file_name}...")
+    with tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_BYTES) as upload:
+        await (await document.get_file()).download_to_memory(upload)
+        upload.seek(0)
+        records = bulk_io.read_records(io.TextIOWrapper(upload, encoding="utf-8-sig", newline=""), fmt)
+        try:
+            summary = await adb.run(bulk_io.import_records, records)
+        except UnicodeDecodeError:
+            await update.message.reply_text("The file is not UTF-8 text.")
+            return
+    message = (f"✅ Import done: {summary['medications']} medications added, "
+               f"{summary['duplicates']} duplicates skipped, {summary['errors']} invalid records.")
+    for line_no, error in summary['error_lines'][:20]:
+        message += f"\nline {line_no}: {error}"
+    if summary['errors'] > 20:
+        message += f"\n... and {summary['errors'] - 20} more."
+    await update.message.reply_text(message)
+
+def _export_to_file(kind, days):
+    fd, path = tempfile.mkstemp(prefix=f"mediminder-{kind}-", suffix=".csv")
+    os.close(fd)
+    try:
+        return path, bulk_io.export_file(kind, path, days)
+    except Exception:
+        os.remove(path)
+        raise
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/export medications or /export history [days]: sends the export as a CSV document."""
+    if not _is_admin(update, "/export"):
+        return
+    if DB_BACKEND != 'sqlite':
+        await update.message.reply_text("Bulk import and export only work with the SQLite backend.")
+        return
+    kind = context.args[0].lower() if context.args else "medications"
+    if kind not in ("medications", "history"):
+        await update.message.reply_text("Usage: /export medications, or /export history [days]")
+        return
+    days = None
+    if kind == "history" and len(context.args) > 1:
+        days = int(context.args[1]) if context.args[1].isdigit() else None
+
+    path, count = await adb.run(_export_to_file, kind, days)
+    try:
+        with open(path, "rb") as f:
+            await update.message.reply_document(
+                document=f, filename=f"mediminder-{kind}-{datetime.now(timezone.utc):%Y%m%d}.csv",
+                caption=f"{count} rows")
+    finally:
+        os.remove(path)
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/broadcast <message> sends a message to every user; /broadcast status and /broadcast cancel manage it."""
+    if not _is_admin(update, "/broadcast"):
+        return
+    parts = update.message.text.split(None, 1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    if text.lower() == "status":
+        report = broadcaster.progress() if broadcaster.running else broadcaster.progress(await adb.get_broadcast())
+        await update.message.reply_text(format_progress(report) if report else "No broadcasts yet.")
+        return
+    if text.lower() == "cancel":
+        cancelled = await broadcaster.cancel()
+        await update.message.reply_text("Broadcast cancelled." if cancelled else "No broadcast is running.")
+        return
+    if not text:
+        await update.message.reply_text(
+            "Usage: /broadcast <message> to send a message to every user, "
+            "/broadcast status to see progress, /broadcast cancel to stop."
+        )
+        return
+
+    row = await broadcaster.start(context.bot, text, update.effective_user.id)
+    if row is None:
+        await update.message.reply_text("Another broadcast is still running. Check it with /broadcast status.")
+        return
+    await update.message.reply_text(
+        f"📣 Broadcast #{row['id']} started to {row['total']} users. "
+        "I'll report here when it's done; /broadcast status shows progress."
+    )
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/profile <jobs|handlers|all|name> [runs] [cprofile|sample] profiles the next runs; /profile off stops."""
+    if not _is_admin(update, "/profile"):
+        return
+    args = [arg.lower() for arg in context.args]
+    if not args or args[0] == "status":
+        await update.message.reply_text(profiler.status())
+        return
+    if args[0] == "off":
+        profiler.disarm()
+        await update.message.reply_text("Profiler is off.")
+        return
+    target, runs, mode = args[0], 1, "cprofile"
+    for arg in args[1:]:
+        if arg.isdigit():
+            runs = int(arg)
+        elif arg in MODES:
+            mode = arg
+        else:
+            await update.message.reply_text(
+                "Usage: /profile <jobs|handlers|all|function name> [runs] [cprofile|sample], "
+                "/profile status or /profile off."
+            )
+            return
+    try:
+        profiler.arm(target, runs, mode)
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return
+    await update.message.reply_text(f"{profiler.status()} I'll send the hottest functions here after each run.")
+
 # --- Scan Prescription ---
 async def scan_rx_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not OCR_AVAILABLE:
+        await update.message.reply_text("Prescription scanning isn't available on this bot. Use /addmed instead.")
+        return
     await update.message.reply_text(
         "To scan a prescription, please send a photo of it. "
-        "I'll try to extract medication information automatically.\n\n"
-        "(This feature is not fully implemented yet - for demonstration purposes only.)"
+        "I'll try to read the medication, dosage and times, and ask you for anything I can't read."
     )
 
+async def scan_rx_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """A photo of a prescription: fills in the add-medication details from it, then asks for what's missing."""
+    if not OCR_AVAILABLE:
+        await update.message.reply_text("Prescription scanning isn't available on this bot. Use /addmed instead.")
+        return ConversationHandler.END
+    image = update.message.photo[-1] if update.message.photo else update.message.document
+    if image.file_size and image.file_size > OCR_MAX_IMAGE_BYTES:
+        await update.message.reply_text("That image is too large. Please send a smaller photo.")
+        return ConversationHandler.END
+
+    await update.message.reply_text("🔎 Reading your prescription...")
+    data = bytes(await (await image.get_file()).download_as_bytearray())
+    try:
+        fields = await rx_scanner.scan(data)
+    except ScannerBusy:
+        await update.message.reply_text("I'm reading a lot of prescriptions right now. Please try again in a minute.")
+        return ConversationHandler.END
+    except Exception as e:
+        logger.error(f"Prescription scan failed for user {update.effective_user.id}: {e}", exc_info=True)
+        await update.message.reply_text("Sorry, I couldn't read that photo. Please try again or use /addmed.")
+        return ConversationHandler.END
+
+    context.user_data.clear()
+    context.user_data.update({key: value for key, value in fields.items() if value})
+    found = [f"{label}: {fields[key]}" for key, label in
+             (("med_name", "Medication"), ("dosage", "Dosage"), ("times_of_day", "Times")) if fields[key]]
+    if found:
+        await update.message.reply_text("From your prescription:\n" + "\n".join(found))
+    else:
+        await update.message.reply_text("I couldn't find medication details in that photo. Let's enter them by hand.")
+    return await _ask_next_field(update, context)
+
 # --- Handle Reminder Button Callbacks ---
 async def handle_reminder_ack(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
@@ -249,24 +534,31 @@ async def handle_reminder_ack(update: Update, context: ContextTypes.DEFAULT_TYPE
     now = datetime.now(timezone.utc)  # Use timezone-aware datetime
     
     if action == "ack":
-        db.update_reminder_log_status(log_id, 'acknowledged', now)
+        status_writer.update(log_id, 'acknowledged', now)
         await query.edit_message_text(
             text="✅ Thanks for confirming you've taken your medication!",
             reply_markup=None  # Remove buttons
         )
     elif action == "snooze":
-        # Check if max snoozes reached
-        # This would need to read the current snooze count from DB first
-        db.update_reminder_log_status(log_id, 'snoozed', None, True)  # Increment snooze count
+        snooze_count = await reminder_scheduler.snooze_reminder(log_id)
+        if snooze_count is None:
+            log_row = await status_writer.get_reminder_log(log_id)
+            if log_row and log_row['status'] in ('pending', 'queued', 'sent') and log_row['snooze_count'] >= MAX_SNOOZES:
+                # Out of snoozes: keep the Taken button so the dose can still be confirmed before escalation.
+                await query.edit_message_reply_markup(
+                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✅ Taken", callback_data=f"ack:{log_id}")]])
+                )
+                await query.message.reply_text(
+                    f"You've already snoozed this reminder {MAX_SNOOZES} times. Please take your medication now."
+                )
+            else:
+                await query.edit_message_text(text="This reminder has already been handled.", reply_markup=None)
+            return
         await query.edit_message_text(
             text=f"⏰ Reminder snoozed for {SNOOZE_MINUTES} minutes. "
                  f"I'll remind you again soon.",
             reply_markup=None  # Remove buttons
         )
-        
-        # You should now schedule a new reminder in X minutes
-        # For simplicity, this could update the scheduled_time in reminders_log
-        # and the scheduler would pick it up
 
 # Add this health check function
 async def health_check(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -0,0 +1,204 @@
+"""Admin broadcasts: one message to every user, throttled so reminders are never delayed.
+
+Recipients are read from users in primary-key pages (telegram_id > cursor), never all at once.
+Messages go through the send dispatcher at PRIORITY_BULK, paced to BROADCAST_RATE with at most
+BROADCAST_MAX_INFLIGHT queued, so reminders and escalations always go first and keep most of the
+bot-wide rate limit. Progress (the id below which every user has been handled, and the counts) is
+saved every BROADCAST_SAVE_SECONDS; after a restart the broadcast resumes from there. Instances
+sharing a database send it from one of them at a time (Storage.claim_broadcast). Users who
+blocked the bot are marked inactive, as for reminders.
+"""
+import asyncio
+import logging
+import time
+
+import db_async as adb
+from dispatcher import dispatcher, TokenBucket, PRIORITY_BULK
+from config import BROADCAST_RATE, BROADCAST_MAX_INFLIGHT, BROADCAST_PAGE_SIZE, BROADCAST_SAVE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class Broadcaster:
+    """Runs at most one broadcast at a time, in the background."""
+
+    def __init__(self, rate=BROADCAST_RATE, max_inflight=BROADCAST_MAX_INFLIGHT, page_size=BROADCAST_PAGE_SIZE,
+                 save_seconds=BROADCAST_SAVE_SECONDS):
+        self.rate = rate
+        self.max_inflight = max_inflight
+        self.page_size = page_size
+        self.save_seconds = save_seconds
+        self._bot = None
+        self._task = None
+        self._stopping = False
+        self._cancelled = False
+        self._broadcast = None
+        self._inflight = set()   # user ids handed to the dispatcher and not finished
+        self._counts = None
+        self._submitted_up_to = 0
+        self._started_at = None
+        self._handled_this_run = 0
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    async def start(self, bot, text, admin_id):
+        """Starts broadcasting `text`. Returns the broadcast row, or None if one is already running."""
+        row = await adb.create_broadcast(text, admin_id)
+        if row is not None and await adb.claim_broadcast(row['id']):
+            self._launch(bot, row)
+        return row
+
+    async def resume(self, bot):
+        """Continues a broadcast a previous run didn't finish, if any and no other instance is sending it."""
+        row = await adb.get_running_broadcast()
+        if row is not None and not self.running and await adb.claim_broadcast(row['id']):
+            logger.info(f"Resuming broadcast #{row['id']} after user {row['cursor']} "
+                        f"({row['sent'] + row['failed'] + row['blocked']}/{row['total']} done).")
+            self._launch(bot, row)
+
+    def _launch(self, bot, row):
+        self._bot = bot
+        self._broadcast = row
+        self._counts = {'sent': row['sent'], 'failed': row['failed'], 'blocked': row['blocked']}
+        self._submitted_up_to = row['cursor']
+        self._inflight.clear()
+        self._started_at = time.monotonic()
+        self._handled_this_run = 0
+        self._stopping = self._cancelled = False
+        dispatcher.start()  # Already running unless this process only serves updates (sharded mode).
+        self._task = asyncio.create_task(self._send(row))
+
+    async def cancel(self):
+        """Stops the running broadcast for good. Returns False if none is running."""
+        if not self.running:
+            return False
+        self._cancelled = True
+        await self._stop_task()
+        return True
+
+    async def stop(self):
+        """Pauses the running broadcast at shutdown; it resumes on the next start."""
+        if self.running:
+            await self._stop_task()
+
+    async def _stop_task(self):
+        self._stopping = True
+        await self._task
+
+    def progress(self, row=None):
+        """Counts, throughput of this run and ETA of the running broadcast (or of `row`)."""
+        row = row or self._broadcast
+        if row is None:
+            return None
+        live = self.running and row['id'] == self._broadcast['id']
+        counts = dict(self._counts) if live else {key: row[key] for key in ('sent', 'failed', 'blocked')}
+        done = sum(counts.values())
+        rate = eta = None
+        if live:
+            elapsed = time.monotonic() - self._started_at
+            rate = self._handled_this_run / elapsed if elapsed > 0 else 0.0
+            eta = (row['total'] - done) / rate if rate else None
+        return {'id': row['id'], 'status': 'running' if live else row['status'], 'total': row['total'],
+                'done': done, **counts, 'rate': rate, 'eta_seconds': max(eta, 0.0) if eta is not None else None}
+
+    def _cursor(self):
+        # Everything below the lowest id still in flight has been handled.
+        return min(self._inflight) - 1 if self._inflight else self._submitted_up_to
+
+    async def _save(self, status='running'):
+        await adb.save_broadcast_progress(self._broadcast['id'], self._cursor(),
+                                          self._counts['sent'], self._counts['failed'], self._counts['blocked'], status)
+
+    async def _send(self, row):
+        try:
+            await self._run(row)
+        finally:
+            await adb.release_broadcast(row['id'])
+
+    async def _run(self, row):
+        bucket = TokenBucket(self.rate, capacity=1)
+        slots = asyncio.Semaphore(self.max_inflight)
+        idle = asyncio.Event()
+        idle.set()
+        last_saved = time.monotonic()
+
+        def finished(user_id, outcome):
+            self._inflight.discard(user_id)
+            self._counts[outcome] += 1
+            self._handled_this_run += 1
+            slots.release()
+            if not self._inflight:
+                idle.set()
+
+        async def failed(user_id, outcome):
+            if outcome == 'blocked':
+                await adb.mark_user_inactive(user_id)
+            finished(user_id, 'blocked' if outcome == 'blocked' else 'failed')
+
+        try:
+            while not self._stopping:
+                page = await adb.get_broadcast_recipients(self._submitted_up_to, self.page_size)
+                if not page:
+                    break
+                for user_id in page:
+                    await slots.acquire()
+                    if self._stopping:
+                        slots.release()
+                        break
+                    await bucket.acquire()
+                    self._inflight.add(user_id)
+                    idle.clear()
+                    self._submitted_up_to = user_id
+                    dispatcher.submit(
+                        user_id,
+                        lambda user_id=user_id: self._bot.send_message(chat_id=user_id, text=row['text']),
+                        lambda _, user_id=user_id: finished(user_id, 'sent'),
+                        lambda outcome, user_id=user_id: failed(user_id, outcome),
+                        PRIORITY_BULK,
+                        label=f"broadcast #{row['id']}",
+                    )
+                    if time.monotonic() - last_saved >= self.save_seconds:
+                        if not await adb.claim_broadcast(row['id']):
+                            # This instance lost its database session, and with it the broadcast.
+                            logger.error(f"Broadcast #{row['id']} was taken over by another instance; stopping here.")
+                            return
+                        await self._save()
+                        last_saved = time.monotonic()
+            await idle.wait()
+        except Exception as e:
+            logger.error(f"Broadcast #{row['id']} stopped by an error; it resumes on the next start: {e}", exc_info=True)
+            await self._save()
+            return
+
+        if self._stopping and not self._cancelled:
+            await self._save()
+            logger.info(f"Broadcast #{row['id']} paused at user {self._cursor()}.")
+            return
+        status = 'cancelled' if self._cancelled else 'done'
+        await self._save(status)
+        self._broadcast = await adb.get_broadcast(row['id'])
+        report = self.progress(self._broadcast)
+        logger.info(f"Broadcast #{row['id']} {status}: {report['sent']} sent, {report['failed']} failed, "
+                    f"{report['blocked']} blocked.")
+        if row['created_by']:
+            try:
+                await self._bot.send_message(chat_id=row['created_by'], text=format_progress(report))
+            except Exception as e:
+                logger.warning(f"Could not report broadcast #{row['id']} to the admin: {e}")
+
+
+def format_progress(report):
+    message = (f"📣 Broadcast #{report['id']} ({report['status']}): {report['done']}/{report['total']} users\n"
+               f"Sent: {report['sent']}, failed: {report['failed']}, blocked: {report['blocked']}")
+    if report['rate'] is not None:
+        message += f"\n{report['rate']:.1f} messages/s"
+        if report['eta_seconds'] is not None:
+            minutes, seconds = divmod(int(report['eta_seconds']), 60)
+            message += f", about {minutes}m {seconds:02d}s left"
+    return message
+
+
+# Process-wide broadcaster, for the admin /broadcast command.
+broadcaster = Broadcaster()
@@ -0,0 +1,207 @@
+"""Bulk import and export of users, medications and reminder history as CSV or JSON Lines.
+
+One record per medication, with the columns
+
+    telegram_id, phone_number, timezone, med_name, dosage, times_of_day
+
+phone_number and timezone are optional and update the user; a record without med_name only
+updates the user. Files are read and written as streams, and imports are committed in chunks of
+IMPORT_CHUNK_SIZE records, so neither side holds a whole file or table in memory. Invalid records
+are reported by line and skipped; the rest of the file is still imported. An export of
+medications can be imported again as is.
+
+    python -m bulk_io import clinic.csv
+    python -m bulk_io export medications medications.csv
+    python -m bulk_io export history history.jsonl --days 90
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+import database as db
+import db_async as adb
+from materializer import is_valid_timezone
+from validators import parse_times_of_day, is_valid_phone
+from config import IMPORT_CHUNK_SIZE, DB_BACKEND
+
+logger = logging.getLogger(__name__)
+
+IMPORT_FIELDS = ("telegram_id", "phone_number", "timezone", "med_name", "dosage", "times_of_day")
+MEDICATION_EXPORT_FIELDS = IMPORT_FIELDS + ("is_active",)
+HISTORY_EXPORT_FIELDS = ("log_id", "telegram_id", "medication_id", "med_name", "scheduled_time", "status",
+                         "snooze_count", "acknowledged_at")
+MAX_REPORTED_ERRORS = 100
+
+
+def detect_format(filename):
+    """'csv' or 'jsonl' from a file name."""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".csv":
+        return "csv"
+    if ext in (".jsonl", ".ndjson", ".json"):
+        return "jsonl"
+    raise ValueError(f"Unsupported file type '{ext}'. Use .csv or .jsonl (one JSON object per line).")
+
+
+def read_records(fileobj, fmt):
+    """Yields (line number, record dict) from a text stream; unparsable lines yield (line, None)."""
+    if fmt == "csv":
+        reader = csv.DictReader(fileobj)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_no, line in enumerate(fileobj, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            record = None
+        yield line_no, record if isinstance(record, dict) else None
+
+
+def _text(record, field):
+    value = record.get(field)
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def validate_record(record):
+    """Returns (user, medication or None) tuples for db.bulk_import, or raises ValueError."""
+    if record is None:
+        raise ValueError("not a valid record")
+    try:
+        telegram_id = int(_text(record, "telegram_id") or "")
+    except ValueError:
+        raise ValueError("telegram_id must be an integer")
+    phone_number = _text(record, "phone_number")
+    if phone_number and not is_valid_phone(phone_number):
+        raise ValueError(f"invalid phone_number '{phone_number}'")
+    tz_name = _text(record, "timezone")
+    if tz_name and not is_valid_timezone(tz_name):
+        raise ValueError(f"unknown timezone '{tz_name}'")
+
+    user = (telegram_id, phone_number, tz_name)
+    med_name = _text(record, "med_name")
+    if not med_name:
+        return user, None
+    valid_times, invalid_times = parse_times_of_day(_text(record, "times_of_day"))
+    if invalid_times:
+        raise ValueError(f"invalid times_of_day {', '.join(invalid_times)}")
+    return user, (telegram_id, med_name, _text(record, "dosage") or "", ', '.join(valid_times))
+
+
+def import_records(records, chunk_size=IMPORT_CHUNK_SIZE):
+    """Validates and imports (line number, record) pairs in chunked transactions. Returns a summary dict."""
+    summary = {"records": 0, "medications": 0, "duplicates": 0, "errors": 0, "error_lines": []}
+    users, meds = {}, []
+
+    def flush():
+        added, duplicates = db.bulk_import(list(users.values()), meds)
+        summary["medications"] += added
+        summary["duplicates"] += duplicates
+        users.clear()
+        meds.clear()
+
+    for line_no, record in records:
+        summary["records"] += 1
+        try:
+            user, med = validate_record(record)
+        except ValueError as e:
+            summary["errors"] += 1
+            if len(summary["error_lines"]) < MAX_REPORTED_ERRORS:
+                summary["error_lines"].append((line_no, str(e)))
+            continue
+        telegram_id, phone_number, tz_name = user
+        previous = users.get(telegram_id)
+        if previous:  # Several records for one user: keep any phone/time zone given on any of them.
+            user = (telegram_id, phone_number or previous[1], tz_name or previous[2])
+        users[telegram_id] = user
+        if med:
+            meds.append(med)
+        if len(users) + len(meds) >= chunk_size:
+            flush()
+    if users or meds:
+        flush()
+    logger.info(f"Bulk import: {summary['records']} records, {summary['medications']} medications added, "
+                f"{summary['duplicates']} duplicates skipped, {summary['errors']} invalid.")
+    return summary
+
+
+def import_file(path, chunk_size=IMPORT_CHUNK_SIZE):
+    # utf-8-sig: spreadsheet exports often start with a byte order mark.
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        return import_records(read_records(f, detect_format(path)), chunk_size)
+
+
+def write_records(fileobj, fmt, fields, rows):
+    """Streams rows (mappings) to a text stream as CSV with a header, or as JSON Lines. Returns the row count."""
+    count = 0
+    if fmt == "csv":
+        writer = csv.writer(fileobj)
+        writer.writerow(fields)
+        for row in rows:
+            writer.writerow([row[field] for field in fields])
+            count += 1
+        return count
+    for row in rows:
+        fileobj.write(json.dumps({field: row[field] for field in fields}, ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+
+def export_medications(fileobj, fmt, include_inactive=False):
+    return write_records(fileobj, fmt, MEDICATION_EXPORT_FIELDS, db.iter_medications(include_inactive))
+
+
+def export_history(fileobj, fmt, since=None):
+    return write_records(fileobj, fmt, HISTORY_EXPORT_FIELDS, db.iter_reminder_history(since))
+
+
+def export_file(kind, path, days=None, include_inactive=False):
+    """Writes an export of `kind` ('medications' or 'history') to `path`. Returns the row count."""
+    fmt = detect_format(path)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        if kind == "medications":
+            return export_medications(f, fmt, include_inactive)
+        since = datetime.now(timezone.utc) - timedelta(days=days) if days else None
+        return export_history(f, fmt, since)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import/export of MediMinder users and medications.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="Import users and medications from a .csv or .jsonl file")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE)
+    export_parser = commands.add_parser("export", help="Export medications or reminder history")
+    export_parser.add_argument("kind", choices=("medications", "history"))
+    export_parser.add_argument("path", help="Output file; .csv or .jsonl")
+    export_parser.add_argument("--days", type=int, help="History: only the last N days")
+    export_parser.add_argument("--include-inactive", action="store_true", help="Medications: inactive ones too")
+    args = parser.parse_args()
+    if DB_BACKEND != "sqlite":
+        parser.error("Bulk import/export only works with the SQLite backend (DB_BACKEND=sqlite).")
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+
+    asyncio.run(adb.storage.start())
+    if args.command == "import":
+        summary = import_file(args.path, args.chunk_size)
+        for line_no, error in summary["error_lines"]:
+            print(f"line {line_no}: {error}")
+        print(f"{summary['medications']} medications added, {summary['duplicates']} duplicates skipped, "
+              f"{summary['errors']} invalid records.")
+    else:
+        count = export_file(args.kind, args.path, args.days, args.include_inactive)
+        print(f"Exported {count} rows to {args.path}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""In-process read-through caches for small, rarely changing rows (user profiles, active medications).
+
+Entries are filled by db_async on a miss and dropped by database.py right after a write commits,
+so a process always sees its own changes; the TTL bounds how long a change made by another
+process (e.g. a shard worker marking a user inactive) can go unnoticed.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from config import CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+_caches = []
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire `ttl` seconds after they were stored.
+
+    Read on the event loop and invalidated from DB threads, so access is guarded by a lock.
+    None is a valid cached value (e.g. an unknown user); misses are reported as MISSING.
+    """
+
+    def __init__(self, name, maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self._lock = threading.Lock()
+        # Bumped by every invalidation; a value loaded across one may be stale and is not stored.
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        _caches.append(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                hit = True
+            else:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                hit = False
+        metrics.cache_requests_total.inc(cache=self.name, result='hit' if hit else 'miss')
+        return entry[1] if hit else MISSING
+
+    def set(self, key, value, generation=None):
+        """Stores `value`, unless an invalidation happened since `generation` was read."""
+        evicted = 0
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                evicted += 1
+            self.evictions += evicted
+        if evicted:
+            metrics.cache_evictions_total.inc(evicted, cache=self.name)
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'size': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_ratio': round(self.hits / requests, 3) if requests else None,
+            }
+
+
+# Keyed by telegram_id: the users row (telegram_id, phone_number, timezone) or None.
+user_profiles = TTLCache("user_profiles")
+# Keyed by telegram_id: the user's active medication rows.
+active_medications = TTLCache("active_medications")
+
+
+def stats():
+    """Hit/miss statistics of every cache, by name."""
+    return {cache.name: cache.stats() for cache in _caches}
+
+
+metrics.Gauge("mediminder_cache_entries", "Entries held by the in-process caches.",
+              lambda: sum(len(cache) for cache in _caches))
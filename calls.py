@@ -0,0 +1,266 @@
+"""Phone-call escalation: places the calls queued in the outbox through a Twilio-compatible REST API.
+
+An escalated reminder of a user with a phone number gets a 'call' outbox row (dedup key
+call:<log_id>) in the same transaction as its status change. CallRelay claims those rows
+separately from the Telegram relay and places them on its own tasks, so a burst of escalations
+never holds up message sending. Requests share one pooled HTTP client; at most
+CALL_MAX_CONCURRENCY calls are in flight, and failed attempts are retried with exponential
+backoff. Every request for a reminder carries the same Idempotency-Key, call-<log_id>.
+
+A call whose outcome is unknown (a timeout after the request went out, or a restart while it was
+in flight) is only retried when CALL_PROVIDER_IDEMPOTENT says the provider de-duplicates on that
+key; otherwise it is given up on, so a reminder is called about at most once.
+"""
+import asyncio
+import json
+import logging
+import random
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape
+
+import httpx
+
+import db_async as adb
+import metrics
+from config import (
+    TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, TWILIO_PHONE_NUMBER, CALLS_ENABLED, CALL_PROVIDER_URL,
+    CALL_PROVIDER_IDEMPOTENT, CALL_MAX_CONCURRENCY, CALL_MAX_ATTEMPTS, CALL_RETRY_BASE_SECONDS,
+    CALL_TIMEOUT_SECONDS, OUTBOX_POLL_SECONDS, OUTBOX_RECOVERY_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+CALL_KINDS = ('call',)
+
+
+def call_payload(phone_number, message):
+    """The outbox payload of a call: who to call and what to say."""
+    return {'to': phone_number, 'message': message}
+
+
+class CallError(Exception):
+    """A failed call attempt. `retryable` says whether trying again can help (and is safe)."""
+
+    def __init__(self, message, retryable, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class CallProvider(ABC):
+    """Places outbound phone calls."""
+
+    idempotent = False  # True if repeating a request with the same idempotency key never calls twice
+
+    @abstractmethod
+    async def place_call(self, to, message, idempotency_key):
+        """Starts a call that reads out `message`. Returns the provider's call id, or raises CallError."""
+
+    async def aclose(self):
+        pass
+
+
+class TwilioCallProvider(CallProvider):
+    """The Twilio Calls API over a pooled httpx client; also spoken by benchmarks/stub_call_provider.py."""
+
+    def __init__(self, account_sid=TWILIO_ACCOUNT_SID, auth_token=TWILIO_AUTH_TOKEN, from_number=TWILIO_PHONE_NUMBER,
+                 base_url=CALL_PROVIDER_URL, max_connections=CALL_MAX_CONCURRENCY, timeout=CALL_TIMEOUT_SECONDS,
+                 idempotent=CALL_PROVIDER_IDEMPOTENT):
+        self.from_number = from_number
+        self.idempotent = idempotent
+        self._path = f"/2010-04-01/Accounts/{account_sid}/Calls.json"
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            auth=(account_sid, auth_token),
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    async def place_call(self, to, message, idempotency_key):
+        twiml = f"<Response><Say>{escape(message)}</Say></Response>"
+        try:
+            response = await self._client.post(
+                self._path,
+                data={'To': to, 'From': self.from_number, 'Twiml': twiml},
+                headers={'Idempotency-Key': idempotency_key},
+            )
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+            # The request never reached the provider.
+            raise CallError(f"{type(e).__name__}: {e}", retryable=True)
+        except httpx.HTTPError as e:
+            raise CallError(f"{type(e).__name__}: {e}", retryable=self.idempotent)
+
+        if response.status_code == 429 or response.status_code >= 500:
+            retry_after = response.headers.get('Retry-After')
+            raise CallError(f"HTTP {response.status_code}", retryable=response.status_code == 429 or self.idempotent,
+                            retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None)
+        if response.status_code >= 400:
+            try:
+                detail = response.json().get('message', response.text)
+            except ValueError:
+                detail = response.text
+            raise CallError(f"HTTP {response.status_code}: {detail}", retryable=False)
+        return response.json().get('sid')
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+class CallRelay:
+    """Claims 'call' outbox rows and places them with bounded concurrency and retries.
+
+    Mirrors OutboxRelay: woken when escalations are queued, polls for anything it wasn't woken
+    for, and records outcomes (and call_triggered_at) in batches.
+    """
+
+    def __init__(self, max_concurrency=CALL_MAX_CONCURRENCY, max_attempts=CALL_MAX_ATTEMPTS,
+                 retry_base_seconds=CALL_RETRY_BASE_SECONDS, poll_seconds=OUTBOX_POLL_SECONDS):
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.poll_seconds = poll_seconds
+        self.shards = None
+        self.provider = None
+        self._calls = set()   # tasks placing a claimed call, including ones waiting to retry
+        self._completed = []  # (outbox_id, log_id, status, attempts, error, placed_at) waiting to be written
+        self._wakeup = None
+        self._task = None
+        self._stopping = False
+        self._recovered_at = 0.0
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    async def start(self, provider=None, shards=None):
+        """Starts placing calls with `provider` (TwilioCallProvider by default). Does nothing if calls are disabled."""
+        if self._task is not None:
+            return
+        if provider is None:
+            if not CALLS_ENABLED:
+                logger.info("Call escalation disabled: TWILIO_ACCOUNT_SID/TWILIO_AUTH_TOKEN/TWILIO_PHONE_NUMBER not set.")
+                return
+            provider = TwilioCallProvider()
+        self.provider = provider
+        self.shards = shards
+        await self._recover()
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Call relay started (at most {self.max_concurrency} calls at once).")
+
+    async def _recover(self, shards=None):
+        """Deals with calls a stopped run (or, with a shared database, a stopped instance) left in flight."""
+        if shards is None:
+            self._recovered_at = time.monotonic()
+            shards = self.shards
+        if self.provider.idempotent:
+            recovered = await adb.recover_outbox(shards, CALL_KINDS)
+            if recovered:
+                logger.warning(f"Call recovery: retrying {recovered} calls left in flight by a stopped run.")
+                self.wake()
+        else:
+            abandoned = await adb.fail_interrupted_calls(shards)
+            if abandoned:
+                logger.warning(f"Call recovery: {abandoned} calls were in flight when a run stopped; "
+                               "not retrying them, as they may already have been placed.")
+
+    async def take_over(self, shards):
+        """Deals with the calls a stopped worker left in flight on shards this relay has just taken over."""
+        if self.running:
+            await self._recover(shards)
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def stop(self):
+        """Stops claiming calls, waits for the ones being placed, records their outcomes and closes the client."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        if self._calls:
+            await asyncio.gather(*self._calls, return_exceptions=True)
+        await self.flush()
+        await self.provider.aclose()
+
+    async def flush(self):
+        if not self._completed:
+            return
+        completed, self._completed = self._completed, []
+        try:
+            await adb.complete_calls(completed)
+        except Exception as e:
+            logger.error(f"DB Error recording {len(completed)} call outcomes, will retry: {e}")
+            self._completed = completed + self._completed
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                capacity = self.max_concurrency - len(self._calls)
+                if capacity > 0:
+                    for row in await adb.claim_outbox_batch(capacity, self.shards, CALL_KINDS):
+                        task = asyncio.create_task(self._place(row))
+                        self._calls.add(task)
+                        task.add_done_callback(self._call_done)
+                await self.flush()
+                if adb.storage.shared and time.monotonic() - self._recovered_at >= OUTBOX_RECOVERY_SECONDS:
+                    await self._recover()
+            except Exception as e:
+                logger.error(f"Call relay error: {e}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def _call_done(self, task):
+        self._calls.discard(task)
+        if not self._stopping:
+            self.wake()  # A slot freed up.
+
+    async def _place(self, row):
+        payload = json.loads(row['payload'])
+        log_id = row['log_id']
+        attempt = 0
+        while True:
+            attempt += 1
+            started = time.perf_counter()
+            try:
+                call_id = await self.provider.place_call(payload['to'], payload['message'], f"call-{log_id}")
+            except CallError as e:
+                error = e
+            except Exception as e:
+                logger.error(f"[CALL] Unexpected error placing call for log_id={log_id}: {e}", exc_info=True)
+                error = CallError(str(e), retryable=False)
+            else:
+                metrics.call_latency_seconds.observe(time.perf_counter() - started)
+                metrics.calls_total.inc(outcome='placed')
+                logger.info("[CALL_PLACED] log_id=%s to user %s, call %s.", log_id, row['chat_id'], call_id,
+                            extra={"log_id": log_id, "user_id": row['chat_id']})
+                self._completed.append((row['id'], log_id, 'sent', attempt, None, datetime.now(timezone.utc)))
+                return
+
+            if error.retryable and attempt < self.max_attempts and not self._stopping:
+                metrics.calls_total.inc(outcome='retry')
+                delay = error.retry_after or self.retry_base_seconds * 2 ** attempt * random.uniform(0.5, 1.0)
+                logger.warning("[CALL] Attempt %d for log_id=%s failed (%s); retrying in %.1fs.",
+                               attempt, log_id, error, delay, extra={"log_id": log_id, "sample": True})
+                await asyncio.sleep(delay)
+                continue
+            metrics.calls_total.inc(outcome='failed')
+            logger.error("[CALL_FAIL_FINAL] log_id=%s to user %s after %d attempts: %s", log_id, row['chat_id'],
+                         attempt, error, extra={"log_id": log_id, "user_id": row['chat_id']})
+            self._completed.append((row['id'], log_id, 'failed', attempt, str(error), None))
+            return
+
+
+# Process-wide relay, started with the reminder engine.
+call_relay = CallRelay()
+metrics.Gauge("mediminder_calls_inflight", "Calls being placed (or waiting to retry) by this process.",
+              lambda: len(call_relay._calls))
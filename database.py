@@ -1,15 +1,257 @@
 import sqlite3
+import json
 import logging
-from datetime import datetime
-from config import DB_NAME
+import math
+import threading
+import time
+from datetime import datetime, timezone, timedelta
+from config import (
+    DB_NAME, DB_BUSY_TIMEOUT_MS, DB_STATEMENT_CACHE_SIZE, SCHEDULER_MODE, CALL_ESCALATION_DELAY_MINUTES,
+    MATERIALIZE_HORIZON_DAYS,
+)
+from materializer import occurrences
+from cache import user_profiles, active_medications
 
 logger = logging.getLogger(__name__)
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_NAME)
+# One long-lived connection per thread. The async layer (db_async) runs these functions on a small
+# pool of DB threads, so in practice this is a connection pool of DB_POOL_SIZE connections.
+_local = threading.local()
+_all_connections = []
+_all_connections_lock = threading.Lock()
+
+def open_connection():
+    """Opens a new tuned connection. Most code should use get_db_connection() instead."""
+    conn = sqlite3.connect(
+        DB_NAME,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=DB_STATEMENT_CACHE_SIZE,
+        check_same_thread=False,  # Only used by its owning thread; closed from the main thread at shutdown
+    )
     conn.row_factory = sqlite3.Row # Access columns by name
+    # Only takes effect while the file is still empty; existing databases are converted by `python -m retention vacuum`.
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}")
     return conn
 
+def get_db_connection():
+    """Returns this thread's long-lived connection. Do not close it; use close_db_connections() at shutdown."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = open_connection()
+        with _all_connections_lock:
+            _all_connections.append(conn)
+    return conn
+
+def close_db_connections():
+    with _all_connections_lock:
+        for conn in _all_connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logger.error(f"DB Error closing connection: {e}")
+        _all_connections.clear()
+    _local.__dict__.clear()
+
+def to_db_timestamp(dt):
+    """Canonical UTC text form for scheduled_time, so equality and range lookups can use the indexes."""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc)
+    return dt.strftime('%Y-%m-%d %H:%M:%S')
+
+def from_db_timestamp(value):
+    """Parses a canonical UTC timestamp column back into an aware datetime."""
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+
+# Schema migrations, applied in order. PRAGMA user_version records how many have run.
+# Append new steps to the end; never edit a step that has shipped.
+MIGRATIONS = [
+    # 1: canonical scheduled_time, one log row per (medication, slot) and indexes for the scheduler queries
+    [
+        "UPDATE reminders_log SET scheduled_time = STRFTIME('%Y-%m-%d %H:%M:%S', scheduled_time) "
+        "WHERE scheduled_time != STRFTIME('%Y-%m-%d %H:%M:%S', scheduled_time)",
+        "DELETE FROM reminders_log WHERE id NOT IN "
+        "(SELECT MAX(id) FROM reminders_log GROUP BY medication_id, scheduled_time)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_reminders_log_med_slot ON reminders_log (medication_id, scheduled_time)",
+        "CREATE INDEX IF NOT EXISTS idx_reminders_log_status_time ON reminders_log (status, scheduled_time)",
+        "CREATE INDEX IF NOT EXISTS idx_reminders_log_user ON reminders_log (user_telegram_id)",
+        "CREATE INDEX IF NOT EXISTS idx_medications_user_active ON medications (user_telegram_id, is_active)",
+    ],
+    # 2: shard leases, worker heartbeats and the change feed sharded scheduler workers poll
+    [
+        """CREATE TABLE IF NOT EXISTS scheduler_leases (
+            shard_id INTEGER PRIMARY KEY,
+            owner TEXT,
+            expires_at REAL NOT NULL DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS scheduler_workers (
+            owner TEXT PRIMARY KEY,
+            heartbeat_at REAL NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS schedule_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL, -- med_added, user_inactive
+            medication_id INTEGER,
+            user_telegram_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+    ],
+    # 3: transactional outbox for outbound messages, and small key/value state for the scheduler
+    [
+        """CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL, -- reminder, escalation
+            dedup_key TEXT NOT NULL UNIQUE, -- e.g. reminder:<log_id>; enqueueing the same message twice is a no-op
+            chat_id INTEGER NOT NULL,
+            log_id INTEGER,
+            payload TEXT NOT NULL, -- JSON: text, parse_mode, buttons
+            status TEXT NOT NULL DEFAULT 'pending', -- pending, inflight, sent, failed
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP,
+            last_error TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_status_next ON outbox (status, next_attempt_at)",
+        """CREATE TABLE IF NOT EXISTS scheduler_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )""",
+    ],
+    # 4: escalation deadline stored per reminder, indexed only while the reminder awaits an answer
+    [
+        # Rows already 'sent' are given a deadline by backfill_escalation_deadlines(), with the configured
+        # delay; a migration must not depend on the environment it runs in.
+        "ALTER TABLE reminders_log ADD COLUMN escalate_at TIMESTAMP",
+        "CREATE INDEX IF NOT EXISTS idx_reminders_log_escalate_at ON reminders_log (escalate_at) WHERE status = 'sent'",
+    ],
+    # 5: per-user IANA time zone; reminder occurrences are materialised ahead as 'pending' log rows
+    [
+        "ALTER TABLE users ADD COLUMN timezone TEXT NOT NULL DEFAULT 'UTC'",
+    ],
+    # 6: daily adherence rollups, per user and medication and overall, kept up to date by a trigger on
+    # reminders_log status changes. scheduled counts doses that fell due (left 'pending'), snoozed and
+    # escalated count events, acknowledged and missed count doses currently in that state.
+    [
+        """CREATE TABLE IF NOT EXISTS adherence_daily (
+            user_telegram_id INTEGER NOT NULL,
+            day TEXT NOT NULL, -- UTC date of scheduled_time
+            medication_id INTEGER NOT NULL,
+            scheduled INTEGER NOT NULL DEFAULT 0,
+            acknowledged INTEGER NOT NULL DEFAULT 0,
+            snoozed INTEGER NOT NULL DEFAULT 0,
+            missed INTEGER NOT NULL DEFAULT 0,
+            escalated INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_telegram_id, day, medication_id)
+        ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS adherence_daily_total (
+            day TEXT PRIMARY KEY,
+            scheduled INTEGER NOT NULL DEFAULT 0,
+            acknowledged INTEGER NOT NULL DEFAULT 0,
+            snoozed INTEGER NOT NULL DEFAULT 0,
+            missed INTEGER NOT NULL DEFAULT 0,
+            escalated INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID""",
+        # queued -> sent, the bulk of hot-path updates, changes no counter and skips the trigger body.
+        """CREATE TRIGGER IF NOT EXISTS trg_reminders_log_adherence
+           AFTER UPDATE OF status ON reminders_log
+           WHEN OLD.status IS NOT NEW.status
+             AND (OLD.status IN ('pending', 'acknowledged', 'missed')
+                  OR NEW.status IN ('acknowledged', 'snoozed', 'missed', 'call_triggered'))
+           BEGIN
+             INSERT INTO adherence_daily
+               (user_telegram_id, day, medication_id, scheduled, acknowledged, snoozed, missed, escalated)
+             VALUES (NEW.user_telegram_id, DATE(NEW.scheduled_time), NEW.medication_id,
+            (OLD.status = 'pending'),
+            (NEW.status = 'acknowledged') - (OLD.status = 'acknowledged'),
+            (NEW.status = 'snoozed'),
+            (NEW.status = 'missed') - (OLD.status = 'missed'),
+            (NEW.status = 'call_triggered'))
+             ON CONFLICT (user_telegram_id, day, medication_id) DO UPDATE SET
+               scheduled = scheduled + excluded.scheduled,
+               acknowledged = acknowledged + excluded.acknowledged,
+               snoozed = snoozed + excluded.snoozed,
+               missed = missed + excluded.missed,
+               escalated = escalated + excluded.escalated;
+             INSERT INTO adherence_daily_total (day, scheduled, acknowledged, snoozed, missed, escalated)
+             VALUES (DATE(NEW.scheduled_time),
+            (OLD.status = 'pending'),
+            (NEW.status = 'acknowledged') - (OLD.status = 'acknowledged'),
+            (NEW.status = 'snoozed'),
+            (NEW.status = 'missed') - (OLD.status = 'missed'),
+            (NEW.status = 'call_triggered'))
+             ON CONFLICT (day) DO UPDATE SET
+               scheduled = scheduled + excluded.scheduled,
+               acknowledged = acknowledged + excluded.acknowledged,
+               snoozed = snoozed + excluded.snoozed,
+               missed = missed + excluded.missed,
+               escalated = escalated + excluded.escalated;
+           END""",
+        # Backfill from history. Past snoozes and escalations followed by an answer can't be recovered.
+        """INSERT INTO adherence_daily
+             (user_telegram_id, day, medication_id, scheduled, acknowledged, snoozed, missed, escalated)
+           SELECT user_telegram_id, DATE(scheduled_time), medication_id, COUNT(*),
+                  SUM(status = 'acknowledged'), SUM(status = 'snoozed'), SUM(status = 'missed'),
+                  SUM(status = 'call_triggered')
+           FROM reminders_log WHERE status NOT IN ('pending', 'queued')
+           GROUP BY user_telegram_id, DATE(scheduled_time), medication_id""",
+        """INSERT INTO adherence_daily_total (day, scheduled, acknowledged, snoozed, missed, escalated)
+           SELECT day, SUM(scheduled), SUM(acknowledged), SUM(snoozed), SUM(missed), SUM(escalated)
+           FROM adherence_daily GROUP BY day""",
+    ],
+    # 7: bot persistence: user/chat/bot data and the states of conversations in progress
+    [
+        """CREATE TABLE IF NOT EXISTS persistence_data (
+            kind TEXT NOT NULL, -- user, chat, bot
+            key INTEGER NOT NULL, -- user or chat id; 0 for bot data
+            data TEXT NOT NULL, -- JSON
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS conversation_states (
+            name TEXT NOT NULL, -- ConversationHandler name
+            key TEXT NOT NULL, -- JSON list, e.g. [chat_id, user_id]
+            state TEXT NOT NULL, -- JSON
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID""",
+    ],
+    # 8: admin broadcasts and how far each got through the users table
+    [
+        """CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running', -- running, done, cancelled
+            created_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP,
+            total INTEGER NOT NULL DEFAULT 0,
+            cursor INTEGER NOT NULL DEFAULT 0, -- every user with telegram_id <= cursor has been handled
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0
+        )""",
+    ],
+]
+
+def run_migrations(conn):
+    """Applies every migration newer than the database's user_version, each in its own transaction."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+            conn.execute("BEGIN")
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+            logger.info(f"Database migrated to schema version {target}.")
+        except sqlite3.Error as e:
+            conn.rollback()
+            logger.error(f"DB Error applying migration {target}: {e}")
+            raise
+
 def init_db():
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -42,7 +284,7 @@ def init_db():
             medication_id INTEGER NOT NULL,
             user_telegram_id INTEGER NOT NULL,
             scheduled_time TIMESTAMP NOT NULL,
-            status TEXT DEFAULT 'pending', -- pending, sent, acknowledged, snoozed, missed, call_triggered
+            status TEXT DEFAULT 'pending', -- pending, queued, sent, acknowledged, snoozed, missed, call_triggered
             snooze_count INTEGER DEFAULT 0,
             acknowledged_at TIMESTAMP,
             call_triggered_at TIMESTAMP,
@@ -51,32 +293,86 @@ def init_db():
         )
     ''')
     conn.commit()
-    conn.close()
+    run_migrations(conn)
+    backfill_escalation_deadlines(conn)
     logger.info("Database initialized.")
 
+def backfill_escalation_deadlines(conn):
+    """Sets the escalation deadline of reminders awaiting an answer that have none (sent before migration 4)."""
+    updated = conn.execute(
+        "UPDATE reminders_log SET escalate_at = DATETIME(scheduled_time, ?) WHERE status = 'sent' AND escalate_at IS NULL",
+        (f"+{CALL_ESCALATION_DELAY_MINUTES} minutes",)
+    ).rowcount
+    conn.commit()
+    if updated:
+        logger.info(f"Escalation deadlines set for {updated} reminders sent before they were stored.")
+
 # --- User Functions ---
 def add_user(telegram_id, phone_number=None):
+    """Adds the user, or updates an existing user's phone number if one is given."""
     conn = get_db_connection()
     try:
         conn.execute(
-            "INSERT OR IGNORE INTO users (telegram_id, phone_number) VALUES (?, ?)",
+            "INSERT INTO users (telegram_id, phone_number) VALUES (?, ?) "
+            "ON CONFLICT (telegram_id) DO UPDATE SET phone_number = COALESCE(excluded.phone_number, users.phone_number)",
             (telegram_id, phone_number)
         )
         conn.commit()
-        logger.info(f"User {telegram_id} added or already exists.")
+        user_profiles.invalidate(telegram_id)
+        logger.info(f"User {telegram_id} added or updated.")
         return True
     except sqlite3.Error as e:
+        conn.rollback()
         logger.error(f"DB Error adding user {telegram_id}: {e}")
         return False
-    finally:
-        conn.close()
 
 def get_user_phone(telegram_id):
     conn = get_db_connection()
     user = conn.execute("SELECT phone_number FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
-    conn.close()
     return user['phone_number'] if user and user['phone_number'] else None
 
+def get_user_profile(telegram_id):
+    """The user's row (telegram_id, phone_number, timezone), or None. Cached by db_async."""
+    conn = get_db_connection()
+    return conn.execute(
+        "SELECT telegram_id, phone_number, timezone FROM users WHERE telegram_id = ?", (telegram_id,)
+    ).fetchone()
+
+def get_user_profiles(telegram_ids):
+    """{telegram_id: row} for the given users that exist, in one query per 500 ids."""
+    conn = get_db_connection()
+    telegram_ids = list(telegram_ids)
+    profiles = {}
+    for start in range(0, len(telegram_ids), 500):
+        chunk = telegram_ids[start:start + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        for row in conn.execute(
+            f"SELECT telegram_id, phone_number, timezone FROM users WHERE telegram_id IN ({placeholders})", chunk
+        ):
+            profiles[row['telegram_id']] = row
+    return profiles
+
+def set_user_timezone(telegram_id, tz_name):
+    """Stores the user's IANA time zone and re-materialises their upcoming reminders in it."""
+    conn = get_db_connection()
+    try:
+        conn.execute(
+            "INSERT INTO users (telegram_id, timezone) VALUES (?, ?) "
+            "ON CONFLICT (telegram_id) DO UPDATE SET timezone = excluded.timezone",
+            (telegram_id, tz_name)
+        )
+        earliest = _rematerialize(conn, "m.user_telegram_id = ?", (telegram_id,))
+        _record_schedule_event(conn, 'user_rescheduled', telegram_id)
+        conn.commit()
+        user_profiles.invalidate(telegram_id)
+        logger.info(f"User {telegram_id} time zone set to {tz_name}.")
+        _notify_materialized(earliest)
+        return True
+    except sqlite3.Error as e:
+        conn.rollback()
+        logger.error(f"DB Error setting time zone for user {telegram_id}: {e}")
+        return False
+
 # --- Medication Functions ---
 def add_medication_db(user_telegram_id, med_name, dosage, times_of_day):
     conn = get_db_connection()
@@ -85,15 +381,20 @@ def add_medication_db(user_telegram_id, med_name, dosage, times_of_day):
             "INSERT INTO medications (user_telegram_id, med_name, dosage, times_of_day) VALUES (?, ?, ?, ?)",
             (user_telegram_id, med_name, dosage, times_of_day)
         )
-        conn.commit()
         med_id = cursor.lastrowid
+        # Read the horizon inside the write transaction, so a concurrent extend_reminder_horizon
+        # either already includes this medication or materialises from where this leaves off.
+        _, earliest = _materialize(conn, datetime.now(timezone.utc), _materialized_until(conn), "m.id = ?", (med_id,))
+        _record_schedule_event(conn, 'med_added', user_telegram_id, med_id)
+        conn.commit()
+        active_medications.invalidate(user_telegram_id)
         logger.info(f"Medication {med_name} (ID: {med_id}) added for user {user_telegram_id}.")
+        _notify_materialized(earliest)
         return med_id
     except sqlite3.Error as e:
+        conn.rollback()
         logger.error(f"DB Error adding medication for user {user_telegram_id}: {e}")
         return None
-    finally:
-        conn.close()
 
 def get_active_medications_for_user(user_telegram_id):
     conn = get_db_connection()
@@ -101,28 +402,202 @@ def get_active_medications_for_user(user_telegram_id):
         "SELECT id, med_name, dosage, times_of_day FROM medications WHERE user_telegram_id = ? AND is_active = TRUE",
         (user_telegram_id,)
     ).fetchall()
-    conn.close()
     return meds
 
-def get_due_reminders(): # To be called by scheduler
+def get_medication(med_id):
+    conn = get_db_connection()
+    return conn.execute(
+        "SELECT id, user_telegram_id, med_name, dosage, times_of_day, is_active FROM medications WHERE id = ?",
+        (med_id,)
+    ).fetchone()
+
+def get_due_reminders(due_by, shards=None):
+    """Materialised reminders still 'pending' whose scheduled_time is at or before `due_by`, oldest first.
+
+    A range scan on idx_reminders_log_status_time; only the rows that are due are visited.
+    """
+    conn = get_db_connection()
+    shard_sql, shard_params = _shard_filter_sql(shards, "rl.user_telegram_id")
+    return conn.execute(
+        f"""SELECT rl.id as log_id, rl.medication_id, m.med_name, m.dosage, rl.user_telegram_id, rl.scheduled_time,
+                  rl.snooze_count
+           FROM reminders_log rl
+           JOIN medications m ON rl.medication_id = m.id
+           WHERE rl.status = 'pending' AND rl.scheduled_time <= ?{shard_sql}
+           ORDER BY rl.scheduled_time
+        """, (to_db_timestamp(due_by), *shard_params)
+    ).fetchall()
+
+def get_next_due_time(shards=None):
+    """The earliest scheduled_time of any 'pending' reminder, or None if nothing is materialised."""
+    conn = get_db_connection()
+    shard_sql, shard_params = _shard_filter_sql(shards, "user_telegram_id")
+    row = conn.execute(
+        f"SELECT MIN(scheduled_time) FROM reminders_log WHERE status = 'pending'{shard_sql}", shard_params
+    ).fetchone()
+    return from_db_timestamp(row[0]) if row[0] else None
+
+def queue_reminders(reminders, build_payload):
+    """Moves due reminders from 'pending' to 'queued' and adds their messages to the outbox, in one transaction.
+
+    `reminders` are get_due_reminders() rows; build_payload(log_id, reminder) returns the JSON-able
+    message. Messages are due at their scheduled_time, so the oldest go first and delivery delay is
+    measured from it. Returns the number of messages queued.
+    """
+    conn = get_db_connection()
+    queued = 0
+    try:
+        for reminder in reminders:
+            cursor = conn.execute(
+                "UPDATE reminders_log SET status = 'queued' WHERE id = ? AND status = 'pending'", (reminder['log_id'],)
+            )
+            if not cursor.rowcount:
+                continue  # Handled elsewhere since it was read (e.g. the user was marked inactive).
+            conn.execute(
+                """INSERT OR IGNORE INTO outbox (kind, dedup_key, chat_id, log_id, payload, next_attempt_at)
+                   VALUES ('reminder', ?, ?, ?, ?, ?)""",
+                (f"reminder:{reminder['log_id']}", reminder['user_telegram_id'], reminder['log_id'],
+                 json.dumps(build_payload(reminder['log_id'], reminder)), reminder['scheduled_time'])
+            )
+            queued += 1
+        conn.commit()
+        return queued
+    except Exception:
+        conn.rollback()
+        raise
+
+def claim_due_reminders(due_by, build_payload, shards=None):
+    """Queues every reminder due by `due_by` (see queue_reminders). Returns the number queued.
+
+    A SQLite database is only sent from by one process per shard, so reading then queueing is enough.
+    """
+    return queue_reminders(get_due_reminders(due_by, shards), build_payload)
+
+def mark_reminders_missed(log_ids):
+    """Records 'pending' reminders that will not be sent (e.g. skipped by catch-up) as 'missed'."""
     conn = get_db_connection()
-    # This query needs refinement. It should find medications whose scheduled times are due
-    # and for which a reminder hasn't been sent or needs to be re-sent (snooze).
-    # For simplicity, we'll focus on creating reminder log entries when a med is added.
-    # The scheduler will then pick up 'pending' reminders from reminders_log.
-    now_utc = datetime.utcnow()
-    # Get pending reminders that are due
-    reminders = conn.execute(
-        """SELECT rl.id as log_id, rl.medication_id, m.med_name, m.dosage, rl.user_telegram_id, rl.scheduled_time, u.phone_number
+    try:
+        conn.executemany(
+            "UPDATE reminders_log SET status = 'missed' WHERE id = ? AND status = 'pending'",
+            [(log_id,) for log_id in log_ids]
+        )
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+def escalation_deadline(scheduled_time):
+    """When an unanswered reminder for `scheduled_time` is escalated."""
+    return scheduled_time + timedelta(minutes=CALL_ESCALATION_DELAY_MINUTES)
+
+def get_reminders_to_escalate(due_by, shards=None):
+    """Reminders still in 'sent' whose escalation deadline is at or before `due_by`, with their medication name.
+
+    Only rows past their deadline are visited (idx_reminders_log_escalate_at), so the join stays small.
+    Phone numbers come from the cached user profiles (db_async.get_user_profiles).
+    """
+    conn = get_db_connection()
+    shard_sql, shard_params = _shard_filter_sql(shards, "rl.user_telegram_id")
+    return conn.execute(
+        f"""SELECT rl.id as log_id, m.med_name, rl.user_telegram_id, rl.scheduled_time
            FROM reminders_log rl
            JOIN medications m ON rl.medication_id = m.id
-           JOIN users u ON rl.user_telegram_id = u.telegram_id
-           WHERE rl.status = 'pending' AND rl.scheduled_time <= ?
-        """, (now_utc,) # Make sure scheduled_time is stored in UTC
+           WHERE rl.status = 'sent' 
+             AND rl.escalate_at <= ?{shard_sql}
+        """, (to_db_timestamp(due_by), *shard_params)
     ).fetchall()
-    conn.close()
-    return reminders
 
+def get_escalation_deadlines(shards=None):
+    """Deadlines of every reminder still awaiting an answer, to rebuild the escalation timer on startup."""
+    conn = get_db_connection()
+    shard_sql, shard_params = _shard_filter_sql(shards, "user_telegram_id")
+    return [
+        from_db_timestamp(row[0]) for row in conn.execute(
+            f"SELECT escalate_at FROM reminders_log WHERE status = 'sent' AND escalate_at IS NOT NULL{shard_sql}",
+            shard_params
+        )
+    ]
+
+def get_next_escalation_time(shards=None):
+    """The earliest escalation deadline of a reminder still awaiting an answer, or None."""
+    conn = get_db_connection()
+    shard_sql, shard_params = _shard_filter_sql(shards, "user_telegram_id")
+    row = conn.execute(
+        f"SELECT MIN(escalate_at) FROM reminders_log WHERE status = 'sent'{shard_sql}", shard_params
+    ).fetchone()
+    return from_db_timestamp(row[0]) if row[0] else None
+
+def escalate_reminders(escalations):
+    """Applies escalation decisions in one transaction.
+
+    Each item is (log_id, new_status, chat_id, payload, call), where call is None or the payload of
+    a phone call (to, message). The status only changes if the reminder is still 'sent', and the
+    escalation message and call are added to the outbox only when it did; the call's dedup key
+    call:<log_id> means a reminder is never called about twice.
+    """
+    conn = get_db_connection()
+    now = to_db_timestamp(datetime.now(timezone.utc))
+    try:
+        for log_id, new_status, chat_id, payload, call in escalations:
+            cursor = conn.execute(
+                "UPDATE reminders_log SET status = ? WHERE id = ? AND status = 'sent'", (new_status, log_id)
+            )
+            if cursor.rowcount:
+                conn.execute(
+                    """INSERT OR IGNORE INTO outbox (kind, dedup_key, chat_id, log_id, payload, next_attempt_at)
+                       VALUES ('escalation', ?, ?, ?, ?, ?)""",
+                    (f"escalation:{log_id}", chat_id, log_id, json.dumps(payload), now)
+                )
+                if call:
+                    conn.execute(
+                        """INSERT OR IGNORE INTO outbox (kind, dedup_key, chat_id, log_id, payload, next_attempt_at)
+                           VALUES ('call', ?, ?, ?, ?, ?)""",
+                        (f"call:{log_id}", chat_id, log_id, json.dumps(call), now)
+                    )
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+def snooze_reminder(log_id, refire_at, max_snoozes, build_payload):
+    """Snoozes a delivered reminder and queues its re-send for `refire_at`, in one transaction.
+
+    The snooze limit is checked by the same UPDATE that increments the count, so concurrent taps
+    can't exceed it. The escalation deadline moves to refire_at + CALL_ESCALATION_DELAY_MINUTES.
+    build_payload(log_id, med, snooze_count) returns the re-sent message.
+    Returns the new snooze_count, or None if the reminder is answered or out of snoozes.
+    """
+    conn = get_db_connection()
+    try:
+        row = conn.execute(
+            """UPDATE reminders_log
+               SET status = 'snoozed', snooze_count = snooze_count + 1, escalate_at = ?
+               WHERE id = ? AND status IN ('pending', 'queued', 'sent') AND snooze_count < ?
+               RETURNING medication_id, user_telegram_id, snooze_count""",
+            (to_db_timestamp(escalation_deadline(refire_at)), log_id, max_snoozes)
+        ).fetchone()
+        if row is None:
+            conn.rollback()
+            return None
+        med = conn.execute("SELECT med_name, dosage FROM medications WHERE id = ?", (row['medication_id'],)).fetchone()
+        conn.execute(
+            """INSERT OR IGNORE INTO outbox (kind, dedup_key, chat_id, log_id, payload, next_attempt_at)
+               VALUES ('reminder', ?, ?, ?, ?, ?)""",
+            (f"snooze:{log_id}:{row['snooze_count']}", row['user_telegram_id'], log_id,
+             json.dumps(build_payload(log_id, med, row['snooze_count'])), to_db_timestamp(refire_at))
+        )
+        conn.commit()
+        return row['snooze_count']
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+def get_reminder_log(log_id):
+    conn = get_db_connection()
+    return conn.execute(
+        "SELECT id, medication_id, user_telegram_id, scheduled_time, status, snooze_count FROM reminders_log WHERE id = ?",
+        (log_id,)
+    ).fetchone()
 
 def update_reminder_log_status(log_id, status, acknowledged_at=None, snooze_count_increment=False):
     conn = get_db_connection()
@@ -131,7 +606,7 @@ def update_reminder_log_status(log_id, status, acknowledged_at=None, snooze_coun
         params = [status]
         if acknowledged_at:
             query += ", acknowledged_at = ?"
-            params.append(acknowledged_at)
+            params.append(to_db_timestamp(acknowledged_at))
         if snooze_count_increment:
             query += ", snooze_count = snooze_count + 1"
 
@@ -141,24 +616,649 @@ def update_reminder_log_status(log_id, status, acknowledged_at=None, snooze_coun
         conn.commit()
         logger.info(f"Reminder log ID {log_id} updated to status {status}.")
     except sqlite3.Error as e:
+        conn.rollback()
         logger.error(f"DB Error updating reminder log {log_id}: {e}")
-    finally:
-        conn.close()
+
+# Statuses each buffered transition may replace. Anything else is further along (e.g. a late 'sent'
+# arriving after an ack) and is left alone. A dose taken after it was escalated still counts as taken.
+STATUS_TRANSITIONS_FROM = {
+    'sent': ('pending', 'queued', 'snoozed'),
+    'send_failed': ('pending', 'queued', 'snoozed'),
+    'acknowledged': ('pending', 'queued', 'sent', 'snoozed', 'send_failed', 'missed', 'call_triggered'),
+}
+
+def update_reminder_statuses(updates):
+    """Writes buffered status transitions in one transaction (see write_behind).
+
+    updates: [(log_id, status, acknowledged_at text or None, snooze_count increment)]. A row only
+    changes if its current status may move to the new one (STATUS_TRANSITIONS_FROM).
+    """
+    if not updates:
+        return
+    conn = get_db_connection()
+    try:
+        for status, allowed in STATUS_TRANSITIONS_FROM.items():
+            rows = [(status, acknowledged_at, snooze_increment, log_id, *allowed)
+                    for log_id, new_status, acknowledged_at, snooze_increment in updates if new_status == status]
+            if rows:
+                conn.executemany(
+                    f"""UPDATE reminders_log
+                       SET status = ?, acknowledged_at = COALESCE(?, acknowledged_at), snooze_count = snooze_count + ?
+                       WHERE id = ? AND status IN ({', '.join('?' * len(allowed))})""",
+                    rows
+                )
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
 
 def mark_user_inactive(user_telegram_id):
     conn = get_db_connection()
     try:
         # Set is_active=FALSE for all medications for this user
         conn.execute("UPDATE medications SET is_active=FALSE WHERE user_telegram_id=?", (user_telegram_id,))
+        conn.execute("DELETE FROM reminders_log WHERE user_telegram_id = ? AND status = 'pending'", (user_telegram_id,))
+        _record_schedule_event(conn, 'user_inactive', user_telegram_id)
         # Optionally, you can add an 'is_active' column to users table if not present
         # For now, just log the event
         conn.commit()
+        active_medications.invalidate(user_telegram_id)
+        user_profiles.invalidate(user_telegram_id)
         logger.info(f"User {user_telegram_id} marked as inactive (all medications disabled).")
     except Exception as e:
+        conn.rollback()
         logger.error(f"Error marking user {user_telegram_id} as inactive: {e}")
-    finally:
-        conn.close()
 
-# More functions for CRUD operations on medications, reminders_log etc. as needed.
-# For example, creating entries in reminders_log when a medication is added,
-# for each scheduled time for the next X days.
\ No newline at end of file
+# --- Adherence Statistics ---
+# Read from the adherence_daily rollups (migration 6), so a report costs O(days), not O(reminders).
+def get_user_adherence(user_telegram_id, since_day):
+    """Per-medication totals for a user from `since_day` (a date) on, most scheduled first."""
+    conn = get_db_connection()
+    return conn.execute(
+        """SELECT a.medication_id, m.med_name, m.is_active, SUM(a.scheduled) AS scheduled,
+                  SUM(a.acknowledged) AS acknowledged, SUM(a.snoozed) AS snoozed,
+                  SUM(a.missed) AS missed, SUM(a.escalated) AS escalated
+           FROM adherence_daily a JOIN medications m ON m.id = a.medication_id
+           WHERE a.user_telegram_id = ? AND a.day >= ?
+           GROUP BY a.medication_id ORDER BY scheduled DESC""",
+        (user_telegram_id, since_day.isoformat())
+    ).fetchall()
+
+def get_adherence_by_day(since_day):
+    """Totals across all users, one row per day from `since_day` on."""
+    conn = get_db_connection()
+    return conn.execute(
+        "SELECT day, scheduled, acknowledged, snoozed, missed, escalated FROM adherence_daily_total "
+        "WHERE day >= ? ORDER BY day",
+        (since_day.isoformat(),)
+    ).fetchall()
+
+def get_population_counts():
+    """Users with at least one active medication, and active medications."""
+    conn = get_db_connection()
+    row = conn.execute(
+        "SELECT COUNT(DISTINCT user_telegram_id) AS users, COUNT(*) AS medications FROM medications WHERE is_active = TRUE"
+    ).fetchone()
+    return row['users'], row['medications']
+
+# --- Scheduler Sharding ---
+# A shard filter is a (shard_count, owned_shard_ids) pair; a user belongs to shard abs(telegram_id) % shard_count.
+def shard_of(user_telegram_id, shard_count):
+    return abs(user_telegram_id) % shard_count
+
+def _shard_filter_sql(shards, column):
+    if shards is None:
+        return "", ()
+    shard_count, owned = shards
+    owned = sorted(owned)
+    if not owned:
+        return " AND 0", ()
+    placeholders = ", ".join("?" * len(owned))
+    return f" AND (ABS({column}) % ?) IN ({placeholders})", (shard_count, *owned)
+
+def _record_schedule_event(conn, kind, user_telegram_id, medication_id=None):
+    """Appends to the change feed sharded workers poll. Part of the caller's transaction."""
+    if SCHEDULER_MODE != 'sharded':
+        return
+    conn.execute(
+        "INSERT INTO schedule_events (kind, medication_id, user_telegram_id) VALUES (?, ?, ?)",
+        (kind, medication_id, user_telegram_id)
+    )
+
+def get_last_schedule_event_id():
+    conn = get_db_connection()
+    return conn.execute("SELECT COALESCE(MAX(id), 0) FROM schedule_events").fetchone()[0]
+
+def get_schedule_events(after_id, limit=1000):
+    conn = get_db_connection()
+    return conn.execute(
+        "SELECT id, kind, medication_id, user_telegram_id FROM schedule_events WHERE id > ? ORDER BY id LIMIT ?",
+        (after_id, limit)
+    ).fetchall()
+
+def prune_schedule_events(older_than_seconds):
+    conn = get_db_connection()
+    conn.execute(
+        "DELETE FROM schedule_events WHERE created_at < DATETIME('now', ?)",
+        (f"-{int(older_than_seconds)} seconds",)
+    )
+    conn.commit()
+
+def acquire_shard_leases(owner, shard_count, ttl_seconds):
+    """Heartbeats `owner`, renews its leases and claims or releases shards towards a fair share.
+
+    The fair share is shard_count divided by the number of workers with a live heartbeat, so a
+    crashed worker's shards are picked up once its leases expire, and a worker over its share
+    hands shards back when a new one joins. Returns the set of shard ids this owner now holds and
+    the subset of them taken over from an expired lease, whose outbox the old owner may have left in flight.
+    """
+    conn = get_db_connection()
+    now = time.time()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "INSERT INTO scheduler_workers (owner, heartbeat_at) VALUES (?, ?) "
+            "ON CONFLICT (owner) DO UPDATE SET heartbeat_at = excluded.heartbeat_at",
+            (owner, now)
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO scheduler_leases (shard_id, owner, expires_at) VALUES (?, NULL, 0)",
+            [(shard_id,) for shard_id in range(shard_count)]
+        )
+        live_workers = conn.execute(
+            "SELECT COUNT(*) FROM scheduler_workers WHERE heartbeat_at >= ?", (now - ttl_seconds,)
+        ).fetchone()[0]
+        fair_share = math.ceil(shard_count / max(live_workers, 1))
+
+        conn.execute(
+            "UPDATE scheduler_leases SET expires_at = ? WHERE owner = ? AND shard_id < ?",
+            (now + ttl_seconds, owner, shard_count)
+        )
+        taken_over = set()
+        owned = [row[0] for row in conn.execute(
+            "SELECT shard_id FROM scheduler_leases WHERE owner = ? AND shard_id < ? ORDER BY shard_id",
+            (owner, shard_count)
+        )]
+        if len(owned) > fair_share:
+            released = owned[fair_share:]
+            owned = owned[:fair_share]
+            conn.executemany(
+                "UPDATE scheduler_leases SET owner = NULL, expires_at = 0 WHERE shard_id = ? AND owner = ?",
+                [(shard_id, owner) for shard_id in released]
+            )
+        elif len(owned) < fair_share:
+            claimable = conn.execute(
+                "SELECT shard_id, owner FROM scheduler_leases WHERE shard_id < ? AND (owner IS NULL OR expires_at < ?) "
+                "ORDER BY shard_id LIMIT ?",
+                (shard_count, now, fair_share - len(owned))
+            ).fetchall()
+            conn.executemany(
+                "UPDATE scheduler_leases SET owner = ?, expires_at = ? WHERE shard_id = ?",
+                [(owner, now + ttl_seconds, row[0]) for row in claimable]
+            )
+            owned.extend(row[0] for row in claimable)
+            # A released lease has no owner; one still naming an owner expired without being released.
+            taken_over = {row[0] for row in claimable if row[1] is not None}
+        conn.commit()
+        return set(owned), taken_over
+    except sqlite3.Error as e:
+        conn.rollback()
+        logger.error(f"DB Error acquiring shard leases for {owner}: {e}")
+        raise
+
+def release_shard_leases(owner):
+    conn = get_db_connection()
+    try:
+        conn.execute("UPDATE scheduler_leases SET owner = NULL, expires_at = 0 WHERE owner = ?", (owner,))
+        conn.execute("DELETE FROM scheduler_workers WHERE owner = ?", (owner,))
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        logger.error(f"DB Error releasing shard leases for {owner}: {e}")
+
+# --- Outbox ---
+# Telegram messages, relayed by outbox.OutboxRelay; 'call' rows are placed by calls.CallRelay.
+MESSAGE_KINDS = ('reminder', 'escalation')
+
+def _kind_filter_sql(kinds, column="kind"):
+    return f" AND {column} IN ({', '.join('?' * len(kinds))})", list(kinds)
+
+def recover_outbox(shards=None, kinds=MESSAGE_KINDS):
+    """Returns messages left 'inflight' by a crash or restart to 'pending' so they are sent again.
+
+    A reminder whose log row already moved on from 'queued' (or 'snoozed', for a re-send) was
+    delivered before the crash and is closed instead, so a replay can't flip an acknowledged dose back to 'sent'.
+    """
+    conn = get_db_connection()
+    shard_sql, shard_params = _shard_filter_sql(shards, "chat_id")
+    kind_sql, kind_params = _kind_filter_sql(kinds)
+    try:
+        conn.execute(
+            f"""UPDATE outbox SET status = 'sent'
+               WHERE status = 'inflight' AND kind = 'reminder'{shard_sql}
+                 AND log_id IN (SELECT id FROM reminders_log WHERE status NOT IN ('pending', 'queued', 'snoozed'))""",
+            shard_params
+        )
+        cursor = conn.execute(
+            f"UPDATE outbox SET status = 'pending' WHERE status = 'inflight'{kind_sql}{shard_sql}",
+            (*kind_params, *shard_params)
+        )
+        conn.commit()
+        return cursor.rowcount
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+def claim_outbox_batch(limit, shards=None, kinds=MESSAGE_KINDS):
+    """Atomically moves up to `limit` due 'pending' messages of `kinds` to 'inflight' and returns them."""
+    conn = get_db_connection()
+    shard_sql, shard_params = _shard_filter_sql(shards, "o.chat_id")
+    kind_sql, kind_params = _kind_filter_sql(kinds, "o.kind")
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(
+            f"""SELECT o.id, o.kind, o.chat_id, o.log_id, o.payload, o.attempts, o.next_attempt_at, rl.escalate_at
+               FROM outbox o LEFT JOIN reminders_log rl ON rl.id = o.log_id
+               WHERE o.status = 'pending' AND o.next_attempt_at <= ?{kind_sql}{shard_sql}
+               ORDER BY o.next_attempt_at, o.id LIMIT ?""",
+            (to_db_timestamp(datetime.now(timezone.utc)), *kind_params, *shard_params, limit)
+        ).fetchall()
+        conn.executemany("UPDATE outbox SET status = 'inflight' WHERE id = ?", [(row['id'],) for row in rows])
+        conn.commit()
+        return rows
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+def complete_outbox(results):
+    """Records final outcomes; each result is (outbox_id, status, attempts, error)."""
+    conn = get_db_connection()
+    now = to_db_timestamp(datetime.now(timezone.utc))
+    try:
+        conn.executemany(
+            "UPDATE outbox SET status = ?, attempts = attempts + ?, last_error = ?, "
+            "sent_at = CASE WHEN ? = 'sent' THEN ? ELSE sent_at END WHERE id = ?",
+            [(status, attempts, error, status, now, outbox_id) for outbox_id, status, attempts, error in results]
+        )
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+def fail_interrupted_calls(shards=None):
+    """Gives up on calls left 'inflight' by a crash or restart: the provider may already have placed them.
+
+    Returns the number of calls given up on.
+    """
+    conn = get_db_connection()
+    shard_sql, shard_params = _shard_filter_sql(shards, "chat_id")
+    cursor = conn.execute(
+        f"""UPDATE outbox SET status = 'failed', last_error = 'interrupted by a restart'
+           WHERE status = 'inflight' AND kind = 'call'{shard_sql}""",
+        shard_params
+    )
+    conn.commit()
+    return cursor.rowcount
+
+def complete_calls(results):
+    """Records call outcomes; each result is (outbox_id, log_id, status, attempts, error, placed_at).
+
+    A placed call also sets its reminder's call_triggered_at, in the same transaction.
+    """
+    conn = get_db_connection()
+    now = to_db_timestamp(datetime.now(timezone.utc))
+    try:
+        conn.executemany(
+            "UPDATE outbox SET status = ?, attempts = attempts + ?, last_error = ?, "
+            "sent_at = CASE WHEN ? = 'sent' THEN ? ELSE sent_at END WHERE id = ?",
+            [(status, attempts, error, status, now, outbox_id) for outbox_id, _, status, attempts, error, _ in results]
+        )
+        conn.executemany(
+            "UPDATE reminders_log SET call_triggered_at = ? WHERE id = ?",
+            [(to_db_timestamp(placed_at), log_id) for _, log_id, _, _, _, placed_at in results if placed_at]
+        )
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+def prune_outbox(older_than_hours):
+    conn = get_db_connection()
+    conn.execute(
+        "DELETE FROM outbox WHERE status IN ('sent', 'failed') AND created_at < DATETIME('now', ?)",
+        (f"-{int(older_than_hours)} hours",)
+    )
+    conn.commit()
+
+# --- Scheduler State ---
+def _set_state(conn, state):
+    if state:
+        conn.executemany(
+            "INSERT INTO scheduler_state (key, value) VALUES (?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            list(state.items())
+        )
+
+def get_scheduler_state(keys):
+    """Returns {key: value} for the given keys that exist."""
+    conn = get_db_connection()
+    keys = list(keys)
+    if not keys:
+        return {}
+    placeholders = ", ".join("?" * len(keys))
+    return dict(conn.execute(f"SELECT key, value FROM scheduler_state WHERE key IN ({placeholders})", keys).fetchall())
+
+# --- Reminder Materialisation ---
+# Each active medication is expanded ahead of time into one 'pending' reminders_log row per
+# occurrence, in UTC, up to the horizon stored as scheduler_state 'materialized_until'. The
+# scheduler then only range-scans due rows (get_due_reminders) instead of computing slots itself.
+MATERIALIZE_BATCH_SIZE = 5000
+_materialize_listeners = []
+
+def add_materialize_listener(callback):
+    """Registers callback(earliest) for reminders materialised by this process (e.g. a new medication).
+
+    Called from DB threads after commit, with the earliest new scheduled_time, so a running
+    scheduler can fire sooner than it had planned.
+    """
+    if callback not in _materialize_listeners:
+        _materialize_listeners.append(callback)
+
+def _notify_materialized(earliest):
+    if earliest is None:
+        return
+    for callback in _materialize_listeners:
+        try:
+            callback(earliest)
+        except Exception as e:
+            logger.error(f"Materialise listener failed: {e}", exc_info=True)
+
+def _materialized_until(conn):
+    row = conn.execute("SELECT value FROM scheduler_state WHERE key = 'materialized_until'").fetchone()
+    if row:
+        return datetime.fromisoformat(row[0])
+    return datetime.now(timezone.utc) + timedelta(days=MATERIALIZE_HORIZON_DAYS)
+
+def _materialize(conn, start, end, where_sql, params=()):
+    """Inserts the occurrences in (start, end] of the active medications matching `where_sql`.
+
+    Part of the caller's transaction. Occurrences that already have a log row are left alone.
+    Returns (rows inserted, earliest occurrence or None).
+    """
+    if end <= start:
+        return 0, None
+    meds = conn.execute(
+        f"""SELECT m.id, m.user_telegram_id, m.times_of_day, COALESCE(u.timezone, 'UTC') AS timezone
+           FROM medications m LEFT JOIN users u ON u.telegram_id = m.user_telegram_id
+           WHERE m.is_active = TRUE AND {where_sql}""",
+        params
+    )
+    inserted = 0
+    earliest = None
+    batch = []
+
+    def flush():
+        nonlocal inserted
+        before = conn.total_changes
+        conn.executemany(
+            """INSERT INTO reminders_log (medication_id, user_telegram_id, scheduled_time, status, escalate_at)
+               VALUES (?, ?, ?, 'pending', ?)
+               ON CONFLICT (medication_id, scheduled_time) DO NOTHING""",
+            batch
+        )
+        inserted += conn.total_changes - before
+        batch.clear()
+
+    for med in meds.fetchall():
+        for at in occurrences(med['times_of_day'], med['timezone'], start, end):
+            batch.append((med['id'], med['user_telegram_id'], to_db_timestamp(at),
+                          to_db_timestamp(escalation_deadline(at))))
+            if earliest is None or at < earliest:
+                earliest = at
+        if len(batch) >= MATERIALIZE_BATCH_SIZE:
+            flush()
+    if batch:
+        flush()
+    return inserted, earliest
+
+def _rematerialize(conn, where_sql, params=()):
+    """Replaces the future 'pending' rows of the matching medications, e.g. after a time zone change.
+
+    Part of the caller's transaction. Returns the earliest new occurrence or None.
+    """
+    now = datetime.now(timezone.utc)
+    conn.execute(
+        f"""DELETE FROM reminders_log
+           WHERE status = 'pending' AND scheduled_time > ?
+             AND medication_id IN (SELECT m.id FROM medications m WHERE {where_sql})""",
+        (to_db_timestamp(now), *params)
+    )
+    _, earliest = _materialize(conn, now, _materialized_until(conn), where_sql, params)
+    return earliest
+
+def extend_reminder_horizon(horizon_days=MATERIALIZE_HORIZON_DAYS, step=timedelta(days=1)):
+    """Materialises every active medication up to now + horizon_days, continuing from the stored horizon.
+
+    Works in transactions of `step`, each holding the write lock while it reads and advances the
+    horizon, so a medication added concurrently is never left with a gap. Returns rows inserted.
+    """
+    conn = get_db_connection()
+    now = datetime.now(timezone.utc)
+    target = now + timedelta(days=horizon_days)
+    inserted = 0
+    while True:
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT value FROM scheduler_state WHERE key = 'materialized_until'").fetchone()
+            start = max(datetime.fromisoformat(row[0]), now) if row else now
+            if start >= target:
+                conn.rollback()
+                break
+            end = min(start + step, target)
+            count, _ = _materialize(conn, start, end, "1")
+            _set_state(conn, {'materialized_until': end.isoformat()})
+            conn.commit()
+            inserted += count
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    if inserted:
+        logger.info(f"Materialised {inserted} reminders up to {target}.")
+    return inserted
+
+# --- Broadcasts ---
+def create_broadcast(text, created_by):
+    """Starts a broadcast to every user. Returns its row, or None if another one is still running."""
+    conn = get_db_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        if conn.execute("SELECT 1 FROM broadcasts WHERE status = 'running'").fetchone():
+            conn.rollback()
+            return None
+        row = conn.execute(
+            """INSERT INTO broadcasts (text, created_by, total, cursor)
+               VALUES (?, ?, (SELECT COUNT(*) FROM users), (SELECT COALESCE(MIN(telegram_id), 1) - 1 FROM users))
+               RETURNING *""",
+            (text, created_by)
+        ).fetchone()
+        conn.commit()
+        return row
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+def get_broadcast(broadcast_id=None):
+    """A broadcast by id, or the most recent one."""
+    conn = get_db_connection()
+    if broadcast_id is not None:
+        return conn.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+    return conn.execute("SELECT * FROM broadcasts ORDER BY id DESC LIMIT 1").fetchone()
+
+def get_running_broadcast():
+    return get_db_connection().execute("SELECT * FROM broadcasts WHERE status = 'running' LIMIT 1").fetchone()
+
+def get_broadcast_recipients(after_telegram_id, limit):
+    """The next `limit` user ids after `after_telegram_id`, in id order: a keyset page over the users primary key."""
+    return [row[0] for row in get_db_connection().execute(
+        "SELECT telegram_id FROM users WHERE telegram_id > ? ORDER BY telegram_id LIMIT ?", (after_telegram_id, limit)
+    )]
+
+def save_broadcast_progress(broadcast_id, cursor, sent, failed, blocked, status='running'):
+    conn = get_db_connection()
+    conn.execute(
+        """UPDATE broadcasts SET cursor = ?, sent = ?, failed = ?, blocked = ?, status = ?,
+                  finished_at = CASE WHEN ? != 'running' THEN ? END
+           WHERE id = ?""",
+        (cursor, sent, failed, blocked, status, status, to_db_timestamp(datetime.now(timezone.utc)), broadcast_id)
+    )
+    conn.commit()
+
+# --- Bot Persistence ---
+def load_persistence_data(kind, key):
+    """The stored JSON data of one user, chat (or the bot, key 0), or None."""
+    row = get_db_connection().execute(
+        "SELECT data FROM persistence_data WHERE kind = ? AND key = ?", (kind, key)
+    ).fetchone()
+    return row[0] if row else None
+
+def load_conversations(name, max_age_days):
+    """{JSON key: JSON state} of the conversations of handler `name` in progress.
+
+    Conversations untouched for `max_age_days` are dropped instead, so abandoned ones don't pile up.
+    """
+    conn = get_db_connection()
+    cutoff = to_db_timestamp(datetime.now(timezone.utc) - timedelta(days=max_age_days))
+    conn.execute("DELETE FROM conversation_states WHERE name = ? AND updated_at < ?", (name, cutoff))
+    conn.commit()
+    return {row['key']: row['state'] for row in conn.execute(
+        "SELECT key, state FROM conversation_states WHERE name = ?", (name,)
+    )}
+
+def save_persistence(data, conversations):
+    """Writes changed bot persistence in one transaction.
+
+    data: [(kind, key, JSON or None to delete)]; conversations: [(name, JSON key, JSON state or None to delete)].
+    """
+    conn = get_db_connection()
+    now = to_db_timestamp(datetime.now(timezone.utc))
+    try:
+        conn.executemany(
+            """INSERT INTO persistence_data (kind, key, data, updated_at) VALUES (?, ?, ?, ?)
+               ON CONFLICT (kind, key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at""",
+            [(kind, key, value, now) for kind, key, value in data if value is not None]
+        )
+        conn.executemany(
+            "DELETE FROM persistence_data WHERE kind = ? AND key = ?",
+            [(kind, key) for kind, key, value in data if value is None]
+        )
+        conn.executemany(
+            """INSERT INTO conversation_states (name, key, state, updated_at) VALUES (?, ?, ?, ?)
+               ON CONFLICT (name, key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at""",
+            [(name, key, state, now) for name, key, state in conversations if state is not None]
+        )
+        conn.executemany(
+            "DELETE FROM conversation_states WHERE name = ? AND key = ?",
+            [(name, key) for name, key, state in conversations if state is None]
+        )
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+# --- Bulk Import/Export ---
+def bulk_import(users, medications):
+    """Upserts users and adds medications in one transaction, materialising the new medications.
+
+    users: [(telegram_id, phone_number, timezone)]; a None phone_number or timezone keeps the stored
+    value (new users get UTC). medications: [(telegram_id, med_name, dosage, times_of_day)]; one
+    identical to an active medication of the same user is skipped, so re-importing a file is harmless.
+    Returns (medications added, duplicates skipped).
+    """
+    conn = get_db_connection()
+    user_ids = sorted({user[0] for user in users} | {med[0] for med in medications})
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        placeholders = ", ".join("?" * len(user_ids))
+        old_timezones = dict(conn.execute(
+            f"SELECT telegram_id, timezone FROM users WHERE telegram_id IN ({placeholders})", user_ids
+        ).fetchall()) if user_ids else {}
+        conn.executemany(
+            """INSERT INTO users (telegram_id, phone_number, timezone) VALUES (?, ?, COALESCE(?, 'UTC'))
+               ON CONFLICT (telegram_id) DO UPDATE SET
+                 phone_number = COALESCE(excluded.phone_number, users.phone_number),
+                 timezone = COALESCE(?, users.timezone)""",
+            [(telegram_id, phone_number, tz_name, tz_name) for telegram_id, phone_number, tz_name in users]
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (telegram_id) VALUES (?)", [(med[0],) for med in medications]
+        )
+
+        existing = {tuple(row) for row in conn.execute(
+            f"SELECT user_telegram_id, med_name, times_of_day FROM medications "
+            f"WHERE is_active = TRUE AND user_telegram_id IN ({placeholders})", user_ids
+        )} if user_ids else set()
+        new_meds = []
+        for telegram_id, med_name, dosage, times_of_day in medications:
+            key = (telegram_id, med_name, times_of_day)
+            if key not in existing:
+                existing.add(key)
+                new_meds.append((telegram_id, med_name, dosage, times_of_day))
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM medications").fetchone()[0]
+        conn.executemany(
+            "INSERT INTO medications (user_telegram_id, med_name, dosage, times_of_day) VALUES (?, ?, ?, ?)", new_meds
+        )
+        for med_id, telegram_id in conn.execute(
+            "SELECT id, user_telegram_id FROM medications WHERE id > ?", (last_id,)
+        ).fetchall():
+            _record_schedule_event(conn, 'med_added', telegram_id, med_id)
+
+        rescheduled = [telegram_id for telegram_id, _, tz_name in users
+                       if tz_name and telegram_id in old_timezones and old_timezones[telegram_id] != tz_name]
+        earliest = None
+        if rescheduled:
+            earliest = _rematerialize(conn, f"m.user_telegram_id IN ({', '.join('?' * len(rescheduled))})", rescheduled)
+            for telegram_id in rescheduled:
+                _record_schedule_event(conn, 'user_rescheduled', telegram_id)
+        _, new_earliest = _materialize(conn, datetime.now(timezone.utc), _materialized_until(conn), "m.id > ?", (last_id,))
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    for telegram_id in user_ids:
+        user_profiles.invalidate(telegram_id)
+        active_medications.invalidate(telegram_id)
+    _notify_materialized(min(filter(None, (earliest, new_earliest)), default=None))
+    return len(new_meds), len(medications) - len(new_meds)
+
+def iter_medications(include_inactive=False, batch_size=1000):
+    """Streams medications with their user's phone number and time zone, in the bulk import columns."""
+    conn = get_db_connection()
+    cursor = conn.execute(
+        f"""SELECT m.user_telegram_id AS telegram_id, u.phone_number, u.timezone, m.med_name, m.dosage,
+                  m.times_of_day, m.is_active
+           FROM medications m LEFT JOIN users u ON u.telegram_id = m.user_telegram_id
+           {'' if include_inactive else 'WHERE m.is_active = TRUE'}
+           ORDER BY m.id"""
+    )
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+def iter_reminder_history(since=None, batch_size=1000):
+    """Streams settled reminders_log rows scheduled at or after `since` (all if None), in insertion order."""
+    conn = get_db_connection()
+    cursor = conn.execute(
+        """SELECT rl.id AS log_id, rl.user_telegram_id AS telegram_id, rl.medication_id, m.med_name,
+                  rl.scheduled_time, rl.status, rl.snooze_count, rl.acknowledged_at
+           FROM reminders_log rl LEFT JOIN medications m ON m.id = rl.medication_id
+           WHERE rl.scheduled_time >= ? AND rl.status NOT IN ('pending', 'queued')
+           ORDER BY rl.id""",  # rowid order streams without a sort over the whole table
+        (to_db_timestamp(since) if since else '',)
+    )
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
@@ -0,0 +1,260 @@
+"""Awaitable storage API used by handlers and scheduler jobs.
+
+Calls go to the backend DB_BACKEND selects (see storage.Storage). With SQLite every call runs the
+database.py function on a small dedicated thread pool, each thread holding its own long-lived
+connection (see database.get_db_connection), so handlers and scheduler jobs never block the event
+loop on connection setup or disk I/O. With PostgreSQL (pg_storage) calls go over an asyncpg pool.
+Read-through caches of user profiles and active medications sit in front of either.
+"""
+import abc
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import database as db
+import metrics
+from cache import MISSING, user_profiles, active_medications
+from config import DB_BACKEND, DB_POOL_SIZE
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+
+async def run(func, *args, **kwargs):
+    """Runs a blocking database function on the DB thread pool and awaits its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, _timed, func, args, kwargs)
+
+
+def _timed(func, args, kwargs):
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        metrics.db_call_seconds.observe(time.perf_counter() - start, function=func.__name__)
+
+
+class SQLiteStorage(Storage):
+    """The database.py functions, each run on the DB thread pool."""
+
+    async def start(self):
+        await run(db.init_db)
+
+    async def close(self):
+        _executor.shutdown(wait=True)
+        db.close_db_connections()
+        logger.info("DB executor shut down and connections closed.")
+
+
+def _delegate(name):
+    func = getattr(db, name)
+
+    async def method(self, *args, **kwargs):
+        return await run(func, *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = func.__doc__
+    return method
+
+
+for _name in (
+    'add_user', 'get_user_profile', 'get_user_profiles', 'set_user_timezone', 'mark_user_inactive',
+    'add_medication_db', 'get_active_medications_for_user', 'get_medication',
+    'extend_reminder_horizon', 'get_due_reminders', 'claim_due_reminders', 'get_next_due_time', 'queue_reminders',
+    'mark_reminders_missed', 'get_reminders_to_escalate', 'get_escalation_deadlines', 'get_next_escalation_time',
+    'escalate_reminders', 'snooze_reminder', 'get_reminder_log', 'update_reminder_log_status', 'update_reminder_statuses',
+    'get_user_adherence', 'get_adherence_by_day', 'get_population_counts',
+    'recover_outbox', 'claim_outbox_batch', 'complete_outbox', 'fail_interrupted_calls', 'complete_calls',
+    'prune_outbox', 'get_scheduler_state',
+    'create_broadcast', 'get_broadcast', 'get_running_broadcast', 'get_broadcast_recipients', 'save_broadcast_progress',
+    'load_persistence_data', 'load_conversations', 'save_persistence',
+):
+    setattr(SQLiteStorage, _name, _delegate(_name))
+abc.update_abstractmethods(SQLiteStorage)  # so a database function missing from the list fails at startup
+
+
+def _create_storage():
+    if DB_BACKEND == 'postgres':
+        from pg_storage import PostgresStorage  # asyncpg is only needed for this backend
+        return PostgresStorage()
+    return SQLiteStorage()
+
+
+# Process-wide storage backend.
+storage = _create_storage()
+
+
+async def _cached(cache, key, load, *args):
+    """Read-through: returns the cached value for `key`, or awaits load(*args) and caches its result."""
+    value = cache.get(key)
+    if value is not MISSING:
+        return value
+    generation = cache.generation  # an invalidation while loading means the result may be stale
+    value = await load(*args)
+    cache.set(key, value, generation)
+    return value
+
+
+async def shutdown():
+    """Waits for in-flight DB calls, then closes every connection."""
+    await storage.close()
+
+
+# --- User Functions ---
+async def add_user(telegram_id, phone_number=None):
+    return await storage.add_user(telegram_id, phone_number)
+
+async def get_user_profile(telegram_id):
+    return await _cached(user_profiles, telegram_id, storage.get_user_profile, telegram_id)
+
+async def get_user_profiles(telegram_ids):
+    """{telegram_id: profile row} for users that exist; only cache misses go to the database, in one call."""
+    profiles = {}
+    missing = []
+    for telegram_id in set(telegram_ids):
+        profile = user_profiles.get(telegram_id)
+        if profile is MISSING:
+            missing.append(telegram_id)
+        elif profile is not None:
+            profiles[telegram_id] = profile
+    if missing:
+        generation = user_profiles.generation
+        loaded = await storage.get_user_profiles(missing)
+        for telegram_id in missing:
+            user_profiles.set(telegram_id, loaded.get(telegram_id), generation)
+        profiles.update(loaded)
+    return profiles
+
+async def get_user_phone(telegram_id):
+    profile = await get_user_profile(telegram_id)
+    return profile['phone_number'] if profile and profile['phone_number'] else None
+
+async def get_user_timezone(telegram_id):
+    profile = await get_user_profile(telegram_id)
+    return profile['timezone'] if profile else None
+
+async def set_user_timezone(telegram_id, tz_name):
+    return await storage.set_user_timezone(telegram_id, tz_name)
+
+async def mark_user_inactive(user_telegram_id):
+    return await storage.mark_user_inactive(user_telegram_id)
+
+# --- Medication Functions ---
+async def add_medication_db(user_telegram_id, med_name, dosage, times_of_day):
+    return await storage.add_medication_db(user_telegram_id, med_name, dosage, times_of_day)
+
+async def get_active_medications_for_user(user_telegram_id):
+    return await _cached(active_medications, user_telegram_id, storage.get_active_medications_for_user, user_telegram_id)
+
+async def get_medication(med_id):
+    return await storage.get_medication(med_id)
+
+# --- Reminder Log Functions ---
+async def get_due_reminders(due_by, shards=None):
+    return await storage.get_due_reminders(due_by, shards)
+
+async def claim_due_reminders(due_by, build_payload, shards=None):
+    return await storage.claim_due_reminders(due_by, build_payload, shards)
+
+async def get_next_due_time(shards=None):
+    return await storage.get_next_due_time(shards)
+
+async def queue_reminders(reminders, build_payload):
+    return await storage.queue_reminders(reminders, build_payload)
+
+async def mark_reminders_missed(log_ids):
+    return await storage.mark_reminders_missed(log_ids)
+
+async def extend_reminder_horizon():
+    return await storage.extend_reminder_horizon()
+
+async def escalate_reminders(escalations):
+    return await storage.escalate_reminders(escalations)
+
+async def get_reminders_to_escalate(due_by, shards=None):
+    return await storage.get_reminders_to_escalate(due_by, shards)
+
+async def get_escalation_deadlines(shards=None):
+    return await storage.get_escalation_deadlines(shards)
+
+async def get_next_escalation_time(shards=None):
+    return await storage.get_next_escalation_time(shards)
+
+async def snooze_reminder(log_id, refire_at, max_snoozes, build_payload):
+    return await storage.snooze_reminder(log_id, refire_at, max_snoozes, build_payload)
+
+async def get_reminder_log(log_id):
+    return await storage.get_reminder_log(log_id)
+
+async def update_reminder_log_status(log_id, status, acknowledged_at=None, snooze_count_increment=False):
+    return await storage.update_reminder_log_status(log_id, status, acknowledged_at, snooze_count_increment)
+
+async def update_reminder_statuses(updates):
+    return await storage.update_reminder_statuses(updates)
+
+# --- Adherence Statistics ---
+async def get_user_adherence(user_telegram_id, since_day):
+    return await storage.get_user_adherence(user_telegram_id, since_day)
+
+async def get_adherence_by_day(since_day):
+    return await storage.get_adherence_by_day(since_day)
+
+async def get_population_counts():
+    return await storage.get_population_counts()
+
+# --- Outbox ---
+async def recover_outbox(shards=None, kinds=db.MESSAGE_KINDS):
+    return await storage.recover_outbox(shards, kinds)
+
+async def claim_outbox_batch(limit, shards=None, kinds=db.MESSAGE_KINDS):
+    return await storage.claim_outbox_batch(limit, shards, kinds)
+
+async def complete_outbox(results):
+    return await storage.complete_outbox(results)
+
+async def fail_interrupted_calls(shards=None):
+    return await storage.fail_interrupted_calls(shards)
+
+async def complete_calls(results):
+    return await storage.complete_calls(results)
+
+async def prune_outbox(older_than_hours):
+    return await storage.prune_outbox(older_than_hours)
+
+# --- Scheduler State ---
+async def get_scheduler_state(keys):
+    return await storage.get_scheduler_state(keys)
+
+# --- Broadcasts ---
+async def create_broadcast(text, created_by):
+    return await storage.create_broadcast(text, created_by)
+
+async def get_broadcast(broadcast_id=None):
+    return await storage.get_broadcast(broadcast_id)
+
+async def get_running_broadcast():
+    return await storage.get_running_broadcast()
+
+async def get_broadcast_recipients(after_telegram_id, limit):
+    return await storage.get_broadcast_recipients(after_telegram_id, limit)
+
+async def save_broadcast_progress(broadcast_id, cursor, sent, failed, blocked, status='running'):
+    return await storage.save_broadcast_progress(broadcast_id, cursor, sent, failed, blocked, status)
+
+async def claim_broadcast(broadcast_id):
+    return await storage.claim_broadcast(broadcast_id)
+
+async def release_broadcast(broadcast_id):
+    return await storage.release_broadcast(broadcast_id)
+
+# --- Bot Persistence ---
+async def load_persistence_data(kind, key):
+    return await storage.load_persistence_data(kind, key)
+
+async def load_conversations(name, max_age_days):
+    return await storage.load_conversations(name, max_age_days)
+
+async def save_persistence(data, conversations):
+    return await storage.save_persistence(data, conversations)
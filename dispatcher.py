@@ -0,0 +1,239 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import timedelta
+
+from telegram.error import Forbidden, RetryAfter, TelegramError
+
+import metrics
+from config import (
+    DISPATCH_WORKERS, DISPATCH_GLOBAL_RATE, DISPATCH_PER_CHAT_RATE,
+    DISPATCH_MAX_ATTEMPTS, DISPATCH_RETRY_BASE_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Lower number = sent first.
+PRIORITY_ESCALATION = 0
+PRIORITY_REMINDER = 1
+PRIORITY_BULK = 9
+
+BLOCKED_MARKERS = ("chat not found", "bot was blocked by the user", "user is deactivated")
+
+
+def is_blocked_error(error):
+    """True for Telegram errors that mean the chat will never accept messages again."""
+    text = str(error).lower()
+    return isinstance(error, Forbidden) or any(marker in text for marker in BLOCKED_MARKERS)
+
+
+def retry_after_seconds(error):
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class TokenBucket:
+    """Classic token bucket; acquire() waits until a token is available."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Drains the bucket so nothing is sent for `seconds` (used when Telegram answers 429)."""
+        self._tokens = -seconds * self.rate
+        self._updated = time.monotonic()
+
+
+class SendJob:
+    __slots__ = ("chat_id", "send", "on_success", "on_failure", "priority", "attempt", "label")
+
+    def __init__(self, chat_id, send, on_success, on_failure, priority, label):
+        self.chat_id = chat_id
+        self.send = send
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.priority = priority
+        self.attempt = 0
+        self.label = label
+
+
+class SendDispatcher:
+    """Fans out Telegram sends over a bounded worker pool.
+
+    A shared token bucket enforces the bot-wide rate limit and a per-chat schedule keeps each chat
+    under its own limit. Jobs that cannot be sent yet (per-chat spacing, 429 RetryAfter, transient
+    errors with backoff) go to a delayed heap instead of blocking a worker.
+    """
+
+    def __init__(self, workers=DISPATCH_WORKERS, global_rate=DISPATCH_GLOBAL_RATE,
+                 per_chat_rate=DISPATCH_PER_CHAT_RATE, max_attempts=DISPATCH_MAX_ATTEMPTS,
+                 retry_base_seconds=DISPATCH_RETRY_BASE_SECONDS):
+        self.workers = workers
+        self.global_rate = global_rate
+        self.per_chat_interval = 1.0 / per_chat_rate
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self._seq = itertools.count()
+        self._queue = None
+        self._delayed = []        # heap of (ready_at, seq, job)
+        self._delayed_changed = None
+        self._chat_next_at = {}   # chat_id -> monotonic time the chat may receive its next message
+        self._bucket = None
+        self._tasks = []
+        self._pump_task = None
+        self._stopping = False
+
+    @property
+    def running(self):
+        return bool(self._tasks)
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._delayed_changed = asyncio.Event()
+        self._bucket = TokenBucket(self.global_rate)
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        self._pump_task = asyncio.create_task(self._pump_delayed())
+        logger.info(f"Send dispatcher started with {self.workers} workers, {self.global_rate} msg/s global limit.")
+
+    async def stop(self, timeout=10):
+        """Waits up to `timeout` seconds for queued sends to finish, then cancels the workers."""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Send dispatcher stopped with {self.pending()} sends still queued.")
+        # The pump is signalled rather than cancelled: wait_for() can swallow a cancel that races its event.
+        self._stopping = True
+        self._delayed_changed.set()
+        await self._pump_task
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._pump_task = None
+
+    def pending(self):
+        return (self._queue.qsize() if self._queue else 0) + len(self._delayed)
+
+    def submit(self, chat_id, send, on_success=None, on_failure=None, priority=PRIORITY_REMINDER, label=""):
+        """Queues `send()` (a coroutine function) for chat_id.
+
+        on_success(result) runs after a successful send; on_failure(outcome) runs with
+        'blocked' or 'send_failed' once the job is given up on. Callbacks may be coroutines.
+        """
+        job = SendJob(chat_id, send, on_success, on_failure, priority, label)
+        self._queue.put_nowait((priority, next(self._seq), job))
+        return job
+
+    def _defer(self, job, delay):
+        heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._seq), job))
+        self._delayed_changed.set()
+
+    async def _pump_delayed(self):
+        while not self._stopping:
+            self._delayed_changed.clear()
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, seq, job = heapq.heappop(self._delayed)
+                self._queue.put_nowait((job.priority, seq, job))
+            timeout = self._delayed[0][0] - now if self._delayed else None
+            try:
+                await asyncio.wait_for(self._delayed_changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self, worker_id):
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                await self._run(job)
+            except Exception as e:
+                logger.error(f"[DISPATCH] Unexpected error in worker {worker_id} for {job.label}: {e}", exc_info=True)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job):
+        now = time.monotonic()
+        chat_next_at = self._chat_next_at.get(job.chat_id, 0)
+        if chat_next_at > now:
+            self._defer(job, chat_next_at - now)
+            return
+        self._chat_next_at[job.chat_id] = now + self.per_chat_interval
+        if len(self._chat_next_at) > 10000:
+            self._chat_next_at = {k: v for k, v in self._chat_next_at.items() if v > now}
+
+        await self._bucket.acquire()
+        job.attempt += 1
+        started = time.perf_counter()
+        try:
+            result = await job.send()
+        except RetryAfter as ra:
+            metrics.sends_total.inc(outcome='rate_limited')
+            delay = retry_after_seconds(ra)
+            logger.warning("[DISPATCH] 429 for %s (chat %s); retrying in %ss.", job.label, job.chat_id, delay,
+                           extra={"user_id": job.chat_id, "sample": True})
+            self._bucket.pause(delay)
+            self._defer(job, delay)
+            return
+        except TelegramError as te:
+            if is_blocked_error(te):
+                metrics.sends_total.inc(outcome='blocked')
+                logger.error("[DISPATCH] Chat %s unreachable for %s: %s", job.chat_id, job.label, te,
+                             extra={"user_id": job.chat_id})
+                await self._finish(job.on_failure, 'blocked')
+                return
+            logger.error("[DISPATCH] Attempt %d failed for %s (chat %s): %s", job.attempt, job.label, job.chat_id, te,
+                         extra={"user_id": job.chat_id, "sample": True})
+        except Exception as e:
+            logger.error("[DISPATCH] Attempt %d failed for %s (chat %s): %s", job.attempt, job.label, job.chat_id, e,
+                         exc_info=True, extra={"user_id": job.chat_id, "sample": True})
+        else:
+            metrics.send_latency_seconds.observe(time.perf_counter() - started)
+            metrics.sends_total.inc(outcome='success')
+            await self._finish(job.on_success, result)
+            return
+
+        if job.attempt < self.max_attempts:
+            metrics.sends_total.inc(outcome='retry')
+            self._defer(job, self.retry_base_seconds * 2 ** job.attempt)
+        else:
+            metrics.sends_total.inc(outcome='send_failed')
+            logger.error("[DISPATCH] Giving up on %s for chat %s after %d attempts.", job.label, job.chat_id, job.attempt,
+                         extra={"user_id": job.chat_id})
+            await self._finish(job.on_failure, 'send_failed')
+
+    @staticmethod
+    async def _finish(callback, arg):
+        if callback is None:
+            return
+        result = callback(arg)
+        if asyncio.iscoroutine(result):
+            await result
+
+
+# Process-wide dispatcher, started by the scheduler in post_init.
+dispatcher = SendDispatcher()
+metrics.Gauge("mediminder_dispatch_queued", "Sends waiting in the dispatcher, including deferred ones.", dispatcher.pending)
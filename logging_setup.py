@@ -0,0 +1,141 @@
+"""Process-wide logging configuration.
+
+Records are handed to a QueueHandler and written by a QueueListener thread, so the event loop never
+waits on stream I/O. Output is the usual text line or one JSON object per record (LOG_FORMAT), with
+any `extra=` fields such as log_id and user_id included. Records logged with extra={"sample": True}
+(per-message lines on the hot paths) are rate-limited per call site.
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+from config import (
+    LOG_LEVEL, LOG_LEVELS, LOG_FORMAT, LOG_QUEUE, LOG_SAMPLE_BURST, LOG_SAMPLE_INTERVAL_SECONDS,
+)
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+# Attributes every LogRecord has; anything else on a record came from `extra=`.
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sample"}
+
+_listener = None
+
+
+class _LocalQueueHandler(logging.handlers.QueueHandler):
+    """Keeps exc_info on queued records (the listener is in-process), so formatters still see it."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: ts, level, logger, msg, any extra fields, and exc if present."""
+
+    def __init__(self, process_label=None):
+        super().__init__()
+        self.process_label = process_label
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if self.process_label:
+            entry["process"] = self.process_label
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    """Lets at most `burst` records per call site through every `interval` seconds.
+
+    Only records logged with extra={"sample": True} are limited. The first record after a window
+    that dropped some carries a `suppressed` count.
+    """
+
+    def __init__(self, burst=LOG_SAMPLE_BURST, interval=LOG_SAMPLE_INTERVAL_SECONDS):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._windows = {}  # (logger, msg template) -> [window_start, passed, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if not getattr(record, "sample", False):
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+def parse_levels(spec):
+    """Turns "apscheduler=WARNING,scheduler=DEBUG" into {"apscheduler": "WARNING", "scheduler": "DEBUG"}."""
+    levels = {}
+    for item in (spec or "").split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(process_label=None):
+    """Configures the root logger from config. Call once, at the start of each process."""
+    global _listener
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter(process_label)
+    else:
+        fmt = TEXT_FORMAT if not process_label else TEXT_FORMAT.replace("%(name)s", f"{process_label} - %(name)s")
+        formatter = logging.Formatter(fmt)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    if LOG_QUEUE:
+        handler = _LocalQueueHandler(queue.SimpleQueue())
+        _listener = logging.handlers.QueueListener(handler.queue, stream_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+    else:
+        handler = stream_handler
+    handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL.upper())
+    for name, level in parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+
+def stop_logging():
+    """Writes out anything still queued. Safe to call more than once."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
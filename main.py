@@ -9,43 +9,71 @@ from telegram.ext import (
     CallbackQueryHandler,
 )
 import config
-import database as db
+import db_async as adb
+import metrics
+from logging_setup import setup_logging
 from bot_handlers import (
     start_command,
     add_med_start, med_name_received, dosage_received,
     specific_times_received, confirmation_received, cancel_conversation,
-    my_medications_command, scan_rx_command, text_fallback,
+    my_medications_command, scan_rx_command, scan_rx_photo, text_fallback,
     MED_NAME, DOSAGE, SPECIFIC_TIMES, CONFIRMATION,
     set_phone_start, set_phone_received, PHONE_NUMBER,
-    handle_reminder_ack, health_check
+    set_timezone_start, set_timezone_received, TIMEZONE,
+    handle_reminder_ack, health_check,
+    stats_command, admin_stats_command,
+    import_document_received, export_command, broadcast_command, profile_command,
 )
-from scheduler import schedule_jobs
+from scheduler import schedule_jobs, shutdown_jobs
+from rx_ocr import rx_scanner
+from persistence import DatabasePersistence
+from broadcast import broadcaster
+from profiling import profiler, instrument_handlers
+from update_processor import PerChatUpdateProcessor
 
-# Enable logging - SET TO DEBUG FOR DETAILED OUTPUT
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.DEBUG # CHANGED TO DEBUG
-)
-logging.getLogger("httpx").setLevel(logging.WARNING)
-logging.getLogger("apscheduler").setLevel(logging.DEBUG) # Get APScheduler's own debug logs
+# Enable logging - set LOG_LEVEL=DEBUG (or LOG_LEVELS=apscheduler=DEBUG,...) for detailed output
+setup_logging()
 logger = logging.getLogger(__name__)
 
 
 async def post_init(application: Application) -> None:
     logger.info("Bot initialized. Running post_init setup...")
+    profiler.start(application.bot)
     await schedule_jobs(application) 
+    await broadcaster.resume(application.bot)
+    if adb.storage.shared:
+        # Takes over a broadcast whose instance stopped.
+        application.job_queue.run_repeating(resume_broadcast, interval=config.BROADCAST_TAKEOVER_SECONDS)
     logger.info("post_init setup complete. Scheduler jobs should be configured.")
 
 
-def main() -> None:
-    db.init_db()
-    logger.info("Database initialized by main.")
+async def resume_broadcast(context) -> None:
+    await broadcaster.resume(context.bot)
+
+
+async def post_shutdown(application: Application) -> None:
+    rx_scanner.shutdown()
+    await broadcaster.stop()
+    await shutdown_jobs(application)
 
-    application = Application.builder().token(config.TELEGRAM_TOKEN).post_init(post_init).build()
+
+def build_application(builder=None) -> Application:
+    """The bot with every handler registered. `builder` may be preconfigured, e.g. with a base_url for tests."""
+    application = (
+        (builder or Application.builder())
+        .token(config.TELEGRAM_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(config.UPDATE_CONCURRENCY))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .persistence(DatabasePersistence())
+        .build()
+    )
     logger.info("Telegram Application built.")
 
     add_med_conv_handler = ConversationHandler(
         entry_points=[MessageHandler(filters.Regex('^💊 Add Medication$'), add_med_start),
-                      CommandHandler('addmed', add_med_start)],
+                      CommandHandler('addmed', add_med_start),
+                      MessageHandler(filters.PHOTO | filters.Document.IMAGE, scan_rx_photo)],
         states={
             MED_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, med_name_received)],
             DOSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, dosage_received)],
@@ -53,7 +81,9 @@ def main() -> None:
             CONFIRMATION: [MessageHandler(filters.Regex('^(✅ Yes, Save!|✏️ No, Start Over)$'), confirmation_received)],
         },
         fallbacks=[CommandHandler('cancel', cancel_conversation), MessageHandler(filters.TEXT, text_fallback)],
-        per_message=False
+        per_message=False,
+        name="add_medication",
+        persistent=True
     )
 
     set_phone_conv_handler = ConversationHandler(
@@ -63,22 +93,69 @@ def main() -> None:
             PHONE_NUMBER: [MessageHandler(filters.TEXT & ~filters.COMMAND, set_phone_received)],
         },
         fallbacks=[CommandHandler('cancel', cancel_conversation)],
-        per_message=False
+        per_message=False,
+        name="set_phone",
+        persistent=True
+    )
+
+    set_timezone_conv_handler = ConversationHandler(
+        entry_points=[CommandHandler('timezone', set_timezone_start)],
+        states={
+            TIMEZONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, set_timezone_received)],
+        },
+        fallbacks=[CommandHandler('cancel', cancel_conversation)],
+        per_message=False,
+        name="set_timezone",
+        persistent=True
     )
 
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(set_phone_conv_handler)
+    application.add_handler(set_timezone_conv_handler)
     application.add_handler(add_med_conv_handler)
     application.add_handler(MessageHandler(filters.Regex('^📋 My Medications$'), my_medications_command))
     application.add_handler(CommandHandler("mylist", my_medications_command))
     application.add_handler(CommandHandler("scanrx", scan_rx_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("adminstats", admin_stats_command))
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r'^/import\b'),
+                                           import_document_received))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("profile", profile_command))
     application.add_handler(CallbackQueryHandler(handle_reminder_ack, pattern=r"^(ack|snooze):"))
     application.add_handler(CommandHandler("health", health_check))
+    instrument_handlers(application)
     logger.info("All handlers added to the application.")
-    
-    logger.info("Starting bot polling...")
-    application.run_polling()
-    logger.info("Bot polling stopped.")
+    return application
+
+
+def main() -> None:
+    # run_polling()/run_webhook() reuse this loop, which the PostgreSQL pool is bound to.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(adb.storage.start())
+    logger.info("Database initialized by main.")
+    metrics.start_http_server(config.METRICS_PORT, config.METRICS_ADDR)
+    application = build_application()
+
+    if config.UPDATE_MODE == "webhook":
+        webhook_url = f"{config.WEBHOOK_URL.rstrip('/')}/{config.WEBHOOK_PATH}"
+        logger.info(f"Starting webhook server on {config.WEBHOOK_LISTEN}:{config.WEBHOOK_PORT} for {webhook_url}...")
+        # PTB's webhook server rejects requests without the matching secret token header.
+        application.run_webhook(
+            listen=config.WEBHOOK_LISTEN,
+            port=config.WEBHOOK_PORT,
+            url_path=config.WEBHOOK_PATH,
+            webhook_url=webhook_url,
+            secret_token=config.WEBHOOK_SECRET_TOKEN,
+            max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+        )
+        logger.info("Webhook server stopped.")
+    else:
+        logger.info("Starting bot polling...")
+        application.run_polling()
+        logger.info("Bot polling stopped.")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,67 @@
+import logging
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEZONE = "UTC"
+
+
+def parse_minutes_of_day(times_of_day):
+    """Turns a "HH:MM, HH:MM" string into a set of minute-of-day offsets, skipping bad entries."""
+    minutes = set()
+    for time_str in (times_of_day or "").split(','):
+        time_str = time_str.strip()
+        if not time_str:
+            continue
+        try:
+            h, m = map(int, time_str.split(':'))
+        except ValueError:
+            logger.error(f"Invalid time format '{time_str}' in times_of_day '{times_of_day}'. Skipping.")
+            continue
+        if 0 <= h < 24 and 0 <= m < 60:
+            minutes.add(h * 60 + m)
+        else:
+            logger.error(f"Out of range time '{time_str}' in times_of_day '{times_of_day}'. Skipping.")
+    return minutes
+
+
+def get_zone(tz_name):
+    """The ZoneInfo for an IANA name like 'Europe/Berlin', falling back to UTC for unknown names."""
+    try:
+        return ZoneInfo(tz_name or DEFAULT_TIMEZONE)
+    except (ZoneInfoNotFoundError, ValueError):
+        logger.error(f"Unknown time zone '{tz_name}'. Using {DEFAULT_TIMEZONE}.")
+        return ZoneInfo(DEFAULT_TIMEZONE)
+
+
+def is_valid_timezone(tz_name):
+    try:
+        ZoneInfo(tz_name)
+        return True
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+
+
+def occurrences(times_of_day, tz_name, start, end):
+    """UTC datetimes of every local HH:MM in `times_of_day` with start < occurrence <= end.
+
+    Times are wall-clock times in the user's zone, so a dose stays at 08:00 local across DST changes.
+    A time skipped by a spring-forward gap fires once, shifted forward by the gap (e.g. 02:30 becomes
+    03:30); a time repeated by a fall-back fires once, at its first occurrence.
+    """
+    minutes = sorted(parse_minutes_of_day(times_of_day))
+    if not minutes:
+        return []
+    zone = get_zone(tz_name)
+    result = set()  # a shifted gap time can land on another dose time
+    day = start.astimezone(zone).date() - timedelta(days=1)  # previous day too, for offsets ahead of UTC
+    last_day = end.astimezone(zone).date()
+    while day <= last_day:
+        for minute in minutes:
+            local = datetime(day.year, day.month, day.day, minute // 60, minute % 60, tzinfo=zone)
+            at = local.astimezone(timezone.utc)
+            if start < at <= end:
+                result.add(at)
+        day += timedelta(days=1)
+    return sorted(result)
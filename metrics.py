@@ -0,0 +1,206 @@
+"""Counters, histograms and gauges served in the Prometheus text format.
+
+Metrics are plain module-level objects; record with inc()/observe() from any thread. Call
+start_http_server() once per process to expose them on http://<addr>:<port>/metrics.
+"""
+import logging
+import math
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+_registry = []
+_server = None
+
+# Seconds, from a fast SQLite statement up to a slow Telegram round trip.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Seconds late, from on time to a reminder delivered after a restart.
+DELAY_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in values]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(self.buckets) + 2)
+            entry[index] += 1
+            entry[-1] += value
+
+    def totals(self):
+        """(count, sum) of every observation across all label values."""
+        with self._lock:
+            return (sum(sum(entry[:-1]) for entry in self._values.values()),
+                    sum(entry[-1] for entry in self._values.values()))
+
+    def _samples(self):
+        with self._lock:
+            values = [(key, list(entry)) for key, entry in self._values.items()]
+        lines = []
+        for key, entry in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), entry[:-1]):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(entry[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge(_Metric):
+    """A value read from `callback()` at scrape time, e.g. a queue length."""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, callback):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def _samples(self):
+        try:
+            return [f"{self.name} {_format_value(self.callback())}"]
+        except Exception as e:
+            logger.error(f"Metrics: gauge {self.name} failed: {e}")
+            return []
+
+
+def render():
+    """All registered metrics in the Prometheus text exposition format."""
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would drown the bot's own logs.
+
+
+def start_http_server(port, addr="127.0.0.1"):
+    """Serves /metrics from a daemon thread. A port of 0 or None leaves metrics unexposed."""
+    global _server
+    if not port or _server is not None:
+        return
+    try:
+        _server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    except OSError as e:
+        logger.error(f"Metrics: could not listen on {addr}:{port}: {e}")
+        return
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"Metrics served on http://{addr}:{port}/metrics")
+
+
+def stop_http_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+
+
+# --- Metrics recorded by the bot ---
+scheduler_tick_seconds = Histogram(
+    "mediminder_scheduler_tick_seconds", "Duration of a scheduler job run.", ["job"])
+scheduler_due_reminders = Histogram(
+    "mediminder_scheduler_due_reminders", "Reminder slots that fell due in one scheduler tick.", buckets=COUNT_BUCKETS)
+sends_total = Counter(
+    "mediminder_sends_total", "Telegram send attempts by outcome (success, retry, rate_limited, blocked, send_failed).",
+    ["outcome"])
+send_latency_seconds = Histogram(
+    "mediminder_send_latency_seconds", "Duration of a successful Telegram send call.")
+delivery_delay_seconds = Histogram(
+    "mediminder_delivery_delay_seconds",
+    "Time from when a message was due (scheduled_time, snooze or escalation) to its delivery.",
+    ["kind"], buckets=DELAY_BUCKETS)
+escalations_total = Counter(
+    "mediminder_escalations_total", "Unanswered reminders escalated, by resulting status.", ["status"])
+db_call_seconds = Histogram(
+    "mediminder_db_call_seconds", "Duration of database calls run on the DB thread pool.", ["function"])
+cache_requests_total = Counter(
+    "mediminder_cache_requests_total", "Read-through cache lookups by cache and result (hit, miss).", ["cache", "result"])
+cache_evictions_total = Counter(
+    "mediminder_cache_evictions_total", "Entries dropped from a read-through cache to stay within its size.", ["cache"])
+calls_total = Counter(
+    "mediminder_calls_total", "Escalation call attempts by outcome (placed, retry, failed).", ["outcome"])
+call_latency_seconds = Histogram(
+    "mediminder_call_latency_seconds", "Duration of a successful request to the call provider.")
+rx_scans_total = Counter(
+    "mediminder_rx_scans_total", "Prescription photo scans by outcome (scanned, cached, busy, error).", ["outcome"])
+rx_scan_seconds = Histogram(
+    "mediminder_rx_scan_seconds", "Duration of a prescription OCR run, including time queued for a worker.")
@@ -0,0 +1,223 @@
+import asyncio
+import json
+import logging
+import math
+import time
+from datetime import datetime, timezone
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import database as db
+import db_async as adb
+import metrics
+from dispatcher import dispatcher, PRIORITY_ESCALATION, PRIORITY_REMINDER
+from config import (
+    OUTBOX_BATCH_SIZE, OUTBOX_POLL_SECONDS, OUTBOX_MAX_INFLIGHT, OUTBOX_RETENTION_HOURS, OUTBOX_RECOVERY_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+PRIORITIES = {'reminder': PRIORITY_REMINDER, 'escalation': PRIORITY_ESCALATION}
+
+
+def message_payload(text, buttons=None, parse_mode=None):
+    """Builds an outbox payload. `buttons` is a list of rows of (label, callback_data) pairs."""
+    payload = {'text': text}
+    if buttons:
+        payload['buttons'] = buttons
+    if parse_mode:
+        payload['parse_mode'] = parse_mode
+    return payload
+
+
+class OutboxRelay:
+    """Drains the outbox table into the send dispatcher.
+
+    Messages are written to the outbox in the same transaction as the reminders_log change that
+    caused them, so a crash can no longer lose a dose between "logged" and "sent". The relay
+    claims due rows in batches, hands them to the dispatcher and records outcomes in batches.
+    On start it puts rows a previous run left 'inflight' back to 'pending' so they are replayed; with
+    a database shared by several instances it keeps doing so for instances that stop.
+
+    Per-kind hooks registered with on_sent/on_failed run after each outcome, e.g. to mark the
+    reminder 'sent'.
+    """
+
+    def __init__(self, batch_size=OUTBOX_BATCH_SIZE, poll_seconds=OUTBOX_POLL_SECONDS,
+                 max_inflight=OUTBOX_MAX_INFLIGHT):
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.max_inflight = max_inflight
+        self.shards = None
+        self._bot = None
+        self._sent_hooks = {}
+        self._failed_hooks = {}
+        self._completed = []   # (outbox_id, status, attempts, error) waiting to be written
+        self._inflight = 0
+        self._wakeup = None
+        self._timers = {}  # whole epoch second -> TimerHandle, see wake_at()
+        self._task = None
+        self._stopping = False
+        self._recovered_at = 0.0
+
+    def on_sent(self, kind, callback):
+        """callback(row, message) runs after a message of `kind` is delivered."""
+        self._sent_hooks[kind] = callback
+
+    def on_failed(self, kind, callback):
+        """callback(row, outcome) runs when a message of `kind` is given up on ('blocked' or 'send_failed')."""
+        self._failed_hooks[kind] = callback
+
+    async def start(self, bot, shards=None):
+        if self._task is not None:
+            return
+        self._bot = bot
+        self.shards = shards
+        await self._recover()
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Outbox relay started (batches of {self.batch_size}, at most {self.max_inflight} in flight).")
+
+    async def _recover(self, shards=None):
+        if shards is None:
+            self._recovered_at = time.monotonic()
+            shards = self.shards
+        recovered = await adb.recover_outbox(shards)
+        if recovered:
+            logger.warning(f"Outbox recovery: {recovered} messages left in flight by a stopped run will be resent.")
+            self.wake()
+
+    async def take_over(self, shards):
+        """Recovers the messages a stopped worker left in flight on shards this relay has just taken over."""
+        await self._recover(shards)
+
+    def wake(self):
+        """Tells the relay new messages are waiting, instead of letting it find them on the next poll."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def wake_at(self, when):
+        """Wakes the relay at `when` (an aware datetime), for messages queued with a later next_attempt_at.
+
+        Timers are coalesced per second, so a burst of messages due at the same moment sets one timer.
+        """
+        if self._task is None:
+            return  # Not relaying in this process; whoever is will find the message on its next poll.
+        second = math.ceil(when.timestamp())
+        if second in self._timers:
+            return
+        loop = asyncio.get_running_loop()
+        delay = max(0.0, second - time.time())
+        self._timers[second] = loop.call_later(delay, self._timer_fired, second)
+
+    def _timer_fired(self, second):
+        self._timers.pop(second, None)
+        self.wake()
+
+    async def stop(self):
+        """Stops claiming new messages. Call flush() once the dispatcher has drained."""
+        if self._task is None:
+            return
+        self._stopping = True
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    async def flush(self):
+        """Writes buffered outcomes to the outbox table."""
+        if not self._completed:
+            return
+        completed, self._completed = self._completed, []
+        try:
+            await adb.complete_outbox(completed)
+        except Exception as e:
+            logger.error(f"DB Error recording {len(completed)} outbox outcomes, will retry: {e}")
+            self._completed = completed + self._completed
+
+    async def _run(self):
+        polls = 0
+        while not self._stopping:
+            try:
+                await self._drain()
+                await self.flush()
+                polls += 1
+                if polls % 3600 == 0:
+                    await adb.prune_outbox(OUTBOX_RETENTION_HOURS)
+                if adb.storage.shared and time.monotonic() - self._recovered_at >= OUTBOX_RECOVERY_SECONDS:
+                    await self._recover()
+            except Exception as e:
+                logger.error(f"Outbox relay error: {e}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _drain(self):
+        while not self._stopping:
+            capacity = min(self.batch_size, self.max_inflight - self._inflight)
+            if capacity <= 0:
+                return
+            rows = await adb.claim_outbox_batch(capacity, self.shards)
+            for row in rows:
+                self._submit(row)
+            if len(rows) < capacity:
+                return
+
+    def _submit(self, row):
+        payload = json.loads(row['payload'])
+        reply_markup = None
+        if payload.get('buttons'):
+            reply_markup = InlineKeyboardMarkup(
+                [[InlineKeyboardButton(label, callback_data=data) for label, data in button_row]
+                 for button_row in payload['buttons']]
+            )
+        job = None
+
+        async def send():
+            return await self._bot.send_message(
+                chat_id=row['chat_id'],
+                text=payload['text'],
+                reply_markup=reply_markup,
+                parse_mode=payload.get('parse_mode'),
+            )
+
+        async def on_success(message):
+            self._finish(row, 'sent', job.attempt, None)
+            delay = (datetime.now(timezone.utc) - db.from_db_timestamp(row['next_attempt_at'])).total_seconds()
+            metrics.delivery_delay_seconds.observe(max(delay, 0.0), kind=row['kind'])
+            hook = self._sent_hooks.get(row['kind'])
+            if hook:
+                await _maybe_await(hook(row, message))
+
+        async def on_failure(outcome):
+            self._finish(row, 'failed', job.attempt, outcome)
+            hook = self._failed_hooks.get(row['kind'])
+            if hook:
+                await _maybe_await(hook(row, outcome))
+
+        self._inflight += 1
+        job = dispatcher.submit(row['chat_id'], send, on_success, on_failure,
+                                PRIORITIES.get(row['kind'], PRIORITY_REMINDER),
+                                label=f"{row['kind']} outbox_id={row['id']} log_id={row['log_id']}")
+
+    def _finish(self, row, status, attempts, error):
+        self._inflight -= 1
+        self._completed.append((row['id'], status, attempts, error))
+        if self._inflight < self.max_inflight // 2:
+            self.wake()
+
+
+async def _maybe_await(result):
+    if asyncio.iscoroutine(result):
+        await result
+
+
+# Process-wide relay, started with the reminder engine.
+outbox_relay = OutboxRelay()
+metrics.Gauge("mediminder_outbox_inflight", "Outbox messages claimed by this process and not yet delivered.",
+              lambda: outbox_relay._inflight)
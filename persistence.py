@@ -0,0 +1,141 @@
+"""Application persistence in the bot's database: conversation states, user, chat and bot data.
+
+PTB hands over changed entries every PERSISTENCE_UPDATE_SECONDS. Entries whose JSON is unchanged
+since they were loaded or last saved (remembered in a bounded TTLCache) are skipped, and the rest
+are written in a single transaction, so persistence costs one write per interval rather than one
+per update. User and chat data are not loaded at startup: each user's (or chat's) row is read the
+first time an update from them is processed. Conversation states are loaded per handler at
+startup, since only conversations in progress are stored.
+"""
+import asyncio
+import json
+import logging
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import db_async as adb
+from cache import TTLCache, MISSING
+from config import PERSISTENCE_UPDATE_SECONDS, PERSISTENCE_CONVERSATION_MAX_AGE_DAYS
+
+logger = logging.getLogger(__name__)
+
+BOT_KEY = 0
+
+
+class DatabasePersistence(BasePersistence):
+    """Stores everything as JSON; values that can't be serialised are logged and not saved."""
+
+    def __init__(self, update_interval=PERSISTENCE_UPDATE_SECONDS):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._saved = TTLCache("persistence")  # (kind, key) -> JSON last loaded or saved
+        self._dirty = {}          # (kind, key) -> JSON, or None to delete
+        self._dirty_conversations = {}  # (name, JSON key) -> JSON state, or None to delete
+        self._flush_task = None
+
+    # --- Loading ---
+    async def _load(self, kind, key, target):
+        if self._saved.get((kind, key)) is not MISSING:
+            return
+        stored = await adb.load_persistence_data(kind, key)
+        self._saved.set((kind, key), stored)
+        # A non-empty target was loaded before and evicted since; what PTB holds is at least as new.
+        if stored is not None and not target and (kind, key) not in self._dirty:
+            target.update(json.loads(stored))
+
+    async def get_user_data(self):
+        return {}  # Loaded per user by refresh_user_data.
+
+    async def get_chat_data(self):
+        return {}  # Loaded per chat by refresh_chat_data.
+
+    async def get_bot_data(self):
+        bot_data = {}
+        await self._load('bot', BOT_KEY, bot_data)
+        return bot_data
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        stored = await adb.load_conversations(name, PERSISTENCE_CONVERSATION_MAX_AGE_DAYS)
+        return {tuple(json.loads(key)): json.loads(state) for key, state in stored.items()}
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._load('user', user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._load('chat', chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass  # Loaded once at startup; only this process writes it.
+
+    # --- Saving ---
+    def _mark(self, kind, key, data):
+        try:
+            value = json.dumps(data, sort_keys=True) if data else None
+        except (TypeError, ValueError) as e:
+            logger.error(f"Persistence: {kind} data of {key} is not JSON serialisable, not saving it: {e}")
+            return
+        if self._saved.get((kind, key)) == value:
+            self._dirty.pop((kind, key), None)
+            return
+        self._dirty[(kind, key)] = value
+        self._schedule_flush()
+
+    async def update_user_data(self, user_id, data):
+        self._mark('user', user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._mark('chat', chat_id, data)
+
+    async def update_bot_data(self, data):
+        self._mark('bot', BOT_KEY, data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._mark('user', user_id, None)
+
+    async def drop_chat_data(self, chat_id):
+        self._mark('chat', chat_id, None)
+
+    async def update_conversation(self, name, key, new_state):
+        self._dirty_conversations[(name, json.dumps(list(key)))] = (
+            None if new_state is None else json.dumps(new_state)
+        )
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        # PTB calls every update_* of one persistence run in the same loop iteration; the task runs
+        # after all of them and writes the whole batch.
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._write())
+
+    async def _write(self):
+        if not self._dirty and not self._dirty_conversations:
+            return
+        dirty, self._dirty = self._dirty, {}
+        conversations, self._dirty_conversations = self._dirty_conversations, {}
+        try:
+            await adb.save_persistence(
+                [(kind, key, value) for (kind, key), value in dirty.items()],
+                [(name, key, state) for (name, key), state in conversations.items()],
+            )
+        except Exception as e:
+            logger.error(f"Persistence: error saving {len(dirty) + len(conversations)} entries, will retry: {e}")
+            # Newer changes made meanwhile win over the ones that failed to save.
+            self._dirty = {**dirty, **self._dirty}
+            self._dirty_conversations = {**conversations, **self._dirty_conversations}
+            return
+        for entry, value in dirty.items():
+            self._saved.set(entry, value)
+
+    async def flush(self):
+        """Called by the Application on shutdown, after its final update_persistence()."""
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._write()
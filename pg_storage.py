@@ -0,0 +1,1015 @@
+"""PostgreSQL storage backend (DB_BACKEND=postgres), which several bot instances can share.
+
+Queries go over an asyncpg connection pool; asyncpg prepares every statement server-side and keeps
+DB_STATEMENT_CACHE_SIZE of them per connection, so the hot queries are parsed and planned once.
+Due reminders and outbox messages are claimed with SELECT ... FOR UPDATE SKIP LOCKED, so instances
+polling at the same moment split the work instead of queueing or sending anything twice.
+
+Each instance holds a session advisory lock on a random instance id and stamps the outbox rows it
+claims with it. Recovery only puts back rows whose instance's lock is gone, i.e. whose process died,
+and runs periodically rather than only at startup (see OutboxRelay). The connection holding the lock
+is checked every PG_SESSION_CHECK_SECONDS; while it is lost, the instance claims no outbox rows, and
+it reconnects and takes the lock again (the same id if nobody has recovered it yet). The session also
+LISTENs for reminders materialised by other instances, so a new medication wakes every reminder job. The schema mirrors the SQLite
+one, and timestamps are read back as the same canonical UTC text, so callers can't tell the two apart.
+"""
+import asyncio
+import functools
+import json
+import logging
+import random
+import time
+from datetime import datetime, timezone, timedelta
+
+import asyncpg
+
+import metrics
+from cache import user_profiles, active_medications
+from config import (
+    DATABASE_URL, PG_POOL_MIN_SIZE, PG_POOL_MAX_SIZE, PG_CLAIM_BATCH_SIZE, PG_SESSION_CHECK_SECONDS,
+    DB_STATEMENT_CACHE_SIZE, MATERIALIZE_HORIZON_DAYS,
+)
+from database import (
+    MESSAGE_KINDS, MATERIALIZE_BATCH_SIZE, STATUS_TRANSITIONS_FROM, to_db_timestamp, from_db_timestamp,
+    escalation_deadline, _notify_materialized,
+)
+from materializer import occurrences
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# Advisory lock keys, (class, id) pairs. Instances and broadcasts use their own id as the second key.
+LOCK_CLASS = 0x6d6d0001
+LOCK_MIGRATIONS = 1
+LOCK_HORIZON = 2
+INSTANCE_LOCK_CLASS = 0x6d6d0002
+BROADCAST_LOCK_CLASS = 0x6d6d0003
+# NOTIFY channel carrying the earliest scheduled_time of newly materialised reminders.
+MATERIALIZED_CHANNEL = 'mediminder_materialized'
+
+# Schema migrations, applied in order; schema_version records how many have run.
+# Append new steps to the end; never edit a step that has shipped. Foreign keys are left out, as
+# SQLite doesn't enforce them either: a user may add a medication before /start.
+PG_MIGRATIONS = [
+    # 1: everything up to SQLite schema version 8
+    [
+        """CREATE TABLE users (
+            telegram_id BIGINT PRIMARY KEY,
+            phone_number TEXT,
+            timezone TEXT NOT NULL DEFAULT 'UTC',
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )""",
+        """CREATE TABLE medications (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            user_telegram_id BIGINT NOT NULL,
+            med_name TEXT NOT NULL,
+            dosage TEXT,
+            schedule_type TEXT DEFAULT 'daily',
+            times_of_day TEXT NOT NULL,
+            is_active BOOLEAN NOT NULL DEFAULT TRUE,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )""",
+        "CREATE INDEX idx_medications_user_active ON medications (user_telegram_id, is_active)",
+        """CREATE TABLE reminders_log (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            medication_id BIGINT NOT NULL,
+            user_telegram_id BIGINT NOT NULL,
+            scheduled_time TIMESTAMPTZ NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            snooze_count INTEGER NOT NULL DEFAULT 0,
+            acknowledged_at TIMESTAMPTZ,
+            call_triggered_at TIMESTAMPTZ,
+            escalate_at TIMESTAMPTZ,
+            UNIQUE (medication_id, scheduled_time)
+        )""",
+        "CREATE INDEX idx_reminders_log_pending ON reminders_log (scheduled_time) WHERE status = 'pending'",
+        "CREATE INDEX idx_reminders_log_escalate_at ON reminders_log (escalate_at) WHERE status = 'sent'",
+        "CREATE INDEX idx_reminders_log_user ON reminders_log (user_telegram_id)",
+        """CREATE TABLE outbox (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            kind TEXT NOT NULL,
+            dedup_key TEXT NOT NULL UNIQUE,
+            chat_id BIGINT NOT NULL,
+            log_id BIGINT,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            sent_at TIMESTAMPTZ,
+            last_error TEXT,
+            claimed_by INTEGER -- instance id of the relay that has it 'inflight'
+        )""",
+        "CREATE INDEX idx_outbox_pending ON outbox (next_attempt_at, id) WHERE status = 'pending'",
+        "CREATE INDEX idx_outbox_inflight ON outbox (claimed_by) WHERE status = 'inflight'",
+        "CREATE INDEX idx_outbox_created ON outbox (created_at)",
+        """CREATE TABLE scheduler_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )""",
+        """CREATE TABLE adherence_daily (
+            user_telegram_id BIGINT NOT NULL,
+            day DATE NOT NULL,
+            medication_id BIGINT NOT NULL,
+            scheduled INTEGER NOT NULL DEFAULT 0,
+            acknowledged INTEGER NOT NULL DEFAULT 0,
+            snoozed INTEGER NOT NULL DEFAULT 0,
+            missed INTEGER NOT NULL DEFAULT 0,
+            escalated INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_telegram_id, day, medication_id)
+        )""",
+        """CREATE TABLE adherence_daily_total (
+            day DATE PRIMARY KEY,
+            scheduled INTEGER NOT NULL DEFAULT 0,
+            acknowledged INTEGER NOT NULL DEFAULT 0,
+            snoozed INTEGER NOT NULL DEFAULT 0,
+            missed INTEGER NOT NULL DEFAULT 0,
+            escalated INTEGER NOT NULL DEFAULT 0
+        )""",
+        # The same counting rules as the SQLite trigger, applied once per statement to the rows it changed,
+        # so a claim of a thousand reminders touches each day's total once.
+        """CREATE FUNCTION reminders_log_adherence() RETURNS trigger LANGUAGE plpgsql AS $$
+           BEGIN
+             WITH changes AS (
+               SELECT n.user_telegram_id, (n.scheduled_time AT TIME ZONE 'UTC')::date AS day, n.medication_id,
+                      (o.status = 'pending')::int AS scheduled,
+                      (n.status = 'acknowledged')::int - (o.status = 'acknowledged')::int AS acknowledged,
+                      (n.status = 'snoozed')::int AS snoozed,
+                      (n.status = 'missed')::int - (o.status = 'missed')::int AS missed,
+                      (n.status = 'call_triggered')::int AS escalated
+               FROM old_rows o JOIN new_rows n ON n.id = o.id
+               WHERE o.status IS DISTINCT FROM n.status
+                 AND (o.status IN ('pending', 'acknowledged', 'missed')
+                      OR n.status IN ('acknowledged', 'snoozed', 'missed', 'call_triggered'))
+             ), per_medication AS (
+               INSERT INTO adherence_daily AS a
+                 (user_telegram_id, day, medication_id, scheduled, acknowledged, snoozed, missed, escalated)
+               SELECT user_telegram_id, day, medication_id, SUM(scheduled), SUM(acknowledged), SUM(snoozed),
+                      SUM(missed), SUM(escalated)
+               FROM changes GROUP BY user_telegram_id, day, medication_id
+               ON CONFLICT (user_telegram_id, day, medication_id) DO UPDATE SET
+                 scheduled = a.scheduled + excluded.scheduled,
+                 acknowledged = a.acknowledged + excluded.acknowledged,
+                 snoozed = a.snoozed + excluded.snoozed,
+                 missed = a.missed + excluded.missed,
+                 escalated = a.escalated + excluded.escalated
+             )
+             INSERT INTO adherence_daily_total AS t (day, scheduled, acknowledged, snoozed, missed, escalated)
+             SELECT day, SUM(scheduled), SUM(acknowledged), SUM(snoozed), SUM(missed), SUM(escalated)
+             FROM changes GROUP BY day
+             ON CONFLICT (day) DO UPDATE SET
+               scheduled = t.scheduled + excluded.scheduled,
+               acknowledged = t.acknowledged + excluded.acknowledged,
+               snoozed = t.snoozed + excluded.snoozed,
+               missed = t.missed + excluded.missed,
+               escalated = t.escalated + excluded.escalated;
+             RETURN NULL;
+           END $$""",
+        """CREATE TRIGGER trg_reminders_log_adherence AFTER UPDATE ON reminders_log
+           REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+           FOR EACH STATEMENT EXECUTE FUNCTION reminders_log_adherence()""",
+        """CREATE TABLE persistence_data (
+            kind TEXT NOT NULL,
+            key BIGINT NOT NULL,
+            data TEXT NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (kind, key)
+        )""",
+        """CREATE TABLE conversation_states (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (name, key)
+        )""",
+        """CREATE TABLE broadcasts (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            created_by BIGINT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            finished_at TIMESTAMPTZ,
+            total INTEGER NOT NULL DEFAULT 0,
+            cursor BIGINT NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0
+        )""",
+        # At most one running broadcast, across instances.
+        "CREATE UNIQUE INDEX idx_broadcasts_running ON broadcasts (status) WHERE status = 'running'",
+    ],
+]
+
+REMINDER_COLUMNS = ("rl.id AS log_id, rl.medication_id, m.med_name, m.dosage, rl.user_telegram_id, "
+                    "rl.scheduled_time, rl.snooze_count")
+
+
+def _encode_timestamp(value):
+    return to_db_timestamp(value) if isinstance(value, datetime) else value
+
+
+def _decode_timestamp(value):
+    # '2026-01-31 08:00:00+00' or with fractional seconds; the session time zone is UTC.
+    return value[:19]
+
+
+async def _init_connection(conn):
+    """Timestamps in and out as canonical UTC text, like the SQLite columns."""
+    await conn.set_type_codec('timestamptz', schema='pg_catalog', encoder=_encode_timestamp,
+                              decoder=_decode_timestamp, format='text')
+
+
+def _rowcount(status):
+    """Rows affected, from a command status such as 'INSERT 0 12' or 'UPDATE 3'."""
+    return int(status.rsplit(" ", 1)[-1])
+
+
+def _shard_filter_sql(shards, column, first_param):
+    if shards is None:
+        return "", ()
+    shard_count, owned = shards
+    if not owned:
+        return " AND FALSE", ()
+    return (f" AND abs({column}) % ${first_param} = ANY(${first_param + 1}::int[])",
+            (shard_count, sorted(owned)))
+
+
+def _occurrence_rows(meds, start, end):
+    """(medication ids, user ids, scheduled times, escalation deadlines, earliest) for the occurrences in (start, end]."""
+    columns = ([], [], [], [])
+    earliest = None
+    for med in meds:
+        for at in occurrences(med['times_of_day'], med['timezone'], start, end):
+            columns[0].append(med['id'])
+            columns[1].append(med['user_telegram_id'])
+            columns[2].append(to_db_timestamp(at))
+            columns[3].append(to_db_timestamp(escalation_deadline(at)))
+            if earliest is None or at < earliest:
+                earliest = at
+    return (*columns, earliest)
+
+
+# STATUS_TRANSITIONS_FROM as two parallel arrays, new status and current status, for unnest().
+_STATUS_TRANSITIONS = (
+    [status for status, allowed in STATUS_TRANSITIONS_FROM.items() for _ in allowed],
+    [current for allowed in STATUS_TRANSITIONS_FROM.values() for current in allowed],
+)
+
+
+async def _notify_instances(conn, earliest):
+    """Tells every instance's reminder job about new reminders, once the caller's transaction commits."""
+    if earliest is not None:
+        await conn.execute("SELECT pg_notify($1, $2)", MATERIALIZED_CHANNEL, to_db_timestamp(earliest))
+
+
+def _timed(method):
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await method(self, *args, **kwargs)
+        finally:
+            metrics.db_call_seconds.observe(time.perf_counter() - start, function=method.__name__)
+    return wrapper
+
+
+class PostgresStorage(Storage):
+    shared = True
+
+    def __init__(self, dsn=DATABASE_URL, min_size=PG_POOL_MIN_SIZE, max_size=PG_POOL_MAX_SIZE):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.instance_id = None
+        self._pool = None
+        self._session = None  # holds this instance's advisory locks
+        self._session_ok = False  # False while the session is lost: this instance's lock may be gone
+        self._session_lock = asyncio.Lock()
+        self._watcher = None
+        self._start_lock = asyncio.Lock()
+        self._broadcasts = set()  # broadcast ids whose lock this instance holds
+
+    async def start(self):
+        """Opens the pool, migrates the schema and takes an instance id. Called on first use."""
+        async with self._start_lock:
+            if self._pool is not None:
+                return
+            pool = await asyncpg.create_pool(
+                self.dsn, min_size=self.min_size, max_size=self.max_size,
+                statement_cache_size=DB_STATEMENT_CACHE_SIZE, init=_init_connection,
+                server_settings={'timezone': 'UTC', 'application_name': 'mediminder'},
+            )
+            async with pool.acquire() as conn:
+                await self._migrate(conn)
+            await self._open_session()
+            self._pool = pool
+            self._watcher = asyncio.create_task(self._watch_session())
+            logger.info(f"PostgreSQL pool opened ({self.min_size}-{self.max_size} connections), "
+                        f"instance id {self.instance_id}.")
+
+    async def close(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+        self._session_ok = False
+        if self._session is not None:
+            session, self._session = self._session, None
+            await session.close()  # releases the instance and broadcast locks
+        self._broadcasts.clear()
+        logger.info("PostgreSQL pool closed.")
+
+    async def _open_session(self):
+        """Connects the session and locks an instance id: the previous one if it is still free."""
+        session = await asyncpg.connect(self.dsn, server_settings={'application_name': 'mediminder-session'})
+        instance_id = self.instance_id
+        while instance_id is None or not await session.fetchval(
+                "SELECT pg_try_advisory_lock($1, $2)", INSTANCE_LOCK_CLASS, instance_id):
+            instance_id = random.randint(1, 2**31 - 1)
+        for broadcast_id in list(self._broadcasts):
+            if not await session.fetchval("SELECT pg_try_advisory_lock($1, $2)", BROADCAST_LOCK_CLASS, broadcast_id):
+                self._broadcasts.discard(broadcast_id)
+                logger.error(f"Broadcast {broadcast_id} was taken over by another instance while the session was lost.")
+        session.add_termination_listener(self._session_terminated)
+        await session.add_listener(MATERIALIZED_CHANNEL, self._on_materialized)
+        if self.instance_id is not None and instance_id != self.instance_id:
+            logger.warning(f"Instance id {self.instance_id} was taken; now {instance_id}.")
+        self._session, self.instance_id, self._session_ok = session, instance_id, True
+
+    def _session_terminated(self, session):
+        if session is self._session and self._session_ok:
+            self._session_ok = False
+            logger.error("PostgreSQL session closed; not claiming outbox messages until it is back.")
+
+    def _on_materialized(self, session, pid, channel, payload):
+        _notify_materialized(from_db_timestamp(payload))
+
+    async def _watch_session(self):
+        while True:
+            await asyncio.sleep(PG_SESSION_CHECK_SECONDS)
+            async with self._session_lock:
+                if self._session_ok:
+                    try:
+                        await self._session.fetchval("SELECT 1", timeout=PG_SESSION_CHECK_SECONDS)
+                        continue
+                    except Exception as e:
+                        self._session_ok = False
+                        logger.error(f"PostgreSQL session check failed; not claiming outbox messages: {e}")
+                self._session.terminate()
+                try:
+                    await self._open_session()
+                except Exception as e:
+                    logger.error(f"Could not reconnect the PostgreSQL session, will retry: {e}")
+                    continue
+                logger.warning(f"PostgreSQL session reconnected with instance id {self.instance_id}.")
+
+    async def _migrate(self, conn):
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1, $2)", LOCK_CLASS, LOCK_MIGRATIONS)
+            await conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+            version = await conn.fetchval("SELECT version FROM schema_version")
+            if version is None:
+                version = 0
+                await conn.execute("INSERT INTO schema_version (version) VALUES (0)")
+            for target, statements in enumerate(PG_MIGRATIONS[version:], start=version + 1):
+                for statement in statements:
+                    await conn.execute(statement)
+                await conn.execute("UPDATE schema_version SET version = $1", target)
+                logger.info(f"PostgreSQL database migrated to schema version {target}.")
+
+    async def _connection_pool(self):
+        if self._pool is None:
+            await self.start()
+        return self._pool
+
+    async def _fetch(self, query, *args):
+        return await (await self._connection_pool()).fetch(query, *args)
+
+    async def _fetchrow(self, query, *args):
+        return await (await self._connection_pool()).fetchrow(query, *args)
+
+    async def _execute(self, query, *args):
+        return await (await self._connection_pool()).execute(query, *args)
+
+    # --- Users ---
+    @_timed
+    async def add_user(self, telegram_id, phone_number=None):
+        try:
+            await self._execute(
+                "INSERT INTO users (telegram_id, phone_number) VALUES ($1, $2) ON CONFLICT (telegram_id) "
+                "DO UPDATE SET phone_number = COALESCE(excluded.phone_number, users.phone_number)",
+                telegram_id, phone_number
+            )
+        except asyncpg.PostgresError as e:
+            logger.error(f"DB Error adding user {telegram_id}: {e}")
+            return False
+        user_profiles.invalidate(telegram_id)
+        logger.info(f"User {telegram_id} added or updated.")
+        return True
+
+    @_timed
+    async def get_user_profile(self, telegram_id):
+        return await self._fetchrow(
+            "SELECT telegram_id, phone_number, timezone FROM users WHERE telegram_id = $1", telegram_id
+        )
+
+    @_timed
+    async def get_user_profiles(self, telegram_ids):
+        rows = await self._fetch(
+            "SELECT telegram_id, phone_number, timezone FROM users WHERE telegram_id = ANY($1::bigint[])",
+            list(telegram_ids)
+        )
+        return {row['telegram_id']: row for row in rows}
+
+    @_timed
+    async def set_user_timezone(self, telegram_id, tz_name):
+        pool = await self._connection_pool()
+        try:
+            async with pool.acquire() as conn, conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock_shared($1, $2)", LOCK_CLASS, LOCK_HORIZON)
+                await conn.execute(
+                    "INSERT INTO users (telegram_id, timezone) VALUES ($1, $2) "
+                    "ON CONFLICT (telegram_id) DO UPDATE SET timezone = excluded.timezone",
+                    telegram_id, tz_name
+                )
+                now = datetime.now(timezone.utc)
+                await conn.execute(
+                    """DELETE FROM reminders_log
+                       WHERE status = 'pending' AND scheduled_time > $1 AND user_telegram_id = $2""",
+                    now, telegram_id
+                )
+                _, earliest = await self._materialize(
+                    conn, now, await self._materialized_until(conn), "m.user_telegram_id = $1", telegram_id
+                )
+                await _notify_instances(conn, earliest)
+        except asyncpg.PostgresError as e:
+            logger.error(f"DB Error setting time zone for user {telegram_id}: {e}")
+            return False
+        user_profiles.invalidate(telegram_id)
+        logger.info(f"User {telegram_id} time zone set to {tz_name}.")
+        _notify_materialized(earliest)
+        return True
+
+    @_timed
+    async def mark_user_inactive(self, user_telegram_id):
+        pool = await self._connection_pool()
+        try:
+            async with pool.acquire() as conn, conn.transaction():
+                await conn.execute("UPDATE medications SET is_active = FALSE WHERE user_telegram_id = $1",
+                                   user_telegram_id)
+                await conn.execute("DELETE FROM reminders_log WHERE user_telegram_id = $1 AND status = 'pending'",
+                                   user_telegram_id)
+        except asyncpg.PostgresError as e:
+            logger.error(f"Error marking user {user_telegram_id} as inactive: {e}")
+            return
+        active_medications.invalidate(user_telegram_id)
+        user_profiles.invalidate(user_telegram_id)
+        logger.info(f"User {user_telegram_id} marked as inactive (all medications disabled).")
+
+    # --- Medications ---
+    @_timed
+    async def add_medication_db(self, user_telegram_id, med_name, dosage, times_of_day):
+        pool = await self._connection_pool()
+        try:
+            async with pool.acquire() as conn, conn.transaction():
+                # Shared with other writers, exclusive with extend_reminder_horizon: the horizon read
+                # here is the one this medication gets materialised up to.
+                await conn.execute("SELECT pg_advisory_xact_lock_shared($1, $2)", LOCK_CLASS, LOCK_HORIZON)
+                med_id = await conn.fetchval(
+                    "INSERT INTO medications (user_telegram_id, med_name, dosage, times_of_day) "
+                    "VALUES ($1, $2, $3, $4) RETURNING id",
+                    user_telegram_id, med_name, dosage, times_of_day
+                )
+                _, earliest = await self._materialize(
+                    conn, datetime.now(timezone.utc), await self._materialized_until(conn), "m.id = $1", med_id
+                )
+                await _notify_instances(conn, earliest)
+        except asyncpg.PostgresError as e:
+            logger.error(f"DB Error adding medication for user {user_telegram_id}: {e}")
+            return None
+        active_medications.invalidate(user_telegram_id)
+        logger.info(f"Medication {med_name} (ID: {med_id}) added for user {user_telegram_id}.")
+        _notify_materialized(earliest)
+        return med_id
+
+    @_timed
+    async def get_active_medications_for_user(self, user_telegram_id):
+        return await self._fetch(
+            "SELECT id, med_name, dosage, times_of_day FROM medications WHERE user_telegram_id = $1 AND is_active",
+            user_telegram_id
+        )
+
+    @_timed
+    async def get_medication(self, med_id):
+        return await self._fetchrow(
+            "SELECT id, user_telegram_id, med_name, dosage, times_of_day, is_active FROM medications WHERE id = $1",
+            med_id
+        )
+
+    # --- Reminder materialisation ---
+    async def _materialized_until(self, conn):
+        value = await conn.fetchval("SELECT value FROM scheduler_state WHERE key = 'materialized_until'")
+        if value:
+            return datetime.fromisoformat(value)
+        return datetime.now(timezone.utc) + timedelta(days=MATERIALIZE_HORIZON_DAYS)
+
+    async def _materialize(self, conn, start, end, where_sql, *params):
+        """Inserts the occurrences in (start, end] of the active medications matching `where_sql`.
+
+        Part of the caller's transaction. Returns (rows inserted, earliest occurrence or None).
+        """
+        if end <= start:
+            return 0, None
+        meds = await conn.fetch(
+            f"""SELECT m.id, m.user_telegram_id, m.times_of_day, COALESCE(u.timezone, 'UTC') AS timezone
+               FROM medications m LEFT JOIN users u ON u.telegram_id = m.user_telegram_id
+               WHERE m.is_active AND {where_sql}""",
+            *params
+        )
+        # Expanding every medication is pure Python; off the loop, so handlers keep running meanwhile.
+        med_ids, user_ids, times, deadlines, earliest = await asyncio.to_thread(_occurrence_rows, meds, start, end)
+        inserted = 0
+        for offset in range(0, len(med_ids), MATERIALIZE_BATCH_SIZE):
+            batch = slice(offset, offset + MATERIALIZE_BATCH_SIZE)
+            status = await conn.execute(
+                """INSERT INTO reminders_log (medication_id, user_telegram_id, scheduled_time, status, escalate_at)
+                   SELECT m, u, s::timestamptz, 'pending', e::timestamptz
+                   FROM unnest($1::bigint[], $2::bigint[], $3::text[], $4::text[]) AS t(m, u, s, e)
+                   ON CONFLICT (medication_id, scheduled_time) DO NOTHING""",
+                med_ids[batch], user_ids[batch], times[batch], deadlines[batch]
+            )
+            inserted += _rowcount(status)
+        return inserted, earliest
+
+    @_timed
+    async def extend_reminder_horizon(self, horizon_days=MATERIALIZE_HORIZON_DAYS, step=timedelta(days=1)):
+        """Materialises up to now + horizon_days, a `step` per transaction, one instance at a time."""
+        pool = await self._connection_pool()
+        now = datetime.now(timezone.utc)
+        target = now + timedelta(days=horizon_days)
+        inserted = 0
+        async with pool.acquire() as conn:
+            while True:
+                async with conn.transaction():
+                    await conn.execute("SELECT pg_advisory_xact_lock($1, $2)", LOCK_CLASS, LOCK_HORIZON)
+                    value = await conn.fetchval("SELECT value FROM scheduler_state WHERE key = 'materialized_until'")
+                    start = max(datetime.fromisoformat(value), now) if value else now
+                    if start >= target:
+                        break
+                    end = min(start + step, target)
+                    count, _ = await self._materialize(conn, start, end, "TRUE")
+                    await conn.execute(
+                        "INSERT INTO scheduler_state (key, value) VALUES ('materialized_until', $1) "
+                        "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                        end.isoformat()
+                    )
+                inserted += count
+        if inserted:
+            logger.info(f"Materialised {inserted} reminders up to {target}.")
+        return inserted
+
+    # --- Reminders ---
+    @_timed
+    async def get_due_reminders(self, due_by, shards=None):
+        shard_sql, shard_params = _shard_filter_sql(shards, "rl.user_telegram_id", 2)
+        return await self._fetch(
+            f"""SELECT {REMINDER_COLUMNS}
+               FROM reminders_log rl JOIN medications m ON rl.medication_id = m.id
+               WHERE rl.status = 'pending' AND rl.scheduled_time <= $1{shard_sql}
+               ORDER BY rl.scheduled_time""",
+            due_by, *shard_params
+        )
+
+    @_timed
+    async def claim_due_reminders(self, due_by, build_payload, shards=None):
+        """Claims due reminders in batches and queues their messages, each batch in one transaction.
+
+        Rows another instance has locked are skipped rather than waited for, so instances ticking at the
+        same moment share the slot. Returns the number this instance queued.
+        """
+        pool = await self._connection_pool()
+        shard_sql, shard_params = _shard_filter_sql(shards, "user_telegram_id", 3)
+        queued = 0
+        async with pool.acquire() as conn:
+            while True:
+                async with conn.transaction():
+                    rows = await conn.fetch(
+                        f"""WITH due AS (
+                               SELECT id FROM reminders_log
+                               WHERE status = 'pending' AND scheduled_time <= $1{shard_sql}
+                               ORDER BY scheduled_time LIMIT $2
+                               FOR UPDATE SKIP LOCKED
+                           )
+                           UPDATE reminders_log rl SET status = 'queued'
+                           FROM due, medications m
+                           WHERE rl.id = due.id AND m.id = rl.medication_id
+                           RETURNING {REMINDER_COLUMNS}""",
+                        due_by, PG_CLAIM_BATCH_SIZE, *shard_params
+                    )
+                    await self._enqueue_reminders(conn, rows, build_payload)
+                queued += len(rows)
+                if len(rows) < PG_CLAIM_BATCH_SIZE:
+                    return queued
+
+    async def _enqueue_reminders(self, conn, reminders, build_payload):
+        if not reminders:
+            return
+        await conn.execute(
+            """INSERT INTO outbox (kind, dedup_key, chat_id, log_id, payload, next_attempt_at)
+               SELECT 'reminder', 'reminder:' || l, c, l, p, t::timestamptz
+               FROM unnest($1::bigint[], $2::bigint[], $3::text[], $4::text[]) AS x(l, c, p, t)
+               ON CONFLICT (dedup_key) DO NOTHING""",
+            [r['log_id'] for r in reminders], [r['user_telegram_id'] for r in reminders],
+            [json.dumps(build_payload(r['log_id'], r)) for r in reminders], [r['scheduled_time'] for r in reminders]
+        )
+
+    @_timed
+    async def get_next_due_time(self, shards=None):
+        shard_sql, shard_params = _shard_filter_sql(shards, "user_telegram_id", 1)
+        row = await self._fetchrow(
+            f"SELECT MIN(scheduled_time) FROM reminders_log WHERE status = 'pending'{shard_sql}", *shard_params
+        )
+        return from_db_timestamp(row[0]) if row[0] else None
+
+    @_timed
+    async def queue_reminders(self, reminders, build_payload):
+        by_id = {reminder['log_id']: reminder for reminder in reminders}
+        if not by_id:
+            return 0
+        pool = await self._connection_pool()
+        async with pool.acquire() as conn, conn.transaction():
+            ids = await conn.fetch(
+                "UPDATE reminders_log SET status = 'queued' WHERE id = ANY($1::bigint[]) AND status = 'pending' "
+                "RETURNING id",
+                list(by_id)
+            )
+            # Those not updated were handled elsewhere since they were read.
+            await self._enqueue_reminders(conn, [by_id[row['id']] for row in ids], build_payload)
+        return len(ids)
+
+    @_timed
+    async def mark_reminders_missed(self, log_ids):
+        await self._execute(
+            "UPDATE reminders_log SET status = 'missed' WHERE id = ANY($1::bigint[]) AND status = 'pending'",
+            list(log_ids)
+        )
+
+    @_timed
+    async def get_reminders_to_escalate(self, due_by, shards=None):
+        shard_sql, shard_params = _shard_filter_sql(shards, "rl.user_telegram_id", 2)
+        return await self._fetch(
+            f"""SELECT rl.id AS log_id, m.med_name, rl.user_telegram_id, rl.scheduled_time
+               FROM reminders_log rl JOIN medications m ON rl.medication_id = m.id
+               WHERE rl.status = 'sent' AND rl.escalate_at <= $1{shard_sql}""",
+            due_by, *shard_params
+        )
+
+    @_timed
+    async def get_escalation_deadlines(self, shards=None):
+        shard_sql, shard_params = _shard_filter_sql(shards, "user_telegram_id", 1)
+        rows = await self._fetch(
+            f"SELECT escalate_at FROM reminders_log WHERE status = 'sent' AND escalate_at IS NOT NULL{shard_sql}",
+            *shard_params
+        )
+        return [from_db_timestamp(row[0]) for row in rows]
+
+    @_timed
+    async def get_next_escalation_time(self, shards=None):
+        shard_sql, shard_params = _shard_filter_sql(shards, "user_telegram_id", 1)
+        row = await self._fetchrow(
+            f"SELECT MIN(escalate_at) FROM reminders_log WHERE status = 'sent'{shard_sql}", *shard_params
+        )
+        return from_db_timestamp(row[0]) if row[0] else None
+
+    @_timed
+    async def escalate_reminders(self, escalations):
+        """As database.escalate_reminders; when instances race, only the one that moves the row on queues."""
+        decisions = {log_id: (new_status, chat_id, payload, call)
+                     for log_id, new_status, chat_id, payload, call in escalations}
+        if not decisions:
+            return
+        pool = await self._connection_pool()
+        async with pool.acquire() as conn, conn.transaction():
+            escalated = await conn.fetch(
+                """UPDATE reminders_log rl SET status = x.status
+                   FROM unnest($1::bigint[], $2::text[]) AS x(id, status)
+                   WHERE rl.id = x.id AND rl.status = 'sent'
+                   RETURNING rl.id""",
+                list(decisions), [decision[0] for decision in decisions.values()]
+            )
+            messages = []
+            for row in escalated:
+                _, chat_id, payload, call = decisions[row['id']]
+                messages.append(('escalation', row['id'], chat_id, json.dumps(payload)))
+                if call:
+                    messages.append(('call', row['id'], chat_id, json.dumps(call)))
+            if messages:
+                await conn.execute(
+                    """INSERT INTO outbox (kind, dedup_key, chat_id, log_id, payload, next_attempt_at)
+                       SELECT k, k || ':' || l, c, l, p, now()
+                       FROM unnest($1::text[], $2::bigint[], $3::bigint[], $4::text[]) AS x(k, l, c, p)
+                       ON CONFLICT (dedup_key) DO NOTHING""",
+                    *(list(column) for column in zip(*messages))
+                )
+
+    @_timed
+    async def snooze_reminder(self, log_id, refire_at, max_snoozes, build_payload):
+        pool = await self._connection_pool()
+        async with pool.acquire() as conn, conn.transaction():
+            row = await conn.fetchrow(
+                """UPDATE reminders_log
+                   SET status = 'snoozed', snooze_count = snooze_count + 1, escalate_at = $1
+                   WHERE id = $2 AND status IN ('pending', 'queued', 'sent') AND snooze_count < $3
+                   RETURNING medication_id, user_telegram_id, snooze_count""",
+                escalation_deadline(refire_at), log_id, max_snoozes
+            )
+            if row is None:
+                return None
+            med = await conn.fetchrow("SELECT med_name, dosage FROM medications WHERE id = $1", row['medication_id'])
+            await conn.execute(
+                """INSERT INTO outbox (kind, dedup_key, chat_id, log_id, payload, next_attempt_at)
+                   VALUES ('reminder', $1, $2, $3, $4, $5) ON CONFLICT (dedup_key) DO NOTHING""",
+                f"snooze:{log_id}:{row['snooze_count']}", row['user_telegram_id'], log_id,
+                json.dumps(build_payload(log_id, med, row['snooze_count'])), refire_at
+            )
+        return row['snooze_count']
+
+    @_timed
+    async def get_reminder_log(self, log_id):
+        return await self._fetchrow(
+            "SELECT id, medication_id, user_telegram_id, scheduled_time, status, snooze_count "
+            "FROM reminders_log WHERE id = $1",
+            log_id
+        )
+
+    @_timed
+    async def update_reminder_log_status(self, log_id, status, acknowledged_at=None, snooze_count_increment=False):
+        try:
+            await self._execute(
+                """UPDATE reminders_log
+                   SET status = $1, acknowledged_at = COALESCE($2, acknowledged_at), snooze_count = snooze_count + $3
+                   WHERE id = $4""",
+                status, acknowledged_at, int(snooze_count_increment), log_id
+            )
+            logger.info(f"Reminder log ID {log_id} updated to status {status}.")
+        except asyncpg.PostgresError as e:
+            logger.error(f"DB Error updating reminder log {log_id}: {e}")
+
+    @_timed
+    async def update_reminder_statuses(self, updates):
+        if not updates:
+            return
+        log_ids, statuses, acknowledged, increments = (list(column) for column in zip(*updates))
+        await self._execute(
+            """UPDATE reminders_log rl
+               SET status = x.status, acknowledged_at = COALESCE(x.acknowledged_at::timestamptz, rl.acknowledged_at),
+                   snooze_count = rl.snooze_count + x.increment
+               FROM unnest($1::bigint[], $2::text[], $3::text[], $4::int[]) AS x(id, status, acknowledged_at, increment)
+               WHERE rl.id = x.id
+                 AND (x.status, rl.status) IN (SELECT * FROM unnest($5::text[], $6::text[]))""",
+            log_ids, statuses, acknowledged, increments, *_STATUS_TRANSITIONS
+        )
+
+    # --- Adherence statistics ---
+    @_timed
+    async def get_user_adherence(self, user_telegram_id, since_day):
+        return await self._fetch(
+            """SELECT a.medication_id, m.med_name, m.is_active, SUM(a.scheduled) AS scheduled,
+                      SUM(a.acknowledged) AS acknowledged, SUM(a.snoozed) AS snoozed,
+                      SUM(a.missed) AS missed, SUM(a.escalated) AS escalated
+               FROM adherence_daily a JOIN medications m ON m.id = a.medication_id
+               WHERE a.user_telegram_id = $1 AND a.day >= $2
+               GROUP BY a.medication_id, m.med_name, m.is_active ORDER BY scheduled DESC""",
+            user_telegram_id, since_day
+        )
+
+    @_timed
+    async def get_adherence_by_day(self, since_day):
+        return await self._fetch(
+            "SELECT day::text AS day, scheduled, acknowledged, snoozed, missed, escalated FROM adherence_daily_total "
+            "WHERE day >= $1 ORDER BY day",
+            since_day
+        )
+
+    @_timed
+    async def get_population_counts(self):
+        row = await self._fetchrow(
+            "SELECT COUNT(DISTINCT user_telegram_id) AS users, COUNT(*) AS medications FROM medications WHERE is_active"
+        )
+        return row['users'], row['medications']
+
+    # --- Outbox ---
+    def _dead_claim_sql(self, param):
+        """Matches rows claimed by an instance that no longer holds its lock, or by none."""
+        return f"""NOT EXISTS (
+                  SELECT 1 FROM pg_locks l
+                  WHERE l.locktype = 'advisory' AND l.granted AND l.classid = ${param}::oid
+                    AND l.objid = outbox.claimed_by::oid AND l.objsubid = 2
+                    AND l.database = (SELECT oid FROM pg_database WHERE datname = current_database()))"""
+
+    @_timed
+    async def recover_outbox(self, shards=None, kinds=MESSAGE_KINDS):
+        """Returns to 'pending' the messages left 'inflight' by instances that have stopped."""
+        pool = await self._connection_pool()
+        async with pool.acquire() as conn, conn.transaction():
+            shard_sql, shard_params = _shard_filter_sql(shards, "chat_id", 2)
+            await conn.execute(
+                f"""UPDATE outbox SET status = 'sent', claimed_by = NULL
+                   WHERE status = 'inflight' AND kind = 'reminder' AND {self._dead_claim_sql(1)}{shard_sql}
+                     AND log_id IN (SELECT id FROM reminders_log WHERE status NOT IN ('pending', 'queued', 'snoozed'))""",
+                INSTANCE_LOCK_CLASS, *shard_params
+            )
+            shard_sql, shard_params = _shard_filter_sql(shards, "chat_id", 3)
+            status = await conn.execute(
+                f"""UPDATE outbox SET status = 'pending', claimed_by = NULL
+                   WHERE status = 'inflight' AND kind = ANY($2::text[]) AND {self._dead_claim_sql(1)}{shard_sql}""",
+                INSTANCE_LOCK_CLASS, list(kinds), *shard_params
+            )
+        return _rowcount(status)
+
+    @_timed
+    async def claim_outbox_batch(self, limit, shards=None, kinds=MESSAGE_KINDS):
+        """Claims up to `limit` due messages for this instance, skipping rows other instances are claiming.
+
+        Claims nothing while the session is lost: other instances may be recovering this one's rows.
+        """
+        pool = await self._connection_pool()
+        if not self._session_ok:
+            return []
+        shard_sql, shard_params = _shard_filter_sql(shards, "chat_id", 4)
+        rows = await pool.fetch(
+            f"""WITH batch AS (
+                   SELECT id FROM outbox
+                   WHERE status = 'pending' AND next_attempt_at <= now() AND kind = ANY($1::text[]){shard_sql}
+                   ORDER BY next_attempt_at, id LIMIT $2
+                   FOR UPDATE SKIP LOCKED
+               )
+               UPDATE outbox o SET status = 'inflight', claimed_by = $3
+               FROM batch WHERE o.id = batch.id
+               RETURNING o.id, o.kind, o.chat_id, o.log_id, o.payload, o.attempts, o.next_attempt_at,
+                         (SELECT rl.escalate_at FROM reminders_log rl WHERE rl.id = o.log_id) AS escalate_at""",
+            list(kinds), limit, self.instance_id, *shard_params
+        )
+        return sorted(rows, key=lambda row: (row['next_attempt_at'], row['id']))
+
+    @_timed
+    async def complete_outbox(self, results):
+        if not results:
+            return
+        outbox_ids, statuses, attempts, errors = (list(column) for column in zip(*results))
+        await self._execute(
+            """UPDATE outbox o
+               SET status = r.status, attempts = o.attempts + r.attempts, last_error = r.error, claimed_by = NULL,
+                   sent_at = CASE WHEN r.status = 'sent' THEN now() ELSE o.sent_at END
+               FROM unnest($1::bigint[], $2::text[], $3::int[], $4::text[]) AS r(id, status, attempts, error)
+               WHERE o.id = r.id""",
+            outbox_ids, statuses, attempts, errors
+        )
+
+    @_timed
+    async def fail_interrupted_calls(self, shards=None):
+        """Gives up on calls left 'inflight' by instances that have stopped. Returns how many."""
+        shard_sql, shard_params = _shard_filter_sql(shards, "chat_id", 2)
+        status = await self._execute(
+            f"""UPDATE outbox SET status = 'failed', last_error = 'interrupted by a restart', claimed_by = NULL
+               WHERE status = 'inflight' AND kind = 'call' AND {self._dead_claim_sql(1)}{shard_sql}""",
+            INSTANCE_LOCK_CLASS, *shard_params
+        )
+        return _rowcount(status)
+
+    @_timed
+    async def complete_calls(self, results):
+        if not results:
+            return
+        pool = await self._connection_pool()
+        async with pool.acquire() as conn, conn.transaction():
+            await conn.execute(
+                """UPDATE outbox o
+                   SET status = r.status, attempts = o.attempts + r.attempts, last_error = r.error, claimed_by = NULL,
+                       sent_at = CASE WHEN r.status = 'sent' THEN now() ELSE o.sent_at END
+                   FROM unnest($1::bigint[], $2::text[], $3::int[], $4::text[]) AS r(id, status, attempts, error)
+                   WHERE o.id = r.id""",
+                [r[0] for r in results], [r[2] for r in results], [r[3] for r in results], [r[4] for r in results]
+            )
+            placed = [(log_id, to_db_timestamp(placed_at)) for _, log_id, _, _, _, placed_at in results if placed_at]
+            if placed:
+                await conn.execute(
+                    """UPDATE reminders_log rl SET call_triggered_at = x.placed_at::timestamptz
+                       FROM unnest($1::bigint[], $2::text[]) AS x(id, placed_at) WHERE rl.id = x.id""",
+                    [log_id for log_id, _ in placed], [placed_at for _, placed_at in placed]
+                )
+
+    @_timed
+    async def prune_outbox(self, older_than_hours):
+        await self._execute(
+            "DELETE FROM outbox WHERE status IN ('sent', 'failed') AND created_at < now() - make_interval(hours => $1)",
+            int(older_than_hours)
+        )
+
+    @_timed
+    async def get_scheduler_state(self, keys):
+        rows = await self._fetch("SELECT key, value FROM scheduler_state WHERE key = ANY($1::text[])", list(keys))
+        return {row['key']: row['value'] for row in rows}
+
+    # --- Broadcasts ---
+    @_timed
+    async def create_broadcast(self, text, created_by):
+        """Starts a broadcast to every user. Returns its row, or None if another one is still running."""
+        return await self._fetchrow(
+            """INSERT INTO broadcasts (text, created_by, total, cursor)
+               VALUES ($1, $2, (SELECT COUNT(*) FROM users), (SELECT COALESCE(MIN(telegram_id), 1) - 1 FROM users))
+               ON CONFLICT DO NOTHING
+               RETURNING *""",
+            text, created_by
+        )
+
+    @_timed
+    async def get_broadcast(self, broadcast_id=None):
+        if broadcast_id is not None:
+            return await self._fetchrow("SELECT * FROM broadcasts WHERE id = $1", broadcast_id)
+        return await self._fetchrow("SELECT * FROM broadcasts ORDER BY id DESC LIMIT 1")
+
+    @_timed
+    async def get_running_broadcast(self):
+        return await self._fetchrow("SELECT * FROM broadcasts WHERE status = 'running' LIMIT 1")
+
+    @_timed
+    async def get_broadcast_recipients(self, after_telegram_id, limit):
+        rows = await self._fetch(
+            "SELECT telegram_id FROM users WHERE telegram_id > $1 ORDER BY telegram_id LIMIT $2", after_telegram_id, limit
+        )
+        return [row[0] for row in rows]
+
+    @_timed
+    async def save_broadcast_progress(self, broadcast_id, cursor, sent, failed, blocked, status='running'):
+        await self._execute(
+            """UPDATE broadcasts SET cursor = $1, sent = $2, failed = $3, blocked = $4, status = $5,
+                      finished_at = CASE WHEN $5 != 'running' THEN now() END
+               WHERE id = $6""",
+            cursor, sent, failed, blocked, status, broadcast_id
+        )
+
+    async def claim_broadcast(self, broadcast_id):
+        """True if this instance now sends the broadcast; False if another instance is already sending it."""
+        await self._connection_pool()
+        async with self._session_lock:
+            if not self._session_ok:
+                return False  # Another instance may be taking the broadcast over.
+            if broadcast_id in self._broadcasts:
+                return True
+            if not await self._session.fetchval("SELECT pg_try_advisory_lock($1, $2)",
+                                                BROADCAST_LOCK_CLASS, broadcast_id):
+                return False
+            self._broadcasts.add(broadcast_id)
+            return True
+
+    async def release_broadcast(self, broadcast_id):
+        async with self._session_lock:
+            if broadcast_id not in self._broadcasts:
+                return
+            self._broadcasts.discard(broadcast_id)
+            if not self._session_ok:
+                return  # The lock went with the session.
+            await self._session.execute("SELECT pg_advisory_unlock($1, $2)", BROADCAST_LOCK_CLASS, broadcast_id)
+
+    # --- Bot persistence ---
+    @_timed
+    async def load_persistence_data(self, kind, key):
+        row = await self._fetchrow("SELECT data FROM persistence_data WHERE kind = $1 AND key = $2", kind, key)
+        return row[0] if row else None
+
+    @_timed
+    async def load_conversations(self, name, max_age_days):
+        await self._execute(
+            "DELETE FROM conversation_states WHERE name = $1 AND updated_at < now() - make_interval(days => $2)",
+            name, int(max_age_days)
+        )
+        rows = await self._fetch("SELECT key, state FROM conversation_states WHERE name = $1", name)
+        return {row['key']: row['state'] for row in rows}
+
+    @_timed
+    async def save_persistence(self, data, conversations):
+        pool = await self._connection_pool()
+        async with pool.acquire() as conn, conn.transaction():
+            upserts = [(kind, key, value) for kind, key, value in data if value is not None]
+            if upserts:
+                await conn.executemany(
+                    """INSERT INTO persistence_data (kind, key, data, updated_at) VALUES ($1, $2, $3, now())
+                       ON CONFLICT (kind, key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at""",
+                    upserts
+                )
+            deletes = [(kind, key) for kind, key, value in data if value is None]
+            if deletes:
+                await conn.executemany("DELETE FROM persistence_data WHERE kind = $1 AND key = $2", deletes)
+            upserts = [(name, key, state) for name, key, state in conversations if state is not None]
+            if upserts:
+                await conn.executemany(
+                    """INSERT INTO conversation_states (name, key, state, updated_at) VALUES ($1, $2, $3, now())
+                       ON CONFLICT (name, key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at""",
+                    upserts
+                )
+            deletes = [(name, key) for name, key, state in conversations if state is None]
+            if deletes:
+                await conn.executemany("DELETE FROM conversation_states WHERE name = $1 AND key = $2", deletes)
@@ -0,0 +1,218 @@
+"""On-demand profiling of scheduler jobs and update handlers.
+
+Armed with the admin /profile command, or from startup with PROFILE_MODE, the profiler captures
+the next N runs of the chosen jobs or handlers, one run at a time:
+
+- 'cprofile': deterministic profile of the event loop thread, saved as .pstats
+  (open with `python -m pstats` or snakeviz);
+- 'sample': stacks of the event loop and DB threads sampled every PROFILE_SAMPLE_INTERVAL_SECONDS,
+  saved in collapsed-stack format (feed to flamegraph.pl or speedscope).
+
+Both see everything the loop runs while the job or handler is in progress, not just that
+coroutine, which is what a slow tick is competing with anyway. Files go to PROFILE_DIR and the
+hottest functions are sent to ADMIN_CHAT_ID. When nothing is armed a wrapped function costs one
+attribute check.
+"""
+import asyncio
+import cProfile
+import functools
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+from telegram.ext import ConversationHandler
+
+from config import (
+    ADMIN_CHAT_ID, PROFILE_MODE, PROFILE_TARGET, PROFILE_RUNS, PROFILE_DIR, PROFILE_SAMPLE_INTERVAL_SECONDS,
+    PROFILE_TOP_FUNCTIONS,
+)
+
+logger = logging.getLogger(__name__)
+
+MODES = ('cprofile', 'sample')
+
+
+def _frame_name(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_qualname}"
+
+
+class _CProfileCapture:
+    extension = "pstats"
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+
+    def write(self, path):
+        stats = pstats.Stats(self._profile)
+        stats.dump_stats(path)
+        # (file, line, function) -> (primitive calls, calls, own time, cumulative time, callers)
+        hottest = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:PROFILE_TOP_FUNCTIONS]
+        return [f"{own * 1000:.1f} ms self, {cumulative * 1000:.1f} ms total, {calls} calls: "
+                f"{os.path.basename(filename)}:{function}"
+                for (filename, _, function), (_, calls, own, cumulative, _) in hottest]
+
+
+class _SampleCapture:
+    extension = "collapsed"
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL_SECONDS):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # The calling (event loop) thread and the DB pool threads, by name.
+        loop_thread = threading.get_ident()
+        threads = {loop_thread: "event_loop"}
+        threads.update({t.ident: t.name for t in threading.enumerate() if t.name.startswith("db_")})
+        self._thread = threading.Thread(target=self._sample, args=(threads,), name="profiler", daemon=True)
+        self._thread.start()
+
+    def _sample(self, threads):
+        while not self._stopped.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, thread_name in threads.items():
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                if stack:
+                    stack.append(thread_name)
+                    self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.items():
+                f.write(f"{stack} {count}\n")
+        total = sum(self.stacks.values())
+        own = Counter()
+        for stack, count in self.stacks.items():
+            own[stack.rsplit(";", 1)[-1]] += count
+        return [f"{count / total:.0%} of samples: {frame}" for frame, count in own.most_common(PROFILE_TOP_FUNCTIONS)]
+
+
+class Profiler:
+    """Captures the next `runs` runs of a target, one at a time."""
+
+    def __init__(self, directory=PROFILE_DIR):
+        self.directory = directory
+        self.armed = False
+        self.mode = None
+        self.target = None
+        self.remaining = 0
+        self.bot = None
+        self._active = False
+        self._captured = 0
+        self._reports = set()
+
+    def start(self, bot, mode=PROFILE_MODE, target=PROFILE_TARGET, runs=PROFILE_RUNS):
+        """Remembers the bot that sends reports, and arms from config if PROFILE_MODE is set."""
+        self.bot = bot
+        if mode:
+            self.arm(target, runs, mode)
+
+    def arm(self, target, runs, mode='cprofile'):
+        """Profiles the next `runs` runs of `target`: 'jobs', 'handlers', 'all' or a function name."""
+        if mode not in MODES:
+            raise ValueError(f"Profiling mode must be one of {', '.join(MODES)}, not {mode!r}.")
+        if runs < 1:
+            raise ValueError("Profile at least one run.")
+        self.mode, self.target, self.remaining = mode, target, runs
+        self.armed = True
+        logger.info(f"Profiler armed: {mode} for the next {runs} runs of {target}.")
+
+    def disarm(self):
+        self.armed = False
+        self.remaining = 0
+
+    def status(self):
+        if not self.armed:
+            return "Profiler is off."
+        return f"Profiler armed: {self.mode} for the next {self.remaining} runs of {self.target}."
+
+    def _wants(self, kind, name):
+        return not self._active and self.target in ('all', kind + 's', name)
+
+    async def _capture(self, name, func, args, kwargs):
+        self._active = True
+        self._captured += 1
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self.armed = False
+        capture = _CProfileCapture() if self.mode == 'cprofile' else _SampleCapture()
+        started = time.perf_counter()
+        capture.start()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            capture.stop()
+            self._active = False
+            task = asyncio.create_task(self._save(capture, f"{name}-{self._captured}", time.perf_counter() - started))
+            self._reports.add(task)
+            task.add_done_callback(self._reports.discard)
+
+    async def _save(self, capture, name, elapsed):
+        path = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}.{capture.extension}")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            hottest = await asyncio.to_thread(capture.write, path)
+        except Exception as e:
+            logger.error(f"Could not save the profile of {name}: {e}", exc_info=True)
+            return
+        report = f"⏱ {name} took {elapsed * 1000:.0f} ms. Profile saved to {path}\n" + "\n".join(hottest)
+        logger.info(report)
+        if self.bot and ADMIN_CHAT_ID:
+            try:
+                await self.bot.send_message(chat_id=ADMIN_CHAT_ID, text=report[:4000])
+            except Exception as e:
+                logger.warning(f"Could not send the profile of {name} to the admin: {e}")
+
+
+def profiled(kind, name=None):
+    """Makes an async job ('job') or handler ('handler') profilable under `name` (default: its own name)."""
+    def decorate(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not profiler.armed or not profiler._wants(kind, label):
+                return await func(*args, **kwargs)
+            return await profiler._capture(label, func, args, kwargs)
+        return wrapper
+    return decorate
+
+
+def instrument_handlers(application):
+    """Wraps the callback of every handler registered on `application`, conversation states included."""
+    def wrap(handlers):
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler):
+                wrap(handler.entry_points)
+                for state_handlers in handler.states.values():
+                    wrap(state_handlers)
+                wrap(handler.fallbacks)
+            else:
+                handler.callback = profiled('handler', handler.callback.__name__)(handler.callback)
+
+    for handlers in application.handlers.values():
+        wrap(handlers)
+
+
+# Process-wide profiler; the admin /profile command arms it.
+profiler = Profiler()
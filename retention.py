@@ -0,0 +1,223 @@
+"""Retention for reminders_log: archives old, settled rows into monthly archive databases.
+
+Rows older than RETENTION_DAYS that no longer drive the scheduler are moved, in batches of
+RETENTION_BATCH_SIZE, to archive/reminders-YYYY-MM.db (same columns, indexed by user), so the hot
+table only holds recent and upcoming doses. Each batch is its own short transaction run on the DB
+thread pool, with a pause between batches for other writers. Freed pages are then returned with
+bounded PRAGMA incremental_vacuum steps and the planner statistics refreshed with PRAGMA optimize.
+The job only does work during RETENTION_QUIET_HOURS.
+
+Archived history stays queryable with get_history(), or from the command line:
+
+    python -m retention history <telegram_id> --days 365
+    python -m retention run        # archive and compact now, ignoring quiet hours
+    python -m retention vacuum     # one-off: switch an existing database to incremental auto-vacuum
+"""
+import argparse
+import asyncio
+import glob
+import logging
+import os
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+import database as db
+import db_async as adb
+from config import (
+    DB_NAME, ARCHIVE_DIR, RETENTION_DAYS, RETENTION_BATCH_SIZE, RETENTION_PAUSE_SECONDS,
+    RETENTION_QUIET_HOURS, RETENTION_VACUUM_PAGES, DB_BACKEND,
+)
+
+logger = logging.getLogger(__name__)
+
+# Anything but a reminder still waiting to be sent can be archived once it is old enough.
+ARCHIVE_STATUSES = ('sent', 'acknowledged', 'snoozed', 'missed', 'call_triggered', 'send_failed')
+COLUMNS = ("id, medication_id, user_telegram_id, scheduled_time, status, snooze_count, "
+           "acknowledged_at, call_triggered_at, escalate_at")
+# Created in each monthly file while it is attached as `archive`.
+ARCHIVE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS archive.reminders_log (
+        id INTEGER PRIMARY KEY,
+        medication_id INTEGER NOT NULL,
+        user_telegram_id INTEGER NOT NULL,
+        scheduled_time TIMESTAMP NOT NULL,
+        status TEXT,
+        snooze_count INTEGER,
+        acknowledged_at TIMESTAMP,
+        call_triggered_at TIMESTAMP,
+        escalate_at TIMESTAMP
+    )""",
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_user_time ON reminders_log (user_telegram_id, scheduled_time)",
+]
+
+
+def archive_path(month):
+    """Archive database file for a 'YYYY-MM' month."""
+    return os.path.join(ARCHIVE_DIR, f"reminders-{month}.db")
+
+
+def parse_quiet_hours(spec):
+    """Turns "2-5" into (2, 5): UTC hours from 02:00 up to 05:00. "22-4" wraps past midnight."""
+    start, _, end = spec.partition("-")
+    return int(start) % 24, int(end or start) % 24
+
+
+def in_quiet_hours(now, spec=RETENTION_QUIET_HOURS):
+    start, end = parse_quiet_hours(spec)
+    if start <= end:
+        return start <= now.hour < end
+    return now.hour >= start or now.hour < end
+
+
+def _open():
+    # A connection of its own, since archive databases are ATTACHed to it.
+    return db.open_connection()
+
+
+def archive_batch(cutoff, limit=RETENTION_BATCH_SIZE):
+    """Moves up to `limit` settled rows scheduled before `cutoff` into their monthly archives.
+
+    Returns the number of rows moved. A row is inserted into the archive before it is deleted
+    here, and re-archiving replaces by id, so a crash between the two only repeats work.
+    """
+    conn = _open()
+    try:
+        status_list = ", ".join("?" * len(ARCHIVE_STATUSES))
+        # Uses idx_reminders_log_status_time: an IN on status, then a range on scheduled_time.
+        rows = conn.execute(
+            f"SELECT id, SUBSTR(scheduled_time, 1, 7) AS month FROM reminders_log "
+            f"WHERE status IN ({status_list}) AND scheduled_time < ? LIMIT ?",
+            (*ARCHIVE_STATUSES, db.to_db_timestamp(cutoff), limit)
+        ).fetchall()
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(row['month'], []).append(row['id'])
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        for month, ids in sorted(by_month.items()):
+            conn.execute("ATTACH DATABASE ? AS archive", (archive_path(month),))
+            try:
+                for statement in ARCHIVE_SCHEMA:
+                    conn.execute(statement)
+                placeholders = ", ".join("?" * len(ids))
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute(
+                    f"INSERT OR REPLACE INTO archive.reminders_log ({COLUMNS}) "
+                    f"SELECT {COLUMNS} FROM main.reminders_log WHERE id IN ({placeholders})",
+                    ids
+                )
+                conn.execute(f"DELETE FROM main.reminders_log WHERE id IN ({placeholders})", ids)
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+            finally:
+                conn.execute("DETACH DATABASE archive")
+        return len(rows)
+    finally:
+        conn.close()
+
+
+def compact_step(max_pages=RETENTION_VACUUM_PAGES):
+    """Returns up to `max_pages` free pages to the filesystem. Returns the free pages left.
+
+    Only works once the database uses auto_vacuum=INCREMENTAL (new databases do; see `vacuum`).
+    """
+    conn = db.get_db_connection()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    conn.execute(f"PRAGMA incremental_vacuum({int(max_pages)})").fetchall()
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def optimize():
+    db.get_db_connection().execute("PRAGMA optimize")
+
+
+def full_vacuum():
+    """Switches the database to incremental auto-vacuum with a one-off VACUUM. Blocks writers while it runs."""
+    conn = _open()
+    try:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+
+async def run_retention(now=None, respect_quiet_hours=True):
+    """Archives and compacts in bounded steps until done or the quiet hours end. Returns rows archived."""
+    now = now or datetime.now(timezone.utc)
+    if respect_quiet_hours and not in_quiet_hours(now):
+        return 0
+    cutoff = now - timedelta(days=RETENTION_DAYS)
+    archived = 0
+    try:
+        while True:
+            moved = await adb.run(archive_batch, cutoff)
+            archived += moved
+            if moved < RETENTION_BATCH_SIZE or (respect_quiet_hours and not in_quiet_hours(datetime.now(timezone.utc))):
+                break
+            await asyncio.sleep(RETENTION_PAUSE_SECONDS)
+        while await adb.run(compact_step) > 0:
+            if respect_quiet_hours and not in_quiet_hours(datetime.now(timezone.utc)):
+                break
+            await asyncio.sleep(RETENTION_PAUSE_SECONDS)
+        await adb.run(optimize)
+    except Exception as e:
+        logger.error(f"Retention: error after archiving {archived} reminders: {e}", exc_info=True)
+    if archived:
+        logger.info(f"Retention: archived {archived} reminders scheduled before {cutoff:%Y-%m-%d}.")
+    return archived
+
+
+def get_history(user_telegram_id, start, end):
+    """Every reminders_log row of a user scheduled in [start, end), from the hot table and the archives."""
+    ts_start, ts_end = db.to_db_timestamp(start), db.to_db_timestamp(end)
+    query = (f"SELECT {COLUMNS} FROM reminders_log "
+             "WHERE user_telegram_id = ? AND scheduled_time >= ? AND scheduled_time < ?")
+    rows = list(db.get_db_connection().execute(query, (user_telegram_id, ts_start, ts_end)))
+    first_month, last_month = ts_start[:7], ts_end[:7]
+    for path in sorted(glob.glob(os.path.join(ARCHIVE_DIR, "reminders-*.db"))):
+        month = os.path.basename(path)[len("reminders-"):-len(".db")]
+        if not first_month <= month <= last_month:
+            continue
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        conn.row_factory = sqlite3.Row
+        try:
+            rows.extend(conn.execute(query, (user_telegram_id, ts_start, ts_end)))
+        finally:
+            conn.close()
+    return sorted(rows, key=lambda row: row['scheduled_time'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="reminders_log retention and archive queries.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("run", help="Archive and compact now, ignoring quiet hours")
+    commands.add_parser("vacuum", help="One-off VACUUM that enables incremental auto-vacuum (stop the bot first)")
+    history = commands.add_parser("history", help="Print a user's reminder history, archived rows included")
+    history.add_argument("telegram_id", type=int)
+    history.add_argument("--days", type=int, default=RETENTION_DAYS * 2)
+    args = parser.parse_args()
+    if DB_BACKEND != "sqlite":
+        parser.error("Retention only works with the SQLite backend (DB_BACKEND=sqlite).")
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+
+    asyncio.run(adb.storage.start())
+    if args.command == "run":
+        async def run_now():
+            try:
+                return await run_retention(respect_quiet_hours=False)
+            finally:
+                await adb.shutdown()
+        print(f"Archived {asyncio.run(run_now())} reminders.")
+    elif args.command == "vacuum":
+        full_vacuum()
+        print(f"{DB_NAME} now uses incremental auto-vacuum.")
+    else:
+        end = datetime.now(timezone.utc)
+        for row in get_history(args.telegram_id, end - timedelta(days=args.days), end):
+            print(f"{row['scheduled_time']}  {row['status']:<15} medication {row['medication_id']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""Prescription scanning for /scanrx: OCR of a photo, parsed into medication name, dosage and times.
+
+OCR is CPU-heavy, so it runs in a pool of OCR_WORKERS processes at lower CPU priority, never on
+the event loop. At most OCR_MAX_PENDING scans are queued or running; beyond that scan() raises
+ScannerBusy straight away, so a flood of photos is turned away instead of piling up work that
+competes with reminder delivery. Results are cached by the SHA-256 of the image, so the same photo
+sent twice is only read once.
+
+Needs pytesseract and Pillow (see requirements.txt) and the tesseract binary; without them
+OCR_AVAILABLE is False and /scanrx says scanning is unavailable.
+"""
+import asyncio
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+from cache import TTLCache, MISSING
+from validators import parse_times_of_day
+from config import (
+    OCR_WORKERS, OCR_MAX_PENDING, OCR_TIMEOUT_SECONDS, OCR_MAX_IMAGE_SIDE, OCR_CACHE_ENTRIES, OCR_CACHE_TTL_SECONDS,
+)
+
+try:
+    import pytesseract
+    from PIL import Image, ImageOps
+    OCR_AVAILABLE = True
+except ImportError:
+    OCR_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+DOSAGE_RE = re.compile(
+    r"\b(\d+(?:[.,]\d+)?\s*(?:mg|mcg|µg|g|ml|iu|units?)\b(?:\s*/\s*\d*\s*(?:ml|tab(?:let)?s?)\b)?)", re.IGNORECASE)
+QUANTITY_RE = re.compile(
+    r"\b(\d+|one|two|half)\s+(tab(?:let)?s?|cap(?:sule)?s?|puffs?|drops?|sachets?)\b", re.IGNORECASE)
+# "8.30" is only a time with am/pm after it; otherwise it is a dosage like "0.25 mg" or "1.25 mg".
+CLOCK_RE = re.compile(
+    r"\b([01]?\d|2[0-3])(?::|\.(?=[0-5]\d\s*[ap]\.?m))([0-5]\d)\s*([ap]\.?m\.?)?(?!\w)", re.IGNORECASE)
+HOUR_RE = re.compile(r"\b(1[0-2]|[1-9])\s*([ap])\.?m\b\.?", re.IGNORECASE)
+LABEL_RE = re.compile(r"^\s*(?:rx|medication|medicine|drug|name)\s*[:.#-]\s*", re.IGNORECASE)
+# Most specific first: "twice daily" must not be read as "daily".
+FREQUENCIES = [
+    (re.compile(r"\b(four times (a|per) day|q\.?i\.?d\b|every 6 ?(hours|hrs|h)\b)", re.IGNORECASE),
+     ["08:00", "12:00", "16:00", "20:00"]),
+    (re.compile(r"\b(three times (a|per) day|thrice daily|t\.?i\.?d\b|every 8 ?(hours|hrs|h)\b)", re.IGNORECASE),
+     ["08:00", "14:00", "20:00"]),
+    (re.compile(r"\b(twice (a |per )?day|twice daily|two times (a|per) day|b\.?i\.?d\b|every 12 ?(hours|hrs|h)\b)",
+                re.IGNORECASE), ["08:00", "20:00"]),
+    (re.compile(r"\b(at bedtime|at night|nightly|q\.?h\.?s\b)", re.IGNORECASE), ["22:00"]),
+    (re.compile(r"\b(once (a |per )?day|once daily|daily|every day|every morning|q\.?d\b)", re.IGNORECASE), ["08:00"]),
+]
+NOT_A_NAME = {"patient", "doctor", "dr", "date", "address", "take", "sig", "qty", "quantity", "refills", "pharmacy",
+              "prescription", "prescriber", "tel", "phone", "dob", "age"}
+
+
+class ScannerBusy(Exception):
+    """Too many scans are queued; try again later."""
+
+
+# --- Runs in the worker processes ---
+def _lower_priority():
+    try:
+        os.nice(10)
+    except OSError:
+        pass
+
+
+def _threshold(histogram):
+    """Otsu's threshold for a 256-bin grey-level histogram."""
+    total = sum(histogram)
+    sum_all = sum(level * count for level, count in enumerate(histogram))
+    best, best_variance = 127, 0.0
+    weight_bg = sum_bg = 0
+    for level, count in enumerate(histogram):
+        weight_bg += count
+        if weight_bg == 0:
+            continue
+        weight_fg = total - weight_bg
+        if weight_fg == 0:
+            break
+        sum_bg += level * count
+        mean_bg, mean_fg = sum_bg / weight_bg, (sum_all - sum_bg) / weight_fg
+        variance = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+        if variance > best_variance:
+            best, best_variance = level, variance
+    return best
+
+
+def preprocess(image_bytes, max_side=OCR_MAX_IMAGE_SIDE):
+    """Upright, greyscale, downscaled to `max_side` and binarised: what tesseract reads best."""
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(image_bytes)))
+    image = ImageOps.autocontrast(image.convert("L"))
+    image.thumbnail((max_side, max_side))
+    cutoff = _threshold(image.histogram())
+    return image.point(lambda level: 255 if level > cutoff else 0, mode="1")
+
+
+def ocr_image(image_bytes, timeout=0):
+    """The text of a prescription photo. tesseract is killed after `timeout` seconds (0: no limit)."""
+    return pytesseract.image_to_string(preprocess(image_bytes), timeout=timeout)
+
+
+# --- Parsing ---
+def _clock_time(hour, minute, meridiem):
+    if meridiem:
+        hour = hour % 12 + (12 if meridiem[0].lower() == "p" else 0)
+    return f"{hour}:{minute:02d}"
+
+
+def parse_times(text):
+    """Dose times in text as normalised HH:MM: explicit times if any, else from a frequency like "twice daily"."""
+    times = [_clock_time(int(h), int(m), meridiem) for h, m, meridiem in CLOCK_RE.findall(text)]
+    times += [_clock_time(int(h), 0, meridiem) for h, meridiem in HOUR_RE.findall(text)]
+    valid_times, _ = parse_times_of_day(", ".join(times))
+    if valid_times:
+        return sorted(set(valid_times))
+    for pattern, default_times in FREQUENCIES:
+        if pattern.search(text):
+            return default_times
+    return []
+
+
+def _name_from(line):
+    line = LABEL_RE.sub("", line)
+    words = re.findall(r"[A-Za-z][A-Za-z-]+", line)
+    if not words or words[0].lower() in NOT_A_NAME:
+        return None
+    return " ".join(words[:3])
+
+
+def parse_prescription(text):
+    """Picks med_name, dosage and times_of_day (as the add-medication conversation stores them) out of OCR text.
+
+    A field that can't be found is None.
+    """
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    med_name = dosage = None
+    for line in lines:
+        match = DOSAGE_RE.search(line)
+        if match:
+            dosage = re.sub(r"\s+", " ", match.group(1))
+            med_name = _name_from(line[:match.start()]) or med_name
+            break
+    if dosage is None:
+        match = QUANTITY_RE.search(text)
+        if match:
+            dosage = f"{match.group(1)} {match.group(2)}".lower()
+    if med_name is None:
+        med_name = next(filter(None, (_name_from(line) for line in lines if LABEL_RE.match(line))), None)
+    times = parse_times(text)
+    return {"med_name": med_name, "dosage": dosage, "times_of_day": ", ".join(times) if times else None}
+
+
+# --- Runs on the event loop ---
+class RxScanner:
+    """Bounded front end to the OCR process pool."""
+
+    def __init__(self, workers=OCR_WORKERS, max_pending=OCR_MAX_PENDING, timeout=OCR_TIMEOUT_SECONDS):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self.results = TTLCache("rx_scans", OCR_CACHE_ENTRIES, OCR_CACHE_TTL_SECONDS)
+        self._pool = None
+
+    def _executor(self):
+        if self._pool is None:
+            # spawn, not fork: the bot process has DB, logging and dispatcher threads that must not be copied.
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=_lower_priority)
+        return self._pool
+
+    async def scan(self, image_bytes):
+        """Parsed fields (see parse_prescription) of a photo. Raises ScannerBusy when the queue is full."""
+        key = hashlib.sha256(image_bytes).hexdigest()
+        result = self.results.get(key)
+        if result is not MISSING:
+            metrics.rx_scans_total.inc(outcome='cached')
+            return result
+        if self.pending >= self.max_pending:
+            metrics.rx_scans_total.inc(outcome='busy')
+            raise ScannerBusy()
+
+        self.pending += 1
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            job = self._executor().submit(ocr_image, image_bytes, self.timeout)
+        except Exception:
+            self.pending -= 1
+            raise
+        # The slot is freed when the worker is done with the job, not when we stop waiting for it: a
+        # timed-out scan that already started keeps its worker busy until tesseract's own timeout.
+        job.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+        try:
+            text = await asyncio.wait_for(asyncio.wrap_future(job), self.timeout)
+        except Exception:
+            metrics.rx_scans_total.inc(outcome='error')
+            raise
+        metrics.rx_scan_seconds.observe(time.perf_counter() - started)
+        metrics.rx_scans_total.inc(outcome='scanned')
+        result = parse_prescription(text)
+        self.results.set(key, result)
+        return result
+
+    def _release(self):
+        self.pending -= 1
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+rx_scanner = RxScanner()
+metrics.Gauge("mediminder_rx_scans_pending", "Prescription scans queued or running.", lambda: rx_scanner.pending)
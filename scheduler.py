@@ -1,204 +1,318 @@
+import heapq
 import logging
+import threading
+import time
+from apscheduler.triggers.date import DateTrigger
 from apscheduler.triggers.interval import IntervalTrigger
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Bot
-from telegram.error import TelegramError # Import specific Telegram errors
+from telegram import Bot
 from datetime import datetime, timezone, timedelta
-import asyncio
 
 import database as db
-from config import SNOOZE_MINUTES, CALL_ESCALATION_DELAY_MINUTES, MAX_SNOOZES
+import db_async as adb
+import metrics
+from dispatcher import dispatcher
+from outbox import outbox_relay, message_payload
+from calls import call_relay, call_payload
+from write_behind import status_writer
+from profiling import profiled
+import shard_worker
+import retention
+from config import (
+    SNOOZE_MINUTES, MAX_SNOOZES, SCHEDULER_MODE, SCHEDULER_WORKERS,
+    CATCHUP_POLICY, CATCHUP_MAX_AGE_MINUTES, MATERIALIZE_INTERVAL_MINUTES, RETENTION_INTERVAL_MINUTES, DB_BACKEND,
+    REMINDER_REARM_SECONDS,
+)
 
 logger = logging.getLogger(__name__)
 
-async def send_telegram_reminder(bot: Bot, log_id: int, user_telegram_id: int, med_name: str, dosage: str):
-    """Sends the medication reminder message via Telegram."""
-    logger.info(f"[SEND_ATTEMPT] log_id={log_id}, user_id={user_telegram_id}, med='{med_name}', dosage='{dosage}'")
-    
-    if not user_telegram_id:
-        logger.error(f"[SEND_FAIL] log_id={log_id}: user_telegram_id is missing or invalid: {user_telegram_id}. Cannot send message.")
-        return
+def reminder_payload(log_id, med, snooze_count=0):
+    """The outbox payload of a reminder message, with its Taken button and Snooze while any are left."""
+    buttons = [["✅ Taken", f"ack:{log_id}"]]
+    if snooze_count < MAX_SNOOZES:
+        buttons.append([f"⏰ Snooze {SNOOZE_MINUTES}min", f"snooze:{log_id}"])
+    return message_payload(
+        f"💊 Time to take your **{med['med_name']}** ({med['dosage']})!",
+        buttons=[buttons],
+        parse_mode='Markdown'
+    )
+
+
+async def snooze_reminder(log_id):
+    """Snoozes a reminder for SNOOZE_MINUTES and queues it to be sent again then.
+
+    Returns the new snooze count, or None if the reminder can't be snoozed (already answered,
+    or MAX_SNOOZES reached), in which case it stays due for escalation.
+    """
+    if status_writer.pending_status(log_id) is not None:
+        # An unflushed 'sent' must land before the snooze, or it would overwrite it.
+        await status_writer.flush_now()
+    refire_at = datetime.now(timezone.utc) + timedelta(minutes=SNOOZE_MINUTES)
+    snooze_count = await adb.snooze_reminder(log_id, refire_at, MAX_SNOOZES, reminder_payload)
+    if snooze_count is not None:
+        # The re-send is durable in the outbox; this only makes the local relay pick it up on time.
+        outbox_relay.wake_at(refire_at)
+        logger.info("Reminder log_id=%s snoozed (%d/%d) until %s.", log_id, snooze_count, MAX_SNOOZES, refire_at,
+                    extra={"log_id": log_id, "sample": True})
+    return snooze_count
+
+
+def _reminder_sent(row, msg_sent):
+    logger.info("[SEND_SUCCESS] log_id=%s to user %s. Message ID: %s", row['log_id'], row['chat_id'], msg_sent.message_id,
+                extra={"log_id": row['log_id'], "user_id": row['chat_id'], "sample": True})
+    status_writer.update(row['log_id'], 'sent')
+    if row['escalate_at']:
+        add_escalation_deadline(db.from_db_timestamp(row['escalate_at']))
+
+
+async def _reminder_failed(row, outcome):
+    if outcome == 'blocked':
+        logger.error("[SEND_FAIL_BLOCKED] log_id=%s: Chat %s not found or bot blocked. Marking user inactive.",
+                     row['log_id'], row['chat_id'], extra={"log_id": row['log_id'], "user_id": row['chat_id']})
+        await adb.mark_user_inactive(row['chat_id'])
+    else:
+        logger.error("[SEND_FAIL_FINAL] log_id=%s: All attempts to send message failed for user %s.",
+                     row['log_id'], row['chat_id'], extra={"log_id": row['log_id'], "user_id": row['chat_id']})
+    status_writer.update(row['log_id'], 'send_failed')
 
-    message_text = f"💊 Time to take your **{med_name}** ({dosage})!"
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ Taken", callback_data=f"ack:{log_id}"),
-            InlineKeyboardButton(f"⏰ Snooze {SNOOZE_MINUTES}min", callback_data=f"snooze:{log_id}")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    max_retries = 3
-    for attempt in range(1, max_retries + 1):
-        try:
-            logger.debug(f"[SEND_API_CALL] Attempt {attempt}: bot.send_message(chat_id={user_telegram_id}, text='{message_text}', ...)")
-            if not isinstance(bot, Bot):
-                logger.error(f"[SEND_FAIL] log_id={log_id}: bot object is not a valid Bot instance: {type(bot)}")
-                return
-            msg_sent = await bot.send_message(
-                chat_id=user_telegram_id,
-                text=message_text,
-                reply_markup=reply_markup,
-                parse_mode='Markdown'
-            )
-            if msg_sent:
-                logger.info(f"[SEND_SUCCESS] log_id={log_id} to user {user_telegram_id}. Message ID: {msg_sent.message_id}")
-                db.update_reminder_log_status(log_id, 'sent')
-                return
-            else:
-                logger.error(f"[SEND_FAIL_UNEXPECTED] log_id={log_id}: send_message returned None/False without error for user {user_telegram_id}.")
-        except TelegramError as te:
-            logger.error(f"[SEND_FAIL_TELEGRAM_API_ERROR] log_id={log_id} for user {user_telegram_id}: {te}", exc_info=False)
-            logger.error(f"TelegramError details: code={getattr(te, 'error_code', 'N/A')}, message='{getattr(te, 'message', str(te))}'")
-            if hasattr(te, 'response') and te.response:
-                logger.error(f"TelegramError response: {te.response.text}")
-            # Handle specific Telegram API errors
-            if "chat not found" in str(te).lower() or (hasattr(te, 'message') and "chat not found" in te.message.lower()):
-                logger.error(f"  Specific: Chat ID {user_telegram_id} not found. User might have blocked the bot or wrong ID.")
-                # Mark user as inactive in DB
-                db.mark_user_inactive(user_telegram_id)
-                return
-            elif "bot was blocked by the user" in str(te).lower() or (hasattr(te, 'message') and "bot was blocked by the user" in te.message.lower()):
-                logger.error(f"  Specific: Bot was blocked by user {user_telegram_id}.")
-                db.mark_user_inactive(user_telegram_id)
-                return
-            # For other Telegram errors, retry
-        except Exception as e:
-            logger.error(f"[SEND_FAIL_UNKNOWN_ERROR] log_id={log_id} for user {user_telegram_id}: {e}", exc_info=True)
-        # Exponential backoff before retrying
-        if attempt < max_retries:
-            await asyncio.sleep(2 ** attempt)
-    # If all attempts fail, update DB
-    logger.error(f"[SEND_FAIL_FINAL] log_id={log_id}: All attempts to send message failed for user {user_telegram_id}.")
-    db.update_reminder_log_status(log_id, 'send_failed')
-
-# --- The rest of scheduler.py (check_and_send_reminders, etc.) remains the same as the previous "Enhanced Debugging" version ---
-# Ensure that check_and_send_reminders correctly calls this updated send_telegram_reminder function.
-# (The previous version already did this correctly)
 
+outbox_relay.on_sent('reminder', _reminder_sent)
+outbox_relay.on_failed('reminder', _reminder_failed)
+
+REMINDER_JOB_ID = "check_reminders_job"
+REARM_JOB_ID = "rearm_reminders_job"
+MATERIALIZE_JOB_ID = "materialize_reminders_job"
+RETENTION_JOB_ID = "reminders_retention_job"
+
+_next_fire_at = None
+# Earliest occurrence materialised by this process since the reminder job last looked for its next
+# run, so a medication added while that lookup is in flight isn't skipped.
+_materialized_hint = None
+_scheduler = None
+_bot = None
+_arm_lock = threading.Lock()
+# (shard_count, owned_shard_ids) when running as a sharded worker; None means every user.
+_shards = None
+ESCALATION_JOB_ID = "check_escalation_job"
+
+# Distinct escalation deadlines of reminders awaiting an answer, soonest first. Many reminders share a
+# slot and therefore a deadline, so the heap holds each instant once and one DB query serves them all.
+_escalation_deadlines = []
+_escalation_deadline_set = set()
+_escalation_armed_at = None
+
+
+@profiled('job')
 async def check_and_send_reminders(bot: Bot):
+    """Queues every materialised reminder that has fallen due, then re-arms for the next one."""
     logger.info("SCHEDULER JOB: check_and_send_reminders - RUNNING")
+    started = time.perf_counter()
     now_utc = datetime.now(timezone.utc) # Explicitly use UTC timezone-aware datetime
-    logger.debug(f"Current UTC time: {now_utc.isoformat()}")
-    conn = None
     try:
-        conn = db.get_db_connection()
-        meds_to_check = conn.execute(
-            "SELECT id, user_telegram_id, med_name, dosage, times_of_day FROM medications WHERE is_active = TRUE"
-        ).fetchall()
-        logger.debug(f"Found {len(meds_to_check)} active medications to check.")
-
-        if not meds_to_check:
-            logger.info("No active medications found in DB.")
+        # The status change and the outbox message commit together, so a crash either leaves the
+        # reminder pending for the next run or has already handed it to the outbox relay. Instances
+        # sharing a database each claim part of the due rows.
+        queued = await adb.claim_due_reminders(now_utc, reminder_payload, _shards)
+        logger.debug("Current UTC time: %s. %d reminders due.", now_utc, queued)
+        metrics.scheduler_due_reminders.observe(queued)
+        if not queued:
             return
-
-        for med_row in meds_to_check:
-            med_id = med_row['id']
-            user_telegram_id = med_row['user_telegram_id'] # Make sure this is correctly fetched
-            med_name = med_row['med_name']
-            dosage = med_row['dosage']
-            times_str_list = med_row['times_of_day'].split(',')
-            logger.debug(f"Checking Med ID {med_id} ({med_name}) for user {user_telegram_id}. Scheduled times: {times_str_list}")
-
-            # ... (rest of the logic from previous 'Enhanced Debugging' version for time checking and log creation) ...
-            # Ensure the user_telegram_id is valid before calling send_telegram_reminder
-            if not user_telegram_id:
-                logger.error(f"  Med ID {med_id}: Invalid or missing user_telegram_id ({user_telegram_id}). Cannot schedule reminder send.")
-                continue
-
-            for time_str in times_str_list:
-                time_str = time_str.strip()
-                try:
-                    h, m = map(int, time_str.split(':'))
-                    scheduled_dt_today_utc = now_utc.replace(hour=h, minute=m, second=0, microsecond=0)
-                    # logger.debug(f"  Med ID {med_id}: Parsed time_str '{time_str}' to scheduled_dt_today_utc: {scheduled_dt_today_utc.isoformat()}")
-                    
-                    trigger_window = timedelta(minutes=1) 
-                    
-                    if not (scheduled_dt_today_utc <= now_utc < scheduled_dt_today_utc + trigger_window):
-                        continue 
-
-                    # logger.info(f"  Med ID {med_id} at {time_str}: IS IN TRIGGER WINDOW. Scheduled: {scheduled_dt_today_utc}, Now: {now_utc}")
-
-                    date_today_str = scheduled_dt_today_utc.strftime('%Y-%m-%d')
-                    time_slot_str = scheduled_dt_today_utc.strftime('%H:%M')
-
-                    existing_log_today = conn.execute(
-                        """SELECT id, status FROM reminders_log 
-                           WHERE medication_id = ? 
-                             AND DATE(scheduled_time, 'utc') = ? 
-                             AND STRFTIME('%H:%M', scheduled_time, 'utc') = ? 
-                           ORDER BY id DESC LIMIT 1""",
-                        (med_id, date_today_str, time_slot_str)
-                    ).fetchone()
-
-                    if existing_log_today:
-                        # logger.debug(f"  Med ID {med_id} at {time_str}: Found existing log ID {existing_log_today['id']} with status '{existing_log_today['status']}' for today.")
-                        if existing_log_today['status'] in ['sent', 'acknowledged', 'call_triggered', 'missed']:
-                            # logger.info(f"  Med ID {med_id} at {time_str}: Already handled (status: {existing_log_today['status']}). Skipping.")
-                            continue 
-
-                    log_id_to_use = None
-                    if existing_log_today and existing_log_today['status'] == 'pending': 
-                        log_id_to_use = existing_log_today['id']
-                        # logger.info(f"  Med ID {med_id} at {time_str}: Re-using existing PENDING log ID {log_id_to_use}.")
-                    else: 
-                        # logger.info(f"  Med ID {med_id} at {time_str}: No suitable existing log. Creating new log entry.")
-                        cursor = conn.execute(
-                            "INSERT INTO reminders_log (medication_id, user_telegram_id, scheduled_time, status) VALUES (?, ?, ?, 'pending')",
-                            (med_id, user_telegram_id, scheduled_dt_today_utc) 
-                        )
-                        log_id_to_use = cursor.lastrowid
-                        # logger.info(f"  CREATED new reminder_log ID {log_id_to_use} for med {med_name} ({med_id}) at {time_str} (Scheduled: {scheduled_dt_today_utc.isoformat()})")
-                    
-                    if log_id_to_use:
-                        conn.commit() 
-                        logger.info(f"  ==> Med ID {med_id} at {time_str}: Preparing to send reminder via log ID {log_id_to_use} to user_id {user_telegram_id}.")
-                        await send_telegram_reminder(bot, log_id_to_use, user_telegram_id, med_name, dosage)
-                    # else:
-                        # logger.warning(f"  Med ID {med_id} at {time_str}: Could not determine log_id_to_use. This shouldn't happen.")
-                        # conn.rollback() 
-
-                except ValueError as ve:
-                    logger.error(f"  Med ID {med_id}: Invalid time format '{time_str}': {ve}")
-                except Exception as e:
-                    logger.error(f"  Med ID {med_id}: Error processing time '{time_str}': {e}", exc_info=True)
-        if conn: conn.commit() 
+        logger.info("  ==> %d due reminders queued in the outbox.", queued)
+        outbox_relay.wake()
     except Exception as e:
         logger.error(f"SCHEDULER JOB: Major error in check_and_send_reminders: {e}", exc_info=True)
-        if conn: conn.rollback()
     finally:
-        if conn:
-            conn.close()
-        # logger.info("SCHEDULER JOB: check_and_send_reminders - FINISHED") # Keep this if you want end-of-job marker
+        await rearm_reminder_job()
+        metrics.scheduler_tick_seconds.observe(time.perf_counter() - started, job='reminders')
+
+
+async def _catch_up(now_utc):
+    """Handles reminders that fell due while no process was sending them, according to CATCHUP_POLICY."""
+    resume_from = now_utc.replace(second=0, microsecond=0)
+    # Reminders of the current minute still fire normally if the bot starts inside it.
+    overdue = await adb.get_due_reminders(resume_from - timedelta(seconds=1), _shards)
+    if not overdue:
+        return
+
+    max_age = now_utc - timedelta(minutes=CATCHUP_MAX_AGE_MINUTES)
+    recent = [row for row in overdue if db.from_db_timestamp(row['scheduled_time']) >= max_age]
+    if CATCHUP_POLICY == 'all':
+        send = recent
+    elif CATCHUP_POLICY == 'latest':
+        latest = {}
+        for row in recent:  # get_due_reminders returns rows oldest first
+            latest[row['medication_id']] = row
+        send = list(latest.values())
+    else:
+        send = []
+    send_ids = {row['log_id'] for row in send}
+    skipped = [row['log_id'] for row in overdue if row['log_id'] not in send_ids]
+
+    if skipped:
+        await adb.mark_reminders_missed(skipped)
+    if send:
+        await adb.queue_reminders(send, reminder_payload)
+        outbox_relay.wake()
+    logger.warning(f"Catch-up ({CATCHUP_POLICY}): {len(overdue)} reminders fell due while stopped; "
+                   f"sending {len(send)}, marking {len(skipped)} missed.")
+
+
+async def rearm_reminder_job():
+    """Arms the reminder job for the earliest pending reminder in the database."""
+    global _materialized_hint
+    with _arm_lock:
+        _materialized_hint = None
+    next_fire = await adb.get_next_due_time(_shards)
+    with _arm_lock:
+        if _materialized_hint is not None and (next_fire is None or _materialized_hint < next_fire):
+            next_fire = _materialized_hint
+        _arm_reminder_job_locked(next_fire)
+
+
+def _on_reminders_materialized(earliest):
+    """Fires the reminder job sooner when this process materialises an earlier reminder. May run on DB threads."""
+    global _materialized_hint
+    with _arm_lock:
+        if _materialized_hint is None or earliest < _materialized_hint:
+            _materialized_hint = earliest
+        if _next_fire_at is None or earliest < _next_fire_at:
+            _arm_reminder_job_locked(earliest)
+
+
+def _arm_reminder_job_locked(next_fire):
+    global _next_fire_at
+    if _scheduler is None:
+        return
+    if next_fire is None:
+        _next_fire_at = None
+        if _scheduler.get_job(REMINDER_JOB_ID):
+            _scheduler.remove_job(REMINDER_JOB_ID)
+        logger.debug("No pending reminders. Reminder job idle until one is materialised.")
+        return
+    if next_fire == _next_fire_at and _scheduler.get_job(REMINDER_JOB_ID):
+        return
+    _next_fire_at = next_fire
+    _scheduler.add_job(
+        check_and_send_reminders,
+        DateTrigger(run_date=next_fire),
+        args=[_bot],
+        id=REMINDER_JOB_ID,
+        replace_existing=True,
+        misfire_grace_time=None
+    )
+    logger.debug("Reminder job armed for %s.", next_fire)
+
+
+@profiled('job')
+async def extend_reminder_horizon():
+    """Rolls the materialised reminder horizon forward; runs in the process that owns the schedule."""
+    try:
+        await adb.extend_reminder_horizon()
+    except Exception as e:
+        logger.error(f"SCHEDULER JOB: Error extending the reminder horizon: {e}", exc_info=True)
 
 
+def _schedule_maintenance_jobs(scheduler):
+    """Jobs run by the process that owns the schedule: rolling the horizon forward and archiving old rows."""
+    scheduler.add_job(
+        extend_reminder_horizon,
+        IntervalTrigger(minutes=MATERIALIZE_INTERVAL_MINUTES),
+        id=MATERIALIZE_JOB_ID,
+        replace_existing=True
+    )
+    if DB_BACKEND != 'sqlite':
+        return  # Archiving to monthly files and incremental vacuuming are SQLite-only.
+    # Only does work during RETENTION_QUIET_HOURS, in short batches on the DB threads.
+    scheduler.add_job(
+        retention.run_retention,
+        IntervalTrigger(minutes=RETENTION_INTERVAL_MINUTES),
+        id=RETENTION_JOB_ID,
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True
+    )
+
+
+def add_escalation_deadline(deadline):
+    """Makes sure the escalation job runs at `deadline`; called when a reminder starts awaiting an answer."""
+    if deadline in _escalation_deadline_set:
+        return
+    _escalation_deadline_set.add(deadline)
+    heapq.heappush(_escalation_deadlines, deadline)
+    if _escalation_armed_at is None or deadline < _escalation_armed_at:
+        _arm_escalation_job()
+
+
+async def rearm_escalation_job():
+    """Adds the earliest escalation deadline in the database, which may be a reminder another instance sent."""
+    deadline = await adb.get_next_escalation_time(_shards)
+    if deadline is not None:
+        add_escalation_deadline(deadline)
+
+
+async def _rearm_jobs():
+    await rearm_reminder_job()
+    await rearm_escalation_job()
+
+
+def _load_escalation_deadlines(deadlines):
+    _escalation_deadline_set.clear()
+    _escalation_deadline_set.update(deadlines)
+    _escalation_deadlines[:] = list(_escalation_deadline_set)
+    heapq.heapify(_escalation_deadlines)
+    _arm_escalation_job()
+
+
+def _arm_escalation_job():
+    """(Re)schedules the one-shot escalation job for the earliest pending deadline."""
+    global _escalation_armed_at
+    if _scheduler is None:
+        return
+    if not _escalation_deadlines:
+        _escalation_armed_at = None
+        if _scheduler.get_job(ESCALATION_JOB_ID):
+            _scheduler.remove_job(ESCALATION_JOB_ID)
+        return
+    next_deadline = _escalation_deadlines[0]
+    if next_deadline == _escalation_armed_at and _scheduler.get_job(ESCALATION_JOB_ID):
+        return
+    _escalation_armed_at = next_deadline
+    _scheduler.add_job(
+        check_missed_reminders_and_escalate,
+        DateTrigger(run_date=next_deadline),
+        args=[_bot],
+        id=ESCALATION_JOB_ID,
+        replace_existing=True,
+        misfire_grace_time=None
+    )
+    logger.debug("Escalation job armed for %s.", next_deadline)
+
+
+@profiled('job')
 async def check_missed_reminders_and_escalate(bot: Bot):
+    """Escalates every unanswered reminder whose deadline has passed, then re-arms for the next deadline."""
+    global _escalation_armed_at
     # logger.info("SCHEDULER JOB: check_missed_reminders_and_escalate - RUNNING")
-    # ... (Your existing logic for escalation, ensure user_telegram_id is valid before sending) ...
     # Ensure timezone awareness here too.
+    started = time.perf_counter()
     now_utc = datetime.now(timezone.utc)
-    conn = None
+    while _escalation_deadlines and _escalation_deadlines[0] <= now_utc:
+        _escalation_deadline_set.discard(heapq.heappop(_escalation_deadlines))
+    _escalation_armed_at = None
     try:
-        conn = db.get_db_connection()
-        escalation_window_start_for_sent = now_utc - timedelta(minutes=CALL_ESCALATION_DELAY_MINUTES)
-        # logger.debug(f"Escalation check: Looking for 'sent' reminders scheduled before {escalation_window_start_for_sent.isoformat()}")
-
-        missed_reminders_to_escalate = conn.execute(
-            """SELECT rl.id as log_id, m.med_name, rl.user_telegram_id, u.phone_number, rl.scheduled_time
-               FROM reminders_log rl
-               JOIN medications m ON rl.medication_id = m.id
-               JOIN users u ON rl.user_telegram_id = u.telegram_id
-               WHERE rl.status = 'sent' 
-                 AND rl.scheduled_time < ?
-            """, (escalation_window_start_for_sent.isoformat(),)
-        ).fetchall()
+        # Acks may still be sitting in the write-behind queue; make them visible before scanning.
+        await status_writer.flush_now()
+        missed_reminders_to_escalate = await adb.get_reminders_to_escalate(now_utc, _shards)
+        profiles = await adb.get_user_profiles(row['user_telegram_id'] for row in missed_reminders_to_escalate)
         
         # logger.debug(f"Found {len(missed_reminders_to_escalate)} 'sent' reminders eligible for escalation check.")
 
+        escalations = []
         for reminder in missed_reminders_to_escalate:
             log_id = reminder['log_id']
             med_name = reminder['med_name']
             user_telegram_id = reminder['user_telegram_id']
-            phone_number = reminder['phone_number']
+            profile = profiles.get(user_telegram_id)
+            phone_number = profile['phone_number'] if profile else None
             
             if not user_telegram_id: # Important check
                 logger.error(f"  Escalation: Invalid or missing user_telegram_id for log ID {log_id}. Cannot escalate.")
@@ -206,44 +320,116 @@ async def check_missed_reminders_and_escalate(bot: Bot):
 
             # logger.info(f"  Escalation Candidate: Log ID {log_id} ({med_name}) for user {user_telegram_id}. Phone: {phone_number}")
             
-            if phone_number:
-                # logger.info(f"    Simulating call escalation to {phone_number} for log ID {log_id}.")
-                await bot.send_message(user_telegram_id,
-                                       f"🚨 It seems you missed your {med_name} dose. "
-                                       f"A call would be made to {phone_number} if fully enabled.")
-                db.update_reminder_log_status(log_id, 'call_triggered')
+            if phone_number and call_relay.running:
+                text = f"🚨 It seems you missed your {med_name} dose. We're calling {phone_number} now."
+                call = call_payload(phone_number, f"This is MediMinder. It's time to take your {med_name}.")
+                escalations.append((log_id, 'call_triggered', user_telegram_id, message_payload(text), call))
+            elif phone_number:
+                text = (f"🚨 It seems you missed your {med_name} dose. "
+                        f"A call would be made to {phone_number} if fully enabled.")
+                escalations.append((log_id, 'call_triggered', user_telegram_id, message_payload(text), None))
             else:
                 # logger.warning(f"    No phone number for user {user_telegram_id} to escalate log ID {log_id}.")
-                await bot.send_message(user_telegram_id,
-                                       f"🚨 It seems you missed your {med_name} dose. "
-                                       "Please set a phone number in settings for call alerts.")
-                db.update_reminder_log_status(log_id, 'missed')
-            conn.commit()
+                text = (f"🚨 It seems you missed your {med_name} dose. "
+                        "Please set a phone number in settings for call alerts.")
+                escalations.append((log_id, 'missed', user_telegram_id, message_payload(text), None))
+        if escalations:
+            # Status change, escalation message and call commit together, so a dose is escalated exactly once.
+            await adb.escalate_reminders(escalations)
+            outbox_relay.wake()
+            call_relay.wake()
+            for _, status, _, _, _ in escalations:
+                metrics.escalations_total.inc(status=status)
     except Exception as e:
         logger.error(f"SCHEDULER JOB: Major error in check_missed_reminders_and_escalate: {e}", exc_info=True)
-        if conn: conn.rollback()
     finally:
-        if conn: conn.close()
+        _arm_escalation_job()
+        metrics.scheduler_tick_seconds.observe(time.perf_counter() - started, job='escalation')
     # logger.info("SCHEDULER JOB: check_missed_reminders_and_escalate - FINISHED")
 
 
+async def start_reminder_engine(scheduler, bot: Bot, shards=None):
+    """Starts sending and the reminder/escalation jobs on `scheduler`, optionally for a subset of shards."""
+    global _scheduler, _shards, _bot
+    _scheduler = scheduler
+    _shards = shards
+    _bot = bot
+    dispatcher.start()
+    status_writer.start()
+    await outbox_relay.start(bot, shards)
+    await call_relay.start(shards=shards)
+
+    await _catch_up(datetime.now(timezone.utc))
+    db.add_materialize_listener(_on_reminders_materialized)
+    await rearm_reminder_job()
+    # Deadlines already past (e.g. while the bot was down) arm the job to run immediately.
+    _load_escalation_deadlines(await adb.get_escalation_deadlines(shards))
+
+
+async def set_shards(shards, taken_over=()):
+    """Switches a running sharded engine to a new set of owned shards.
+
+    `taken_over` are the newly owned shards whose previous lease expired: their owner stopped
+    without releasing them, so the messages and calls it had claimed are recovered here.
+    """
+    global _shards
+    _shards = shards
+    outbox_relay.shards = shards
+    call_relay.shards = shards
+    if taken_over:
+        shard_count, _ = shards
+        await outbox_relay.take_over((shard_count, taken_over))
+        await call_relay.take_over((shard_count, taken_over))
+    # Newly acquired shards may have been unowned for a while; deal with what their old owner didn't send.
+    await _catch_up(datetime.now(timezone.utc))
+    await rearm_reminder_job()
+    _load_escalation_deadlines(await adb.get_escalation_deadlines(shards))
+
+
+async def stop_reminder_engine():
+    """Stops claiming outbox messages, lets queued sends drain, then flushes buffered writes."""
+    await outbox_relay.stop()
+    await call_relay.stop()
+    await dispatcher.stop()
+    logger.info("Send dispatcher stopped.")
+    await outbox_relay.flush()
+    await status_writer.stop()
+
+
 async def schedule_jobs(application):
-    scheduler = application.job_queue.scheduler
     logger.info("Attempting to add/update scheduler jobs...") # Changed log message slightly
-    scheduler.add_job(
-        check_and_send_reminders, 
-        IntervalTrigger(seconds=30), 
-        args=[application.bot], 
-        id="check_reminders_job", 
-        replace_existing=True,
-        misfire_grace_time=25
-    )
-    scheduler.add_job(
-        check_missed_reminders_and_escalate, 
-        IntervalTrigger(minutes=1), 
-        args=[application.bot], 
-        id="check_escalation_job", 
+    # Reminders are materialised by this process in both modes, before anything starts sending them.
+    await extend_reminder_horizon()
+    _schedule_maintenance_jobs(application.job_queue.scheduler)
+    if SCHEDULER_MODE == 'sharded':
+        # Reminders are sent by the shard workers; this process only serves Telegram updates.
+        status_writer.start()
+        shard_worker.start_workers(application.job_queue.scheduler)
+        logger.info(f"Scheduler running in sharded mode with {SCHEDULER_WORKERS} worker processes.")
+        return
+    await start_reminder_engine(application.job_queue.scheduler, application.bot)
+    # Reminders materialised by another process (e.g. `python -m bulk_io import`, or an instance whose
+    # PostgreSQL notification this one missed) don't wake this one; re-reading the next due time picks
+    # them up. Likewise for escalation deadlines, which only the sending instance knows about: if it
+    # stops, another one escalates its unanswered reminders. Sharded workers poll schedule_events instead.
+    application.job_queue.scheduler.add_job(
+        _rearm_jobs,
+        IntervalTrigger(seconds=REMINDER_REARM_SECONDS),
+        id=REARM_JOB_ID,
         replace_existing=True,
-        misfire_grace_time=55
+        max_instances=1,
+        coalesce=True
     )
-    logger.info("APScheduler jobs (check_reminders_job, check_escalation_job) configured in PTB's job queue.")
\ No newline at end of file
+    logger.info("APScheduler jobs (check_reminders_job, check_escalation_job, materialize_reminders_job, "
+                "rearm_reminders_job) configured in PTB's job queue.")
+
+
+async def shutdown_jobs(application):
+    """Stops sending (or the shard workers), flushes buffered writes, then releases the DB pool."""
+    if SCHEDULER_MODE == 'sharded':
+        shard_worker.stop_workers()
+        await dispatcher.stop()  # Only started here by a broadcast.
+        await status_writer.stop()
+    else:
+        await stop_reminder_engine()
+    await adb.shutdown()
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+from datetime import timezone
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.interval import IntervalTrigger
+from telegram import Bot
+
+import database as db
+import db_async as adb
+import metrics
+from logging_setup import setup_logging
+import scheduler as reminder_scheduler
+from dispatcher import dispatcher
+from profiling import profiler
+from config import (
+    TELEGRAM_TOKEN, DISPATCH_GLOBAL_RATE, SCHEDULER_WORKERS, SCHEDULER_SHARDS,
+    SHARD_LEASE_TTL_SECONDS, SHARD_POLL_SECONDS, METRICS_PORT, METRICS_ADDR,
+)
+
+logger = logging.getLogger(__name__)
+
+_processes = {}  # worker index -> multiprocessing.Process, in the front process
+# Workers poll every few seconds; anything older than this has been seen by every live worker.
+SCHEDULE_EVENT_RETENTION_SECONDS = 3600
+
+
+# --- Front process side ---
+def start_workers(scheduler):
+    """Spawns the shard worker processes and a job on `scheduler` that restarts any that die."""
+    for index in range(SCHEDULER_WORKERS):
+        _spawn(index)
+    scheduler.add_job(
+        _supervise,
+        IntervalTrigger(seconds=SHARD_LEASE_TTL_SECONDS),
+        id="shard_worker_supervisor",
+        replace_existing=True
+    )
+
+
+def _spawn(index):
+    process = multiprocessing.get_context("spawn").Process(
+        target=worker_main, args=(index,), name=f"shard-worker-{index}", daemon=True
+    )
+    process.start()
+    _processes[index] = process
+    logger.info(f"Started shard worker {index} (pid {process.pid}).")
+
+
+async def _supervise():
+    for index, process in list(_processes.items()):
+        if not process.is_alive():
+            logger.error(f"Shard worker {index} (pid {process.pid}) exited with code {process.exitcode}. Restarting.")
+            _spawn(index)
+    await adb.run(db.prune_schedule_events, SCHEDULE_EVENT_RETENTION_SECONDS)
+
+
+def stop_workers(timeout=15):
+    """Asks every worker to release its shards and exit; kills any that don't within `timeout`."""
+    for process in _processes.values():
+        if process.is_alive():
+            process.terminate()  # SIGTERM, handled as a clean shutdown by the worker
+    for index, process in _processes.items():
+        process.join(timeout)
+        if process.is_alive():
+            logger.error(f"Shard worker {index} did not stop in {timeout}s. Killing it.")
+            process.kill()
+    _processes.clear()
+
+
+# --- Worker process side ---
+def worker_main(index):
+    """Entry point of a shard worker process."""
+    setup_logging(f"worker{index}")
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    if METRICS_PORT:
+        metrics.start_http_server(METRICS_PORT + 1 + index, METRICS_ADDR)
+    asyncio.run(_run_worker(owner))
+
+
+async def _run_worker(owner):
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    # Windows has no loop signal handlers: there the front process falls back to kill() after the join timeout.
+    if os.name != "nt":
+        loop.add_signal_handler(signal.SIGTERM, stopping.set)
+
+    bot = Bot(token=TELEGRAM_TOKEN)
+    await bot.initialize()
+    profiler.start(bot)
+    scheduler = AsyncIOScheduler(timezone=timezone.utc)
+    scheduler.start()
+    # Every worker sends through the same bot token, so they split the global rate limit.
+    dispatcher.global_rate = DISPATCH_GLOBAL_RATE / SCHEDULER_WORKERS
+
+    # Read the change feed position before loading, so nothing between the two is missed.
+    last_event_id = await adb.run(db.get_last_schedule_event_id)
+    # Starting the relays recovers whatever is in flight on every owned shard, taken over or not.
+    owned, _ = await adb.run(db.acquire_shard_leases, owner, SCHEDULER_SHARDS, SHARD_LEASE_TTL_SECONDS)
+    await reminder_scheduler.start_reminder_engine(scheduler, bot, (SCHEDULER_SHARDS, owned))
+    logger.info(f"Shard worker {owner} owns {len(owned)} shards.")
+
+    renew_every = max(1, int(SHARD_LEASE_TTL_SECONDS / 3 / SHARD_POLL_SECONDS))
+    tick = 0
+    try:
+        while not stopping.is_set():
+            try:
+                await asyncio.wait_for(stopping.wait(), SHARD_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            if stopping.is_set():
+                break
+            tick += 1
+            try:
+                if tick % renew_every == 0:
+                    new_owned, taken_over = await adb.run(db.acquire_shard_leases, owner, SCHEDULER_SHARDS, SHARD_LEASE_TTL_SECONDS)
+                    if new_owned != owned:
+                        logger.info(f"Shard worker {owner}: shards changed from {len(owned)} to {len(new_owned)}. Reloading.")
+                        last_event_id = await adb.run(db.get_last_schedule_event_id)
+                        owned = new_owned
+                        await reminder_scheduler.set_shards((SCHEDULER_SHARDS, owned), taken_over)
+                last_event_id = await _apply_schedule_events(last_event_id, owned)
+            except Exception as e:
+                logger.error(f"Shard worker {owner}: error in coordination loop: {e}", exc_info=True)
+    finally:
+        await reminder_scheduler.stop_reminder_engine()
+        await adb.run(db.release_shard_leases, owner)
+        scheduler.shutdown(wait=False)
+        await bot.shutdown()
+        await adb.shutdown()
+        logger.info(f"Shard worker {owner} stopped and released its shards.")
+
+
+async def _apply_schedule_events(last_event_id, owned):
+    """Re-arms this worker's reminder job when another process changed reminders in its shards."""
+    events = await adb.run(db.get_schedule_events, last_event_id)
+    changed = False
+    for event in events:
+        last_event_id = event['id']
+        if db.shard_of(event['user_telegram_id'], SCHEDULER_SHARDS) in owned:
+            changed = True
+    if changed:
+        # The front process materialised (or removed) the rows already; only the next fire time can move.
+        await reminder_scheduler.rearm_reminder_job()
+    return last_event_id
@@ -0,0 +1,198 @@
+"""The storage interface handlers and the scheduler go through (via db_async).
+
+Two implementations: db_async.SQLiteStorage runs the database.py functions on a thread pool, and
+pg_storage.PostgresStorage talks to PostgreSQL over an asyncpg connection pool. DB_BACKEND picks one.
+Rows come back as mappings with the same column names either way, and timestamps as canonical UTC
+text (see database.to_db_timestamp). The database.py docstrings describe each operation in detail.
+"""
+from abc import ABC, abstractmethod
+
+from database import MESSAGE_KINDS
+
+
+class Storage(ABC):
+    """Every operation the bot needs from its database, as coroutines. A backend implements them all."""
+
+    # True when several bot processes may share the database, so work must be claimed row by row and
+    # recovery must leave alone what live instances have in flight.
+    shared = False
+
+    async def start(self):
+        """Opens connections and brings the schema up to date."""
+
+    async def close(self):
+        """Waits for in-flight calls, then closes every connection."""
+
+    # --- Users ---
+    @abstractmethod
+    async def add_user(self, telegram_id, phone_number=None):
+        """Adds a user if they don't exist. Returns False on a database error."""
+
+    @abstractmethod
+    async def get_user_profile(self, telegram_id):
+        """The user's row (telegram_id, phone_number, timezone), or None."""
+
+    @abstractmethod
+    async def get_user_profiles(self, telegram_ids):
+        """{telegram_id: profile row} for the given users that exist."""
+
+    @abstractmethod
+    async def set_user_timezone(self, telegram_id, tz_name):
+        """Stores the user's time zone and re-materialises their upcoming reminders in it."""
+
+    @abstractmethod
+    async def mark_user_inactive(self, user_telegram_id):
+        """Deactivates the user's medications and drops their pending reminders."""
+
+    # --- Medications ---
+    @abstractmethod
+    async def add_medication_db(self, user_telegram_id, med_name, dosage, times_of_day):
+        """Adds a medication and materialises its reminders. Returns its id, or None on error."""
+
+    @abstractmethod
+    async def get_active_medications_for_user(self, user_telegram_id):
+        ...
+
+    @abstractmethod
+    async def get_medication(self, med_id):
+        ...
+
+    # --- Reminders ---
+    @abstractmethod
+    async def extend_reminder_horizon(self):
+        """Materialises every active medication up to the horizon. Returns rows inserted."""
+
+    @abstractmethod
+    async def get_due_reminders(self, due_by, shards=None):
+        """'pending' reminders scheduled at or before `due_by`, oldest first."""
+
+    @abstractmethod
+    async def claim_due_reminders(self, due_by, build_payload, shards=None):
+        """Queues every due 'pending' reminder in the outbox. Returns the number this process queued."""
+
+    @abstractmethod
+    async def get_next_due_time(self, shards=None):
+        ...
+
+    @abstractmethod
+    async def queue_reminders(self, reminders, build_payload):
+        """Queues the given get_due_reminders() rows that are still 'pending'. Returns the number queued."""
+
+    @abstractmethod
+    async def mark_reminders_missed(self, log_ids):
+        ...
+
+    @abstractmethod
+    async def get_reminders_to_escalate(self, due_by, shards=None):
+        ...
+
+    @abstractmethod
+    async def get_escalation_deadlines(self, shards=None):
+        ...
+
+    @abstractmethod
+    async def get_next_escalation_time(self, shards=None):
+        ...
+
+    @abstractmethod
+    async def escalate_reminders(self, escalations):
+        ...
+
+    @abstractmethod
+    async def snooze_reminder(self, log_id, refire_at, max_snoozes, build_payload):
+        ...
+
+    @abstractmethod
+    async def get_reminder_log(self, log_id):
+        ...
+
+    @abstractmethod
+    async def update_reminder_log_status(self, log_id, status, acknowledged_at=None, snooze_count_increment=False):
+        ...
+
+    @abstractmethod
+    async def update_reminder_statuses(self, updates):
+        """Writes (log_id, status, acknowledged_at text or None, snooze increment) tuples in one transaction."""
+
+    # --- Adherence statistics ---
+    @abstractmethod
+    async def get_user_adherence(self, user_telegram_id, since_day):
+        ...
+
+    @abstractmethod
+    async def get_adherence_by_day(self, since_day):
+        ...
+
+    @abstractmethod
+    async def get_population_counts(self):
+        ...
+
+    # --- Outbox ---
+    @abstractmethod
+    async def recover_outbox(self, shards=None, kinds=MESSAGE_KINDS):
+        """Puts messages left 'inflight' by a stopped process back to 'pending'. Returns how many."""
+
+    @abstractmethod
+    async def claim_outbox_batch(self, limit, shards=None, kinds=MESSAGE_KINDS):
+        ...
+
+    @abstractmethod
+    async def complete_outbox(self, results):
+        ...
+
+    @abstractmethod
+    async def fail_interrupted_calls(self, shards=None):
+        ...
+
+    @abstractmethod
+    async def complete_calls(self, results):
+        ...
+
+    @abstractmethod
+    async def prune_outbox(self, older_than_hours):
+        ...
+
+    @abstractmethod
+    async def get_scheduler_state(self, keys):
+        ...
+
+    # --- Broadcasts ---
+    @abstractmethod
+    async def create_broadcast(self, text, created_by):
+        ...
+
+    @abstractmethod
+    async def get_broadcast(self, broadcast_id=None):
+        ...
+
+    @abstractmethod
+    async def get_running_broadcast(self):
+        ...
+
+    @abstractmethod
+    async def get_broadcast_recipients(self, after_telegram_id, limit):
+        ...
+
+    @abstractmethod
+    async def save_broadcast_progress(self, broadcast_id, cursor, sent, failed, blocked, status='running'):
+        ...
+
+    async def claim_broadcast(self, broadcast_id):
+        """True if this process may send the broadcast: no other instance is sending it."""
+        return True
+
+    async def release_broadcast(self, broadcast_id):
+        """Lets another instance resume the broadcast."""
+
+    # --- Bot persistence ---
+    @abstractmethod
+    async def load_persistence_data(self, kind, key):
+        ...
+
+    @abstractmethod
+    async def load_conversations(self, name, max_age_days):
+        ...
+
+    @abstractmethod
+    async def save_persistence(self, data, conversations):
+        ...
@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+# config refuses to load without a token; the tests never talk to Telegram.
+os.environ.setdefault("TELEGRAM_TOKEN", "test-token")
+
+import database as db  # noqa: E402
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    """A fresh, migrated SQLite database for this test; returns this thread's connection to it."""
+    db.close_db_connections()
+    monkeypatch.setattr(db, "DB_NAME", str(tmp_path / "test.db"))
+    db.init_db()
+    yield db.get_db_connection()
+    db.close_db_connections()
+
+
+@pytest.fixture
+def add_reminder(conn):
+    """Adds a reminder for `user` in `status`, with a medication and user to go with it. Returns its log id."""
+    def add(status="sent", user=1001, scheduled_time="2026-01-01 08:00:00", escalate_at=None):
+        conn.execute("INSERT OR IGNORE INTO users (telegram_id) VALUES (?)", (user,))
+        med_id = conn.execute(
+            "INSERT INTO medications (user_telegram_id, med_name, dosage, times_of_day) VALUES (?, 'Aspirin', '100 mg', '08:00')",
+            (user,)
+        ).lastrowid
+        log_id = conn.execute(
+            "INSERT INTO reminders_log (medication_id, user_telegram_id, scheduled_time, status, escalate_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (med_id, user, scheduled_time, status, escalate_at)
+        ).lastrowid
+        conn.commit()
+        return log_id
+    return add
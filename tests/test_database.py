@@ -0,0 +1,171 @@
+import json
+import time
+
+import pytest
+
+import database as db
+
+SHARDS = 4
+
+
+def status_of(conn, log_id):
+    return conn.execute("SELECT status FROM reminders_log WHERE id = ?", (log_id,)).fetchone()[0]
+
+
+def add_outbox(conn, chat_id, status="pending", kind="reminder", log_id=None, next_attempt_at="2026-01-01 08:00:00"):
+    return conn.execute(
+        "INSERT INTO outbox (kind, dedup_key, chat_id, log_id, payload, status, next_attempt_at) "
+        "VALUES (?, ?, ?, ?, '{}', ?, ?)",
+        (kind, f"{kind}:{chat_id}:{log_id}:{time.monotonic_ns()}", chat_id, log_id, status, next_attempt_at)
+    ).lastrowid
+
+
+def outbox_status(conn, outbox_id):
+    return conn.execute("SELECT status FROM outbox WHERE id = ?", (outbox_id,)).fetchone()[0]
+
+
+def user_in_shard(shard):
+    return next(user for user in range(1000, 2000) if db.shard_of(user, SHARDS) == shard)
+
+
+# --- Status transitions ---
+@pytest.mark.parametrize("status,previous", [
+    (status, previous) for status, allowed in db.STATUS_TRANSITIONS_FROM.items() for previous in allowed
+])
+def test_allowed_transition_is_written(conn, add_reminder, status, previous):
+    log_id = add_reminder(previous)
+    db.update_reminder_statuses([(log_id, status, None, 0)])
+    assert status_of(conn, log_id) == status
+
+
+@pytest.mark.parametrize("status,later", [
+    ("sent", "acknowledged"), ("sent", "call_triggered"), ("sent", "missed"), ("sent", "send_failed"),
+    ("send_failed", "sent"), ("send_failed", "acknowledged"),
+])
+def test_late_transition_does_not_move_a_reminder_back(conn, add_reminder, status, later):
+    log_id = add_reminder(later)
+    db.update_reminder_statuses([(log_id, status, None, 0)])
+    assert status_of(conn, log_id) == later
+
+
+def test_ack_after_call_escalation_counts_as_taken(conn, add_reminder):
+    log_id = add_reminder("call_triggered")
+    db.update_reminder_statuses([(log_id, "acknowledged", "2026-01-01 08:40:00", 0)])
+    row = conn.execute("SELECT status, acknowledged_at FROM reminders_log WHERE id = ?", (log_id,)).fetchone()
+    assert (row["status"], row["acknowledged_at"]) == ("acknowledged", "2026-01-01 08:40:00")
+
+
+def test_batch_applies_each_rows_own_transition(conn, add_reminder):
+    queued, acked, snoozed = add_reminder("queued"), add_reminder("acknowledged"), add_reminder("snoozed")
+    db.update_reminder_statuses([(queued, "sent", None, 0), (acked, "sent", None, 0), (snoozed, "sent", None, 1)])
+    assert [status_of(conn, log_id) for log_id in (queued, acked, snoozed)] == ["sent", "acknowledged", "sent"]
+    assert conn.execute("SELECT snooze_count FROM reminders_log WHERE id = ?", (snoozed,)).fetchone()[0] == 1
+
+
+def test_empty_batch_is_a_no_op(conn):
+    db.update_reminder_statuses([])
+
+
+# --- Snoozing ---
+def snooze_payload(log_id, med, snooze_count):
+    return {"text": f"{med['med_name']} again ({snooze_count})"}
+
+
+def test_snooze_stops_at_the_limit(conn, add_reminder):
+    log_id = add_reminder("sent")
+    refire_at = db.from_db_timestamp("2026-01-01 08:05:00")
+    counts = []
+    for _ in range(3):
+        counts.append(db.snooze_reminder(log_id, refire_at, 2, snooze_payload))
+        db.update_reminder_statuses([(log_id, "sent", None, 0)])  # the re-send went out
+    assert counts == [1, 2, None]
+    assert conn.execute("SELECT snooze_count FROM reminders_log WHERE id = ?", (log_id,)).fetchone()[0] == 2
+    messages = conn.execute("SELECT dedup_key, payload FROM outbox WHERE log_id = ? ORDER BY id", (log_id,)).fetchall()
+    assert [row["dedup_key"] for row in messages] == [f"snooze:{log_id}:1", f"snooze:{log_id}:2"]
+    assert json.loads(messages[1]["payload"]) == {"text": "Aspirin again (2)"}
+
+
+def test_snooze_moves_the_escalation_deadline(conn, add_reminder):
+    log_id = add_reminder("sent", escalate_at="2026-01-01 08:30:00")
+    refire_at = db.from_db_timestamp("2026-01-01 08:05:00")
+    assert db.snooze_reminder(log_id, refire_at, 3, snooze_payload) == 1
+    row = conn.execute("SELECT status, escalate_at FROM reminders_log WHERE id = ?", (log_id,)).fetchone()
+    assert row["status"] == "snoozed"
+    assert db.from_db_timestamp(row["escalate_at"]) == db.escalation_deadline(refire_at)
+
+
+@pytest.mark.parametrize("status", ["acknowledged", "missed", "call_triggered", "snoozed"])
+def test_answered_or_snoozed_reminder_cannot_be_snoozed(conn, add_reminder, status):
+    log_id = add_reminder(status)
+    assert db.snooze_reminder(log_id, db.from_db_timestamp("2026-01-01 08:05:00"), 3, snooze_payload) is None
+    assert status_of(conn, log_id) == status
+    assert conn.execute("SELECT COUNT(*) FROM outbox WHERE log_id = ?", (log_id,)).fetchone()[0] == 0
+
+
+# --- Outbox ---
+def test_claim_takes_due_messages_once(conn):
+    due = add_outbox(conn, 1001)
+    later = add_outbox(conn, 1001, next_attempt_at="2999-01-01 00:00:00")
+    inflight = add_outbox(conn, 1001, status="inflight")
+    call = add_outbox(conn, 1001, kind="call")
+    conn.commit()
+    assert [row["id"] for row in db.claim_outbox_batch(10)] == [due]
+    assert outbox_status(conn, due) == "inflight"
+    assert db.claim_outbox_batch(10) == []
+    assert [row["id"] for row in db.claim_outbox_batch(10, kinds=("call",))] == [call]
+    assert outbox_status(conn, later) == "pending" and outbox_status(conn, inflight) == "inflight"
+
+
+def test_claim_respects_limit_and_order(conn):
+    ids = [add_outbox(conn, 1001, next_attempt_at=f"2026-01-01 08:0{minute}:00") for minute in (3, 1, 2)]
+    conn.commit()
+    assert [row["id"] for row in db.claim_outbox_batch(2)] == [ids[1], ids[2]]
+
+
+def test_claim_only_takes_owned_shards(conn):
+    mine, theirs = add_outbox(conn, user_in_shard(1)), add_outbox(conn, user_in_shard(2))
+    conn.commit()
+    assert [row["id"] for row in db.claim_outbox_batch(10, (SHARDS, {1}))] == [mine]
+    assert outbox_status(conn, theirs) == "pending"
+
+
+def test_recover_resends_inflight_messages(conn, add_reminder):
+    log_id = add_reminder("queued")
+    message = add_outbox(conn, 1001, status="inflight", log_id=log_id)
+    call = add_outbox(conn, 1001, status="inflight", kind="call")
+    conn.commit()
+    assert db.recover_outbox() == 1
+    assert outbox_status(conn, message) == "pending"
+    assert outbox_status(conn, call) == "inflight"  # calls have their own recovery
+    assert [row["id"] for row in db.claim_outbox_batch(10)] == [message]
+
+
+def test_recover_closes_reminders_that_were_delivered(conn, add_reminder):
+    log_id = add_reminder("acknowledged")
+    message = add_outbox(conn, 1001, status="inflight", log_id=log_id)
+    conn.commit()
+    assert db.recover_outbox() == 0
+    assert outbox_status(conn, message) == "sent"
+    assert status_of(conn, log_id) == "acknowledged"
+
+
+def test_recover_only_touches_given_shards(conn):
+    mine, theirs = add_outbox(conn, user_in_shard(1), "inflight"), add_outbox(conn, user_in_shard(2), "inflight")
+    conn.commit()
+    assert db.recover_outbox((SHARDS, {1})) == 1
+    assert (outbox_status(conn, mine), outbox_status(conn, theirs)) == ("pending", "inflight")
+
+
+# --- Shard leases ---
+def test_expired_leases_are_taken_over(conn):
+    assert db.acquire_shard_leases("a", SHARDS, 30) == ({0, 1, 2, 3}, set())
+    conn.execute("UPDATE scheduler_leases SET expires_at = ?", (time.time() - 1,))
+    conn.execute("UPDATE scheduler_workers SET heartbeat_at = 0")
+    conn.commit()
+    assert db.acquire_shard_leases("b", SHARDS, 30) == ({0, 1, 2, 3}, {0, 1, 2, 3})
+
+
+def test_released_leases_are_not_taken_over(conn):
+    db.acquire_shard_leases("a", SHARDS, 30)
+    db.release_shard_leases("a")
+    assert db.acquire_shard_leases("b", SHARDS, 30) == ({0, 1, 2, 3}, set())
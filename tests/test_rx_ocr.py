@@ -0,0 +1,39 @@
+from rx_ocr import parse_prescription, parse_times
+
+
+def test_parse_prescription_reads_name_dosage_and_frequency():
+    text = "Rx: Amoxicillin 500 mg\nTake one capsule three times a day"
+    assert parse_prescription(text) == {
+        "med_name": "Amoxicillin", "dosage": "500 mg", "times_of_day": "08:00, 14:00, 20:00",
+    }
+
+
+def test_parse_prescription_prefers_explicit_times():
+    text = "Metformin 850 mg\nTake at 7:30 am and 7:30 pm"
+    assert parse_prescription(text)["times_of_day"] == "07:30, 19:30"
+
+
+def test_parse_prescription_missing_fields_are_none():
+    assert parse_prescription("Patient: John Smith") == {"med_name": None, "dosage": None, "times_of_day": None}
+
+
+def test_decimal_dosage_is_not_a_time():
+    text = "Levothyroxine 0.25 mg\nTake one tablet twice daily"
+    assert parse_prescription(text) == {
+        "med_name": "Levothyroxine", "dosage": "0.25 mg", "times_of_day": "08:00, 20:00",
+    }
+    assert parse_prescription("Bisoprolol 1.25 mg")["times_of_day"] is None
+    assert parse_times("Salbutamol 2.50 ml nightly") == ["22:00"]
+
+
+def test_dotted_time_needs_am_or_pm():
+    assert parse_times("Take at 8.30 pm") == ["20:30"]
+    assert parse_times("Take at 8.30am and 13:15") == ["08:30", "13:15"]
+    assert parse_times("Take 1.30 daily") == ["08:00"]
+
+
+def test_hour_with_meridiem_and_frequency_fallback():
+    assert parse_times("one tablet at 9 pm") == ["21:00"]
+    assert parse_times("Take twice daily") == ["08:00", "20:00"]
+    assert parse_times("Take four times a day") == ["08:00", "12:00", "16:00", "20:00"]
+    assert parse_times("as needed") == []
@@ -0,0 +1,94 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+import db_async as adb
+from write_behind import StatusWriteBehind
+
+ACKED_AT = datetime(2026, 1, 1, 8, 10, tzinfo=timezone.utc)
+
+
+class FlakyWriter:
+    """Stands in for adb.update_reminder_statuses; fails the next `failures` writes."""
+
+    def __init__(self):
+        self.batches = []
+        self.failures = 0
+        self.during_write = None  # called while a write is in progress
+
+    async def __call__(self, updates):
+        if self.during_write:
+            self.during_write()
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("database is locked")
+        self.batches.append(sorted(updates))
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    writer = FlakyWriter()
+    monkeypatch.setattr(adb, "update_reminder_statuses", writer)
+    return writer
+
+
+def test_updates_to_one_reminder_coalesce(writes):
+    queue = StatusWriteBehind()
+    queue.update(1, "sent")
+    queue.update(1, "acknowledged", acknowledged_at=ACKED_AT)
+    queue.update(2, "sent")
+    queue.update(2, "sent", snooze_count_increment=True)
+    queue.update(2, "sent", snooze_count_increment=True)
+    assert len(queue) == 2
+    assert asyncio.run(queue.flush()) == 2
+    assert writes.batches == [[(1, "acknowledged", "2026-01-01 08:10:00", 0), (2, "sent", None, 2)]]
+    assert len(queue) == 0
+
+
+@pytest.mark.parametrize("first,late", [("acknowledged", "sent"), ("acknowledged", "send_failed"), ("sent", "sent")])
+def test_late_update_does_not_undo_a_further_status(writes, first, late):
+    queue = StatusWriteBehind()
+    queue.update(1, first)
+    queue.update(1, late)
+    assert queue.pending_status(1) == first
+
+
+def test_failed_flush_is_requeued_and_retried(writes):
+    queue = StatusWriteBehind()
+    queue.update(1, "acknowledged", acknowledged_at=ACKED_AT)
+    queue.update(2, "sent", snooze_count_increment=True)
+    writes.failures = 1
+    with pytest.raises(RuntimeError):
+        asyncio.run(queue.flush())
+    assert len(queue) == 2
+    assert asyncio.run(queue.flush()) == 2
+    assert writes.batches == [[(1, "acknowledged", "2026-01-01 08:10:00", 0), (2, "sent", None, 1)]]
+
+
+def test_requeue_merges_with_updates_made_during_the_write(writes):
+    queue = StatusWriteBehind()
+    queue.update(1, "acknowledged", acknowledged_at=ACKED_AT)
+    queue.update(2, "sent", snooze_count_increment=True)
+    queue.update(3, "send_failed")
+
+    def more_updates():
+        assert queue.pending_status(1) == "acknowledged"  # still visible while being written
+        queue.update(1, "sent")
+        queue.update(2, "sent", snooze_count_increment=True)
+        queue.update(3, "acknowledged")
+
+    writes.failures = 1
+    writes.during_write = more_updates
+    with pytest.raises(RuntimeError):
+        asyncio.run(queue.flush())
+    writes.during_write = None
+    assert [queue.pending_status(log_id) for log_id in (1, 2, 3)] == ["acknowledged", "sent", "acknowledged"]
+    asyncio.run(queue.flush())
+    assert writes.batches == [[(1, "acknowledged", "2026-01-01 08:10:00", 0), (2, "sent", None, 2),
+                               (3, "acknowledged", None, 0)]]
+
+
+def test_flush_now_skips_an_empty_queue(writes):
+    asyncio.run(StatusWriteBehind().flush_now())
+    assert writes.batches == []
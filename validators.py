@@ -0,0 +1,22 @@
+"""Validation of user-entered values, shared by the bot conversations and bulk import."""
+
+
+def parse_times_of_day(text):
+    """Splits "8:00, 20:00" into (["08:00", "20:00"], invalid entries), normalising each valid time to HH:MM."""
+    valid_times = []
+    invalid_times = []
+    for t in (t.strip() for t in (text or "").split(',')):
+        try:
+            h, m = map(int, t.split(':'))
+            if 0 <= h < 24 and 0 <= m < 60:
+                valid_times.append(f"{h:02d}:{m:02d}")
+            else:
+                invalid_times.append(t)
+        except (ValueError, IndexError):
+            invalid_times.append(t)
+    return valid_times, invalid_times
+
+
+def is_valid_phone(phone_number):
+    """Country code + number, e.g. +1234567890."""
+    return phone_number.startswith('+') and len(phone_number) > 8 and phone_number[1:].isdigit()
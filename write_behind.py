@@ -0,0 +1,139 @@
+import asyncio
+import logging
+
+import database as db
+import db_async as adb
+import metrics
+from config import WRITE_BEHIND_FLUSH_SECONDS, WRITE_BEHIND_MAX_BATCH
+
+logger = logging.getLogger(__name__)
+
+
+class StatusWriteBehind:
+    """Coalesces reminders_log status transitions and writes them in batched transactions.
+
+    update() only touches memory, so sends and button taps never wait on an fsync. Pending
+    transitions are flushed every `flush_interval` seconds, or sooner once `max_batch` distinct
+    rows are waiting. Several updates to the same log_id collapse into one row write: the furthest
+    status wins (see database.STATUS_TRANSITIONS_FROM), the latest acknowledged_at is kept and snooze
+    increments add up. The write itself only moves a row forward, so a late 'sent' can't undo an ack.
+    """
+
+    def __init__(self, flush_interval=WRITE_BEHIND_FLUSH_SECONDS, max_batch=WRITE_BEHIND_MAX_BATCH):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending = {}   # log_id -> [status, acknowledged_at, snooze_increment]
+        self._inflight = {}  # batch currently being written, still visible to readers
+        self._flush_lock = asyncio.Lock()  # one flush at a time, so flush_now() waits for an in-progress write
+        self._wakeup = None
+        self._task = None
+        self._stopping = False
+
+    def update(self, log_id, status, acknowledged_at=None, snooze_count_increment=False):
+        entry = self._pending.get(log_id)
+        if entry is None:
+            entry = self._pending[log_id] = [status, None, 0]
+        elif entry[0] in db.STATUS_TRANSITIONS_FROM[status]:
+            entry[0] = status
+        if acknowledged_at:
+            entry[1] = db.to_db_timestamp(acknowledged_at)
+        if snooze_count_increment:
+            entry[2] += 1
+        if len(self._pending) >= self.max_batch and self._wakeup is not None:
+            self._wakeup.set()
+
+    def pending_status(self, log_id):
+        """The not-yet-flushed status for log_id, or None. Lets readers see their own writes."""
+        entry = self._pending.get(log_id) or self._inflight.get(log_id)
+        return entry[0] if entry else None
+
+    async def get_reminder_log(self, log_id):
+        """The reminder's row with any unflushed transition applied, so callers read their own writes."""
+        row = await adb.get_reminder_log(log_id)
+        entry = self._pending.get(log_id) or self._inflight.get(log_id)
+        if row is None or entry is None:
+            return row
+        row = dict(row)
+        row['status'] = entry[0]
+        row['snooze_count'] += entry[2]
+        return row
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def flush(self):
+        """Writes every pending transition in one transaction. Returns the number of rows written."""
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            batch = self._inflight = self._pending
+            self._pending = {}
+            try:
+                await adb.update_reminder_statuses(
+                    [(log_id, status, acknowledged_at, snooze_increment)
+                     for log_id, (status, acknowledged_at, snooze_increment) in batch.items()]
+                )
+            except Exception as e:
+                logger.error(f"DB Error flushing {len(batch)} reminder status updates, will retry: {e}")
+                self._requeue(batch)
+                raise
+            finally:
+                self._inflight = {}
+            logger.debug("Flushed %d reminder status updates.", len(batch))
+            return len(batch)
+
+    def _requeue(self, batch):
+        """Merges a failed batch back with anything that arrived while it was being written.
+
+        The furthest status wins, as in update(): a failed 'acknowledged' is not lost to a later 'sent'.
+        """
+        for log_id, (status, acknowledged_at, snooze_increment) in batch.items():
+            newer = self._pending.get(log_id)
+            if newer is None:
+                self._pending[log_id] = [status, acknowledged_at, snooze_increment]
+            else:
+                if newer[0] in db.STATUS_TRANSITIONS_FROM[status]:
+                    newer[0] = status
+                newer[1] = newer[1] or acknowledged_at
+                newer[2] += snooze_increment
+
+    async def flush_now(self):
+        """Flushes from async code, e.g. before a query that must see every transition."""
+        if self._pending or self._inflight:
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Status write-behind started (every {self.flush_interval}s or {self.max_batch} rows).")
+
+    async def stop(self):
+        """Stops the background flusher and writes whatever is still pending."""
+        if self._task is not None:
+            # Signalled rather than cancelled: wait_for() can swallow a cancel that races the wakeup event.
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush_now()
+        logger.info("Status write-behind stopped and flushed.")
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush_now()
+            except Exception:
+                pass  # Already logged and re-queued by flush()
+
+
+# Process-wide queue used for every reminder status transition.
+status_writer = StatusWriteBehind()
+metrics.Gauge("mediminder_status_writes_pending", "Reminder status transitions not yet written to the database.",
+              status_writer.__len__)